@@ -12,6 +12,9 @@ PASSWORD_HASHERS = (
 )
 DEBUG = False
 TEMPLATE_DEBUG = False
+HTTP_MAX_RETRIES = 0
+CIRCUIT_BREAKER_THRESHOLD = 0
+RISE_SET_MEMORY_CACHE_SIZE = 0
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
@@ -0,0 +1,286 @@
+'''
+    Computes observable intervals for many sidereal targets at once. Instead of solving rise and set times target by
+    target like rise_set's Visibility, the constraints of every target are evaluated on a shared time grid with numpy
+    and the crossing times are interpolated between grid points. The Sun and Moon come from the shared ephemeris of each
+    site, so their cost does not grow with the number of targets.
+
+    The constraints and their conventions follow rise_set: the Sun below nautical twilight, the target above the
+    horizon or airmass limit, the target within the hour angle limits of the telescope, and the target further than
+    its lunar distance limit from the Moon. rise_set checks the lunar distance every 30 minutes, whereas here it is
+    continuous, so intervals limited by the Moon can differ from rise_set's by up to that much.
+'''
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from math import floor, ceil
+from pyslalib import slalib as sla
+from rise_set.astrometry import gregorian_to_ut_mjd, ut_mjd_to_tdb
+import numpy as np
+
+from valhalla.common.ephemeris import (SECONDS_PER_DAY, greenwich_mean_sidereal_time, unit_vectors, sin_altitudes,
+                                       get_site_ephemeris)
+
+GRID_STEP = 300  # seconds between grid points
+BLOCK_SIZE = 64  # targets evaluated together on one grid
+NAUTICAL_TWILIGHT = -12.0
+MJD_EPOCH = datetime(1858, 11, 17, tzinfo=timezone.utc)
+HORIZON_REFRACTION = -0.5667  # rise_set's refraction term, only applied to a horizon of exactly zero
+MIN_MOON_DISTANCE = 0.5  # rise_set ignores lunar distance limits at or below this
+LIGHT_TIME_AU = 499.004782  # seconds for light to travel 1 AU
+# The standard atmosphere rise_set's calculate_airmass_at_times refracts with: temperature (K), pressure (mb),
+# relative humidity, wavelength (microns) and tropospheric lapse rate (K/m)
+STANDARD_ATMOSPHERE = (273.15, 1013.25, 0.3, 0.55, 0.0065)
+
+
+class BatchTargets(namedtuple('BatchTargets', ['ra', 'dec', 'proper_motion_ra', 'proper_motion_dec', 'epoch',
+                                               'max_airmass', 'min_lunar_distance'])):
+    '''
+        Arrays describing N sidereal targets and their constraints, in the units valhalla stores them: degrees for
+        ra, dec and min_lunar_distance, mas/year for proper motions and a julian year for the epoch.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_request_dicts(cls, request_dicts):
+        targets = [request_dict['target'] for request_dict in request_dicts]
+        constraints = [request_dict['constraints'] for request_dict in request_dicts]
+        return cls(
+            ra=np.array([target['ra'] for target in targets], dtype=float),
+            dec=np.array([target['dec'] for target in targets], dtype=float),
+            proper_motion_ra=np.array([target.get('proper_motion_ra') or 0.0 for target in targets], dtype=float),
+            proper_motion_dec=np.array([target.get('proper_motion_dec') or 0.0 for target in targets], dtype=float),
+            epoch=np.array([target.get('epoch') or 2000.0 for target in targets], dtype=float),
+            max_airmass=np.array([c.get('max_airmass') or 0.0 for c in constraints], dtype=float),
+            min_lunar_distance=np.array([c.get('min_lunar_distance') or 0.0 for c in constraints], dtype=float)
+        )
+
+    def take(self, indices):
+        return BatchTargets(*[field[indices] for field in self])
+
+
+def effective_horizon(max_airmass, horizon):
+    '''rise_set's set_airmass_limit and apply_refraction_to_horizon for an array of airmass limits'''
+    horizon_airmass = 1 / np.cos(np.radians(90.0 - horizon))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        airmass_horizon = 90.0 - np.degrees(np.arccos(1 / max_airmass))
+    limited = (max_airmass > 0) & (max_airmass < horizon_airmass)
+    altitude = np.where(limited, airmass_horizon, horizon)
+    return np.where(altitude == 0.0, HORIZON_REFRACTION, altitude)
+
+
+def apparent_positions(targets, tt_mjd):
+    '''
+        Apparent unit vectors of the targets at tt_mjd: proper motion, annual aberration and precession-nutation from
+        each target's epoch, the same corrections sla_map makes.
+    '''
+    dec = np.radians(targets.dec)
+    pm_ra = np.radians(targets.proper_motion_ra / 1000.0 / np.cos(dec) / 3600.0)
+    pm_dec = np.radians(targets.proper_motion_dec / 1000.0 / 3600.0)
+    years = (tt_mjd - (51544.5 + (targets.epoch - 2000.0) * 365.25)) / 365.25
+    positions = unit_vectors(np.radians(targets.ra) + pm_ra * years, dec + pm_dec * years)
+
+    barycentric_velocity = sla.sla_evp(tt_mjd, 2000.0)[0]
+    positions = positions + barycentric_velocity * LIGHT_TIME_AU
+    positions /= np.linalg.norm(positions, axis=1)[:, np.newaxis]
+
+    apparent = np.empty_like(positions)
+    for epoch in np.unique(targets.epoch):
+        same_epoch = targets.epoch == epoch
+        apparent[same_epoch] = positions[same_epoch].dot(sla.sla_prenut(epoch, tt_mjd).T)
+    return apparent
+
+
+def constraint_margins(site_detail, ephemeris, targets, positions, ut_mjd):
+    '''
+        Returns an array of shape (constraints, targets, grid points) that is non negative wherever the constraint
+        holds, and varies smoothly enough between grid points to interpolate where it crosses zero. Altitudes and
+        distances are compared through their sines and cosines, which avoids inverse trigonometry on the whole grid.
+    '''
+    longitude = np.radians(site_detail['longitude'])
+    latitude = np.radians(site_detail['latitude'])
+    local_sidereal_time = ephemeris.local_sidereal_time(ut_mjd)
+    sun, moon = ephemeris.sun_and_moon(ut_mjd)
+
+    dark = np.sin(np.radians(NAUTICAL_TWILIGHT)) - sin_altitudes(latitude, local_sidereal_time, sun)
+    horizon = np.sin(np.radians(effective_horizon(targets.max_airmass, site_detail['horizon'])))
+    up = sin_altitudes(latitude, local_sidereal_time, positions[:, np.newaxis, :]) - horizon[:, np.newaxis]
+
+    # rise_set measures the hour angle limits from the mean sidereal time and the catalog ra
+    mean_hour_angle = np.degrees(greenwich_mean_sidereal_time(ut_mjd) + longitude) / 15.0
+    hour_angle = np.mod(mean_hour_angle - targets.ra[:, np.newaxis] / 15.0 + 12.0, 24.0) - 12.0
+    after_ha_limit_neg = hour_angle - site_detail['ha_limit_neg']
+    before_ha_limit_pos = site_detail['ha_limit_pos'] - hour_angle
+
+    away_from_moon = np.cos(np.radians(targets.min_lunar_distance))[:, np.newaxis] - positions.dot(moon.T)
+    away_from_moon[targets.min_lunar_distance <= MIN_MOON_DISTANCE] = 1.0
+
+    return np.stack(np.broadcast_arrays(dark, up, after_ha_limit_neg, before_ha_limit_pos, away_from_moon))
+
+
+def observable_periods(margins, grid):
+    '''
+        Returns, for each target, the list of (start, end) periods in grid units where every margin is non negative.
+        Where the margins change between two grid points, the time is interpolated from the margins that changed.
+    '''
+    satisfied = margins >= 0
+    observable = satisfied.all(axis=0)
+    changes = np.diff(observable.astype(np.int8), axis=1)
+    step = grid[1] - grid[0]
+
+    def crossings(rows, columns):
+        before = margins[:, rows, columns]
+        after = margins[:, rows, columns + 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return before / (before - after)
+
+    rows, columns = np.nonzero(changes == 1)
+    # becomes observable once the last of the unsatisfied constraints is satisfied
+    fractions = np.where(~satisfied[:, rows, columns], crossings(rows, columns), -np.inf).max(axis=0)
+    starts = [[] for _ in range(len(observable))]
+    for row, time in zip(rows, grid[columns] + fractions * step):
+        starts[row].append(time)
+
+    rows, columns = np.nonzero(changes == -1)
+    # stops being observable as soon as the first constraint is broken
+    fractions = np.where(~satisfied[:, rows, columns + 1], crossings(rows, columns), np.inf).min(axis=0)
+    ends = [[] for _ in range(len(observable))]
+    for row, time in zip(rows, grid[columns] + fractions * step):
+        ends[row].append(time)
+
+    periods = []
+    for row in range(len(observable)):
+        if observable[row, 0]:
+            starts[row].insert(0, grid[0])
+        if observable[row, -1]:
+            ends[row].append(grid[-1])
+        periods.append(list(zip(starts[row], ends[row])))
+    return periods
+
+
+def clip_periods(periods, window, window_seconds, reference):
+    '''Clips periods in seconds from reference to a window, returning datetime intervals like rise_set does'''
+    intervals = []
+    start_seconds, end_seconds = window_seconds
+    for start, end in periods:
+        if end <= start_seconds or start >= end_seconds:
+            continue
+        start = window[0] if start <= start_seconds else reference + timedelta(seconds=float(start))
+        end = window[1] if end >= end_seconds else reference + timedelta(seconds=float(end))
+        if start < end:
+            intervals.append((start, end))
+    return intervals
+
+
+def window_blocks(window_seconds):
+    '''
+        Groups (start, end, row) windows sorted by start into blocks of up to BLOCK_SIZE that share a grid. A block
+        ends early at a gap between windows, so no block's grid spans time none of its windows need.
+    '''
+    block = []
+    block_end = None
+    for start, end, row in window_seconds:
+        if block and (len(block) == BLOCK_SIZE or start >= block_end):
+            yield block
+            block = []
+        block_end = max(block_end, end) if block else end
+        block.append((start, end, row))
+    if block:
+        yield block
+
+
+def get_observable_intervals(site_details, targets, windows, sites=None):
+    '''
+        Computes the observable intervals of N sidereal targets at M sites.
+
+        site_details: dict of site code to configdb site details, as from get_sites_with_instrument_type_and_location
+        targets: BatchTargets of N targets
+        windows: list of N lists of (start, end) datetimes
+        sites: optional list of N collections of site codes each target is restricted to
+
+        Returns a dict of site code to a dict of target index to a list of interval lists, one for each window.
+    '''
+    intervals = {site: {} for site in site_details}
+    rows = [(i, w) for i, target_windows in enumerate(windows) for w in range(len(target_windows))]
+    if not rows:
+        return intervals
+    reference = min(windows[i][w][0] for i, w in rows)
+    reference_mjd = gregorian_to_ut_mjd(reference)
+    window_seconds = sorted(
+        ((windows[i][w][0] - reference).total_seconds(), (windows[i][w][1] - reference).total_seconds(), row)
+        for row, (i, w) in enumerate(rows)
+    )
+    ephemerides = {site: get_site_ephemeris(site_detail) for site, site_detail in site_details.items()}
+    for site in site_details:
+        for i in range(len(windows)):
+            if sites is None or site in sites[i]:
+                intervals[site][i] = [[] for _ in windows[i]]
+
+    for block in window_blocks(window_seconds):
+        first = floor(block[0][0] / GRID_STEP)
+        last = ceil(max(end for _, end, _ in block) / GRID_STEP)
+        grid = np.arange(first, max(last, first + 1) + 1) * float(GRID_STEP)
+        ut_mjd = reference_mjd + grid / SECONDS_PER_DAY
+        middle_tt_mjd = ut_mjd_to_tdb(ut_mjd[len(ut_mjd) // 2])
+        block_targets = targets.take(np.array([rows[row][0] for _, _, row in block]))
+        positions = apparent_positions(block_targets, middle_tt_mjd)
+
+        for site, site_detail in site_details.items():
+            at_site = np.array([
+                b for b, (_, _, row) in enumerate(block) if sites is None or site in sites[rows[row][0]]
+            ], dtype=int)
+            if not len(at_site):
+                continue
+            margins = constraint_margins(site_detail, ephemerides[site], block_targets.take(at_site),
+                                         positions[at_site], ut_mjd)
+            for b, periods in zip(at_site, observable_periods(margins, grid)):
+                start, end, row = block[b]
+                i, w = rows[row]
+                intervals[site][i][w] = clip_periods(periods, windows[i][w], (start, end), reference)
+    return intervals
+
+
+def get_dark_intervals(site_detail, start, end):
+    '''
+        The intervals between start and end when the Sun is below nautical twilight at the site, as rise_set's
+        get_dark_intervals finds them, interpolated from the site's shared ephemeris. The grid is aligned to whole
+        steps since the MJD epoch, so overlapping queries sample the Sun at the same times and agree where they overlap.
+    '''
+    if end <= start:
+        return []
+    first = floor((start - MJD_EPOCH).total_seconds() / GRID_STEP)
+    reference = MJD_EPOCH + timedelta(seconds=first * GRID_STEP)
+    window_seconds = ((start - reference).total_seconds(), (end - reference).total_seconds())
+    steps = np.arange(first, first + ceil(window_seconds[1] / GRID_STEP) + 1)
+    grid = (steps - first) * float(GRID_STEP)
+    ut_mjd = steps * float(GRID_STEP) / SECONDS_PER_DAY
+    ephemeris = get_site_ephemeris(site_detail)
+    sun, _ = ephemeris.sun_and_moon(ut_mjd)
+    sin_sun_altitude = sin_altitudes(np.radians(site_detail['latitude']), ephemeris.local_sidereal_time(ut_mjd), sun)
+    dark = np.sin(np.radians(NAUTICAL_TWILIGHT)) - sin_sun_altitude
+    periods = observable_periods(dark[np.newaxis, np.newaxis, :], grid)[0]
+    return clip_periods(periods, (start, end), window_seconds, reference)
+
+
+def airmass(zenith_distance):
+    '''sla_airmas for an array of observed zenith distances in radians'''
+    seczm1 = 1.0 / np.cos(np.minimum(1.52, np.abs(zenith_distance))) - 1.0
+    return 1.0 + seczm1 * (0.9981833 - seczm1 * (0.002875 + 0.0008083 * seczm1))
+
+
+def get_airmasses(site_detail, targets, times):
+    '''
+        Computes the airmasses of N sidereal targets at a site at each of the times, refracted through the same
+        standard atmosphere as rise_set's calculate_airmass_at_times. Returns an array of shape (N, len(times)).
+    '''
+    first_ut_mjd = gregorian_to_ut_mjd(times[0])
+    ut_mjd = first_ut_mjd + np.array([(time - times[0]).total_seconds() for time in times]) / SECONDS_PER_DAY
+    latitude = np.radians(site_detail['latitude'])
+    positions = apparent_positions(targets, ut_mjd_to_tdb(ut_mjd[len(ut_mjd) // 2]))
+    local_sidereal_time = get_site_ephemeris(site_detail).local_sidereal_time(ut_mjd)
+    sin_altitude = sin_altitudes(latitude, local_sidereal_time, positions[:, np.newaxis, :])
+    zenith_distance = np.arccos(np.clip(sin_altitude, -1.0, 1.0))
+
+    temperature, pressure, humidity, wavelength, lapse_rate = STANDARD_ATMOSPHERE
+    refa, refb = sla.sla_refco(site_detail.get('altitude') or 0.0, temperature, pressure, humidity, wavelength,
+                               latitude, lapse_rate, 1e-10)
+    tan_zenith_distance = np.tan(np.minimum(zenith_distance, np.radians(87.0)))
+    return airmass(zenith_distance - tan_zenith_distance * (refa + refb * tan_zenith_distance ** 2))
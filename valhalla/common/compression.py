@@ -0,0 +1,101 @@
+'''
+    Compresses API responses with the best encoding the client accepts: zstd when the optional zstandard package is
+    installed, otherwise gzip. Responses that are already encoded, or too small to gain from it, are left as they are.
+'''
+from django.utils.cache import patch_vary_headers
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Below this many bytes the encoding costs more than it saves, as in django's GZipMiddleware
+MIN_LENGTH = 200
+
+
+def _gzip_compressor():
+    # wbits 31 writes the gzip header and trailer
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def _zstd_compressor():
+    return zstandard.ZstdCompressor().compressobj()
+
+
+def get_compressors():
+    '''The compressor factory of each available encoding, most preferred first'''
+    compressors = [('gzip', _gzip_compressor)]
+    if zstandard is not None:
+        compressors.insert(0, ('zstd', _zstd_compressor))
+    return compressors
+
+
+def get_accepted_encodings(request):
+    '''The encodings in the request's Accept-Encoding that the client did not refuse with q=0'''
+    encodings = set()
+    for encoding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = encoding.partition(';')
+        params = params.replace(' ', '')
+        try:
+            quality = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            quality = 1.0
+        if name.strip() and quality > 0:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+def get_compressor(request):
+    '''The (encoding, compressor factory) to use for the request, or None to not compress'''
+    accepted = get_accepted_encodings(request)
+    for encoding, compressor in get_compressors():
+        if encoding in accepted or '*' in accepted:
+            return encoding, compressor
+    return None
+
+
+def compress_sequence(sequence, compressor):
+    compressobj = compressor()
+    for item in sequence:
+        data = compressobj.compress(item)
+        if data:
+            yield data
+    yield compressobj.flush()
+
+
+def compress_response(request, response):
+    '''Compresses the response in place with the best encoding the request accepts, and returns it'''
+    if response.has_header('Content-Encoding') or response.status_code == 304:
+        return response
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if not response.streaming and len(response.content) < MIN_LENGTH:
+        return response
+    encoding_and_compressor = get_compressor(request)
+    if encoding_and_compressor is None:
+        return response
+    encoding, compressor = encoding_and_compressor
+
+    if response.streaming:
+        response.streaming_content = compress_sequence(response.streaming_content, compressor)
+        del response['Content-Length']
+    else:
+        compressobj = compressor()
+        response.content = compressobj.compress(response.content) + compressobj.flush()
+        response['Content-Length'] = str(len(response.content))
+    # The encoded bytes differ from those the ETag was made for, so it can only match weakly
+    if response.has_header('ETag') and response['ETag'].startswith('"'):
+        response['ETag'] = 'W/' + response['ETag']
+    response['Content-Encoding'] = encoding
+    return response
+
+
+class CompressedResponseMixin(object):
+    '''Compresses the responses of an APIView with the best encoding its client accepts'''
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if hasattr(response, 'add_post_render_callback'):
+            # Rest framework responses are rendered after the view returns them
+            response.add_post_render_callback(lambda rendered: compress_response(request, rendered))
+            return response
+        return compress_response(request, response)
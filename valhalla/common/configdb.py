@@ -2,8 +2,16 @@ import requests
 from django.core.cache import cache
 from django.utils.translation import ugettext as _
 from django.conf import settings
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, Counter
+from urllib.parse import urlsplit, unquote
+import threading
 import logging
+import json
+import time
+import sys
+import os
+
+from valhalla.common.http_client import configdb_client
 
 logger = logging.getLogger(__name__)
 
@@ -11,10 +19,47 @@ CONFIGDB_ERROR_MSG = _(("ConfigDB connection is currently down, please wait a fe
                        " If this problem persists then please contact support."))
 
 
+SPECTROGRAPH_INSTRUMENT_TYPES = frozenset(['2M0-FLOYDS-SCICAM', '0M8-NRES-SCICAM', '1M0-NRES-SCICAM'])
+
+# Seconds the configdb resources are kept in the shared django cache
+CONFIGDB_CACHE_TIMEOUT = 900
+
+# The file each configdb resource is read from in a snapshot directory, the layout of common/test_data
+SNAPSHOT_FILES = OrderedDict((('sites', 'configdb.json'), ('filterwheels', 'filterwheels.json')))
+
+
 class ConfigDBException(Exception):
     pass
 
 
+def get_snapshot_file(url, resource):
+    '''
+        Returns the path of the file a resource is read from when url is a file:// url or a local path, either of a
+        snapshot directory or of the sites file in one. Returns None when url is a configdb server.
+    '''
+    parts = urlsplit(url)
+    if parts.scheme == 'file':
+        path = unquote(parts.path)
+    elif not parts.scheme and url:
+        path = url
+    else:
+        return None
+    if os.path.isdir(path):
+        return os.path.join(path, SNAPSHOT_FILES[resource])
+    if resource == 'sites':
+        return path
+    return os.path.join(os.path.dirname(path), SNAPSHOT_FILES[resource])
+
+
+def read_snapshot_file(path):
+    '''Returns the results in a snapshot file, which has the same format as the configdb api responses'''
+    try:
+        with open(path, encoding='utf-8') as snapshot_file:
+            return json.load(snapshot_file)['results']
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise ConfigDBException('Could not read configdb snapshot {}: {}'.format(path, e))
+
+
 class TelescopeKey(namedtuple('TelescopeKey', ['site', 'observatory', 'telescope'])):
     __slots__ = ()
 
@@ -22,112 +67,450 @@ class TelescopeKey(namedtuple('TelescopeKey', ['site', 'observatory', 'telescope
         return ".".join(s for s in [self.site, self.observatory, self.telescope] if s)
 
 
+class CameraType(namedtuple('CameraType', ['code', 'name', 'default_binning', 'modes', 'fixed_overhead_per_exposure',
+                                           'config_change_time', 'acquire_processing_time', 'acquire_exposure_time',
+                                           'front_padding', 'filter_change_time'])):
+    '''A configdb camera type, with its modes as a tuple of (binning, readout) pairs'''
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, camera_type):
+        return cls(
+            code=sys.intern(camera_type['code'].upper()),
+            name=sys.intern(camera_type['name']),
+            default_binning=camera_type['default_mode']['binning'],
+            modes=tuple((mode['binning'], mode['readout']) for mode in camera_type['mode_set']),
+            fixed_overhead_per_exposure=camera_type['fixed_overhead_per_exposure'],
+            config_change_time=camera_type['config_change_time'],
+            acquire_processing_time=camera_type['acquire_processing_time'],
+            acquire_exposure_time=camera_type['acquire_exposure_time'],
+            front_padding=camera_type['front_padding'],
+            filter_change_time=camera_type['filter_change_time']
+        )
+
+    @property
+    def binnings(self):
+        return {binning for binning, _ in self.modes}
+
+
+class Instrument(namedtuple('Instrument', ['code', 'state', 'camera_type', 'filters', 'telescope_key'])):
+    '''A configdb instrument, with its science camera's lower case filters as a frozenset'''
+    __slots__ = ()
+
+    @property
+    def instrument_type(self):
+        return self.camera_type.code
+
+    @property
+    def schedulable(self):
+        return self.state == 'SCHEDULABLE'
+
+
+class Telescope(namedtuple('Telescope', ['key', 'latitude', 'longitude', 'horizon', 'ha_limit_pos', 'ha_limit_neg',
+                                         'instruments'])):
+    __slots__ = ()
+
+    @property
+    def code(self):
+        return self.key.telescope
+
+    @property
+    def observatory(self):
+        return self.key.observatory
+
+
+class Site(namedtuple('Site', ['code', 'elevation', 'telescopes'])):
+    __slots__ = ()
+
+
+class RequestOverheads(namedtuple('RequestOverheads', ['config_change_time', 'acquire_processing_time',
+                                                       'acquire_exposure_time', 'front_padding', 'filter_change_time',
+                                                       'is_spectrograph'])):
+    '''The per request overheads of an instrument type'''
+    __slots__ = ()
+
+    @classmethod
+    def from_camera_type(cls, camera_type):
+        return cls(
+            config_change_time=camera_type.config_change_time,
+            acquire_processing_time=camera_type.acquire_processing_time,
+            acquire_exposure_time=camera_type.acquire_exposure_time,
+            front_padding=camera_type.front_padding,
+            filter_change_time=camera_type.filter_change_time,
+            is_spectrograph=camera_type.code in SPECTROGRAPH_INSTRUMENT_TYPES
+        )
+
+
+class OverheadTables(namedtuple('OverheadTables', ['exposure', 'request'])):
+    '''
+        The overheads of one snapshot that request durations are computed from: readout plus fixed overhead per
+        exposure keyed by (instrument type, binning), and RequestOverheads keyed by instrument type. Instrument types
+        are upper case.
+    '''
+    __slots__ = ()
+
+    def exposure_overhead(self, instrument_type, binning):
+        try:
+            return self.exposure[(instrument_type.upper(), binning)]
+        except KeyError:
+            raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+
+    def request_overheads(self, instrument_type):
+        try:
+            return self.request[instrument_type.upper()]
+        except KeyError:
+            raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+
+
+class ConfigDBSnapshot(object):
+    '''
+        An immutable view of one configdb fetch. The site tree is walked exactly once, when the snapshot is built, to
+        fill hash indexes keyed by instrument type, (instrument type, binning), telescope key and site. All of the
+        ConfigDB accessors are lookups against these indexes, so the returned containers must be treated as read-only.
+
+        The tree is held as Site, Telescope, Instrument and CameraType records with interned codes. The raw json is
+        only kept down to the telescopes, without their instruments, for get_site_data.
+    '''
+
+    def __init__(self, site_data, filterwheel_data=()):
+        self.site_data = []
+        self.created = time.monotonic()
+        self.filter_map = {}
+        # site code -> Site
+        self.site_records = OrderedDict()
+        self.instruments = []
+        self.schedulable_instruments = []
+        # instrument type (upper case) -> camera type of the first instrument of that type
+        self.camera_types = {}
+        # instrument type (upper case) -> set of lower case filters across all instruments of that type
+        self.filters = {}
+        # (instrument type, binning) -> readout + fixed overhead per exposure
+        self.exposure_overheads = {}
+        # instrument type -> RequestOverheads
+        self.request_overheads = {}
+        self.overheads = OverheadTables(self.exposure_overheads, self.request_overheads)
+        # instrument type -> set of TelescopeKeys, for all and for only schedulable instruments
+        self.telescopes = {}
+        self.schedulable_telescopes = {}
+        # TelescopeKey -> list of instrument types, for all and for only schedulable instruments
+        self.instrument_types = {}
+        self.schedulable_instrument_types = {}
+        # site code -> list of (observatory code, telescope code, instrument type, site details) for schedulable ones
+        self.sites = OrderedDict()
+        # lazily filled memos for the queries that take free form arguments
+        self._site_details = {}
+        self._active_instrument_types = {}
+        # CameraType -> the same CameraType, so instruments with identical camera types share one record
+        self._camera_type_records = {}
+
+        for site in site_data:
+            site_code = sys.intern(site['code'])
+            self.sites[site_code] = []
+            telescopes = []
+            enclosures = []
+            for enclosure in site['enclosure_set']:
+                enclosures.append(dict(
+                    {key: value for key, value in enclosure.items() if key != 'telescope_set'},
+                    telescope_set=[{key: value for key, value in telescope.items() if key != 'instrument_set'}
+                                   for telescope in enclosure['telescope_set']]
+                ))
+                for telescope in enclosure['telescope_set']:
+                    telescope_key = TelescopeKey(
+                        site=site_code,
+                        observatory=sys.intern(enclosure['code']),
+                        telescope=sys.intern(telescope['code'])
+                    )
+                    site_details = {
+                        'latitude': telescope['lat'],
+                        'longitude': telescope['long'],
+                        'horizon': telescope['horizon'],
+                        'altitude': site['elevation'],
+                        'ha_limit_pos': telescope['ha_limit_pos'],
+                        'ha_limit_neg': telescope['ha_limit_neg']
+                    }
+                    instruments = tuple(
+                        self._add_instrument(instrument, telescope_key) for instrument in telescope['instrument_set']
+                    )
+                    for instrument in instruments:
+                        if instrument.schedulable:
+                            self.sites[site_code].append((
+                                telescope_key.observatory, telescope_key.telescope, instrument.instrument_type,
+                                site_details
+                            ))
+                    telescopes.append(Telescope(
+                        key=telescope_key,
+                        latitude=telescope['lat'],
+                        longitude=telescope['long'],
+                        horizon=telescope['horizon'],
+                        ha_limit_pos=telescope['ha_limit_pos'],
+                        ha_limit_neg=telescope['ha_limit_neg'],
+                        instruments=instruments
+                    ))
+            self.site_records[site_code] = Site(code=site_code, elevation=site['elevation'],
+                                                telescopes=tuple(telescopes))
+            self.site_data.append(dict(
+                {key: value for key, value in site.items() if key != 'enclosure_set'}, enclosure_set=enclosures
+            ))
+        del self._camera_type_records
+
+        for fw in filterwheel_data:
+            for f in fw['filters']:
+                self.filter_map[f['code'].lower()] = {
+                    'type': f.get('filter_type', 'Engineering'),
+                    'name': f.get('name', f['code'])
+                }
+
+    @property
+    def age(self):
+        return time.monotonic() - self.created
+
+    def _add_instrument(self, instrument_data, telescope_key):
+        camera_type = CameraType.from_dict(instrument_data['science_camera']['camera_type'])
+        camera_type = self._camera_type_records.setdefault(camera_type, camera_type)
+        camera_filters = instrument_data['science_camera']['filters'].split(',')
+        instrument = Instrument(
+            code=sys.intern(instrument_data['code']),
+            state=sys.intern(instrument_data['state']),
+            camera_type=camera_type,
+            filters=frozenset(sys.intern(camera_filter.lower()) for camera_filter in camera_filters),
+            telescope_key=telescope_key
+        )
+        instrument_type = camera_type.code
+        schedulable = instrument.schedulable
+
+        self.instruments.append(instrument)
+        if schedulable:
+            self.schedulable_instruments.append(instrument)
+
+        self.camera_types.setdefault(instrument_type, camera_type)
+        if instrument_type not in self.request_overheads:
+            self.request_overheads[instrument_type] = RequestOverheads.from_camera_type(camera_type)
+        self.filters.setdefault(instrument_type, set()).update(instrument.filters)
+        for binning, readout in camera_type.modes:
+            self.exposure_overheads.setdefault(
+                (instrument_type, binning), readout + camera_type.fixed_overhead_per_exposure
+            )
+
+        indexes = [(self.telescopes, self.instrument_types)]
+        if schedulable:
+            indexes.append((self.schedulable_telescopes, self.schedulable_instrument_types))
+        for telescopes, instrument_types in indexes:
+            telescopes.setdefault(instrument_type, set()).add(telescope_key)
+            types = instrument_types.setdefault(telescope_key, [])
+            if instrument_type not in types:
+                types.append(instrument_type)
+        return instrument
+
+    def get_site_details(self, instrument_type, site_code, observatory_code, telescope_code):
+        key = (instrument_type.upper() if instrument_type else '', site_code or '', observatory_code or '',
+               telescope_code or '')
+        if key not in self._site_details:
+            instrument_type, site_code, observatory_code, telescope_code = key
+            sites = [site_code] if site_code else self.sites.keys()
+            site_details = {}
+            for site in sites:
+                for observatory, telescope, camera_type, details in self.sites.get(site, []):
+                    if ((not observatory_code or observatory_code == observatory)
+                            and (not telescope_code or telescope_code == telescope)
+                            and (not instrument_type or instrument_type == camera_type)):
+                        site_details[site] = details
+                        break
+            self._site_details[key] = site_details
+        return self._site_details[key]
+
+    def get_active_instrument_types(self, site, observatory, telescope):
+        key = (site, observatory, telescope)
+        if key not in self._active_instrument_types:
+            instrument_types = set()
+            for telescope_key, types in self.schedulable_instrument_types.items():
+                if (site in telescope_key.site.lower()
+                        and observatory in telescope_key.observatory.lower()
+                        and telescope in telescope_key.telescope.lower()):
+                    instrument_types.update(types)
+            self._active_instrument_types[key] = instrument_types
+        return self._active_instrument_types[key]
+
+
 class ConfigDB(object):
+    '''
+        Serves configdb lookups from an in process snapshot. Once a snapshot is older than CONFIGDB_SOFT_TTL it is
+        still served while a background thread fetches a new one. Only a missing snapshot, or one older than
+        CONFIGDB_HARD_TTL, makes the caller wait on a fetch. An expired snapshot is still served if that fetch fails.
+    '''
 
     def __init__(self):
-        self.site_data = None
-
-    def _get_configdb_data(self, resource):
-        ''' Gets all the data from configdb (the sites structure with everything in it)
+        self.snapshot = None
+        self.stats = Counter()
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread = None
+
+    @property
+    def site_data(self):
+        return self.get_snapshot().site_data
+
+    def _get_configdb_data(self, resource, use_cache=True):
+        ''' Gets all the data from configdb (the sites structure with everything in it). When CONFIGDB_URL is a local
+            snapshot it is read from there, and when configdb cannot be reached it is read from the snapshot in
+            CONFIGDB_FALLBACK_DIR, if one is set.
         :return: list of dictionaries of site data
         '''
+        snapshot_file = get_snapshot_file(settings.CONFIGDB_URL, resource)
+        if snapshot_file:
+            return read_snapshot_file(snapshot_file)
 
-        data = cache.get(resource)
+        data = cache.get(resource) if use_cache else None
         if not data:
             try:
-                r = requests.get(settings.CONFIGDB_URL + '/{}/'.format(resource))
-                r.raise_for_status()
-            except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
-                msg = "{}: {}".format(e.__class__.__name__, CONFIGDB_ERROR_MSG)
-                raise ConfigDBException(msg)
-            try:
-                data = r.json()['results']
-            except KeyError:
-                raise ConfigDBException(CONFIGDB_ERROR_MSG)
-            # cache the results for 15 minutes
-            cache.set(resource, data, 900)
+                data = self._fetch_configdb_data(resource)
+            except ConfigDBException as e:
+                if not settings.CONFIGDB_FALLBACK_DIR:
+                    raise
+                logger.warning('Reading {} from the configdb snapshot in {}: {}'.format(
+                    resource, settings.CONFIGDB_FALLBACK_DIR, e
+                ))
+                return read_snapshot_file(get_snapshot_file(settings.CONFIGDB_FALLBACK_DIR, resource))
+            cache.set(resource, data, CONFIGDB_CACHE_TIMEOUT)
 
         return data
 
+    def _fetch_configdb_data(self, resource):
+        try:
+            r = configdb_client.get(settings.CONFIGDB_URL + '/{}/'.format(resource))
+            r.raise_for_status()
+        except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
+            msg = "{}: {}".format(e.__class__.__name__, CONFIGDB_ERROR_MSG)
+            raise ConfigDBException(msg)
+        try:
+            return r.json()['results']
+        except KeyError:
+            raise ConfigDBException(CONFIGDB_ERROR_MSG)
+
+    def warm_cache(self):
+        '''
+            Fetches the sites and filterwheels from configdb into the shared django cache, which every process reads
+            when it refreshes its snapshot, so configdb is fetched once for all of them. Returns the resources fetched,
+            none when CONFIGDB_URL is a local snapshot.
+        '''
+        resources = [resource for resource in SNAPSHOT_FILES if not get_snapshot_file(settings.CONFIGDB_URL, resource)]
+        for resource in resources:
+            cache.set(resource, self._fetch_configdb_data(resource), CONFIGDB_CACHE_TIMEOUT)
+        return resources
+
+    def dump(self, directory):
+        '''
+            Writes the live configdb into a snapshot directory that CONFIGDB_URL or CONFIGDB_FALLBACK_DIR can point at.
+            Each file is written beside its destination and then moved into place, so readers never see a partial one.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for resource, filename in SNAPSHOT_FILES.items():
+            data = self._get_configdb_data(resource, use_cache=False)
+            path = os.path.join(directory, filename)
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'results': data}, f)
+            os.replace(path + '.tmp', path)
+            paths.append(path)
+        return paths
+
+    def refresh(self, use_cache=True):
+        '''
+            Fetches the sites and filterwheels and swaps in a new snapshot built from them. The snapshot is fully built
+            before it replaces the old one, so readers always see a consistent view.
+        '''
+        self.stats['refresh'] += 1
+        snapshot = ConfigDBSnapshot(
+            self._get_configdb_data('sites', use_cache=use_cache),
+            self._get_configdb_data('filterwheels', use_cache=use_cache)
+        )
+        if snapshot.site_data:
+            self.snapshot = snapshot
+        events = ', '.join('{} {}'.format(count, event) for event, count in sorted(self.stats.items()))
+        logger.info('Refreshed the configdb snapshot of {} sites, snapshot events so far: {}'.format(
+            len(snapshot.site_data), events
+        ))
+        return snapshot
+
+    def _refresh_in_background(self):
+        if not self._refresh_lock.acquire(blocking=False):
+            # A refresh is already running
+            return
+
+        def run():
+            try:
+                # The shared cache is kept warm by the warm_configdb_cache task
+                self.refresh()
+            except ConfigDBException as e:
+                logger.warning('Failed to refresh configdb snapshot: {}'.format(e))
+            finally:
+                self._refresh_lock.release()
+
+        self._refresh_thread = threading.Thread(target=run, name='configdb-refresh', daemon=True)
+        self._refresh_thread.start()
+
+    def get_snapshot(self):
+        '''
+            Returns the current snapshot of the configdb, fetching and indexing the site data if there is none yet.
+        '''
+        snapshot = self.snapshot
+        if not snapshot or not snapshot.site_data:
+            self.stats['miss'] += 1
+            return self.refresh()
+
+        age = snapshot.age
+        if age > settings.CONFIGDB_HARD_TTL:
+            try:
+                return self.refresh(use_cache=False)
+            except ConfigDBException as e:
+                logger.warning('Serving expired configdb snapshot, refresh failed: {}'.format(e))
+                self.stats['stale'] += 1
+        elif age > settings.CONFIGDB_SOFT_TTL:
+            self.stats['stale'] += 1
+            self._refresh_in_background()
+        else:
+            self.stats['hit'] += 1
+        return snapshot
+
     def get_site_data(self):
-        if not self.site_data:
-            self.site_data = self._get_configdb_data('sites')
-        return self.site_data
+        '''
+            Returns the configdb sites json down to the telescopes, without their instruments. Use get_sites for the
+            full tree.
+        '''
+        return self.get_snapshot().site_data
+
+    def get_sites(self):
+        '''
+        :return: OrderedDict of site code to Site records, with their Telescopes and those telescopes' Instruments
+        '''
+        return self.get_snapshot().site_records
 
     def get_sites_with_instrument_type_and_location(self, instrument_type='', site_code='',
                                                     observatory_code='', telescope_code=''):
-        if not self.site_data:
-            self.site_data = self._get_configdb_data('sites')
-        site_data = self.site_data
-        site_details = {}
-        for site in site_data:
-            if not site_code or site_code == site['code']:
-                for enclosure in site['enclosure_set']:
-                    if not observatory_code or observatory_code == enclosure['code']:
-                        for telescope in enclosure['telescope_set']:
-                            if not telescope_code or telescope_code == telescope['code']:
-                                for instrument in telescope['instrument_set']:
-                                    if instrument['state'] == 'SCHEDULABLE':
-                                        camera_type = instrument['science_camera']['camera_type']['code']
-                                        if not instrument_type or instrument_type.upper() == camera_type.upper():
-                                            if site['code'] not in site_details:
-                                                site_details[site['code']] = {
-                                                    'latitude': telescope['lat'],
-                                                    'longitude': telescope['long'],
-                                                    'horizon': telescope['horizon'],
-                                                    'altitude': site['elevation'],
-                                                    'ha_limit_pos': telescope['ha_limit_pos'],
-                                                    'ha_limit_neg': telescope['ha_limit_neg']
-                                                }
-
-        return site_details
+        return dict(self.get_snapshot().get_site_details(instrument_type, site_code, observatory_code, telescope_code))
 
     def get_instruments(self, only_schedulable=False):
-        if not self.site_data:
-            self.site_data = self._get_configdb_data('sites')
-        instruments = []
-        for site in self.site_data:
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    for instrument in telescope['instrument_set']:
-                        if only_schedulable and instrument['state'] != 'SCHEDULABLE':
-                            pass
-                        else:
-                            telescope_key = TelescopeKey(
-                                site=site['code'],
-                                observatory=enclosure['code'],
-                                telescope=telescope['code']
-                            )
-                            instrument['telescope_key'] = telescope_key
-                            instruments.append(instrument)
-
-        return instruments
+        snapshot = self.get_snapshot()
+        if only_schedulable:
+            return snapshot.schedulable_instruments
+        return snapshot.instruments
 
     def get_instrument_types_per_telescope(self, only_schedulable=False):
         '''
             Function uses the configdb to get a set of available instrument types per telescope
         :return: set of available instrument types per TelescopeKey
         '''
-        telescope_instrument_types = {}
-        for instrument in self.get_instruments(only_schedulable=only_schedulable):
-            if instrument['telescope_key'] not in telescope_instrument_types:
-                telescope_instrument_types[instrument['telescope_key']] = []
-            instrument_type = instrument['science_camera']['camera_type']['code'].upper()
-            if instrument_type not in telescope_instrument_types[instrument['telescope_key']]:
-                telescope_instrument_types[instrument['telescope_key']].append(instrument_type)
-
-        return telescope_instrument_types
+        snapshot = self.get_snapshot()
+        if only_schedulable:
+            return snapshot.schedulable_instrument_types
+        return snapshot.instrument_types
 
     def get_telescopes_per_instrument_type(self, instrument_type, only_schedulable=False):
         '''
         Function returns a set of telescope keys that have an instrument of instrument_type
         associated with them
         '''
-        instrument_telescopes = set()
-        for instrument in self.get_instruments(only_schedulable=only_schedulable):
-            if instrument['science_camera']['camera_type']['code'].upper() == instrument_type:
-                instrument_telescopes.add(instrument['telescope_key'])
-        return instrument_telescopes
+        snapshot = self.get_snapshot()
+        telescopes = snapshot.schedulable_telescopes if only_schedulable else snapshot.telescopes
+        return set(telescopes.get(instrument_type, set()))
 
     def get_filters(self, instrument_type):
         '''
@@ -135,23 +518,10 @@ class ConfigDB(object):
         :param instrument_type:
         :return: returns the available set of filters for an instrument_type
         '''
-        available_filters = set()
-        for instrument in self.get_instruments():
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                for camera_filter in instrument['science_camera']['filters'].split(','):
-                    available_filters.add(camera_filter.lower())
-
-        return available_filters
+        return set(self.get_snapshot().filters.get(instrument_type.upper(), set()))
 
     def get_filter_map(self):
-        filter_map = {}
-        for fw in self._get_configdb_data('filterwheels'):
-            for f in fw['filters']:
-                filter_map[f['code'].lower()] = {
-                    'type': f.get('filter_type', 'Engineering'),
-                    'name': f.get('name', f['code'])
-                }
-        return filter_map
+        return self.get_snapshot().filter_map
 
     def get_binnings(self, instrument_type):
         '''
@@ -159,14 +529,10 @@ class ConfigDB(object):
         :param instrument_type:
         :return: returns the available set of binnings for an instrument_type
         '''
-        available_binnings = set()
-        for instrument in self.get_instruments():
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                for mode in instrument['science_camera']['camera_type']['mode_set']:
-                    available_binnings.add(mode['binning'])
-                # Once the instrument type is found, we  have the binnings and are done
-                break
-        return available_binnings
+        camera_type = self.get_snapshot().camera_types.get(instrument_type.upper())
+        if not camera_type:
+            return set()
+        return camera_type.binnings
 
     def get_default_binning(self, instrument_type):
         '''
@@ -174,16 +540,16 @@ class ConfigDB(object):
         :param instrument_type:
         :return: binning default
         '''
-        for instrument in self.get_instruments():
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                return instrument['science_camera']['camera_type']['default_mode']['binning']
-        return None
+        camera_type = self.get_snapshot().camera_types.get(instrument_type.upper())
+        if not camera_type:
+            return None
+        return camera_type.default_binning
 
     def get_instrument_name(self, instrument_type):
-        for instrument in self.get_instruments():
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                return instrument['science_camera']['camera_type']['name']
-        return instrument_type
+        camera_type = self.get_snapshot().camera_types.get(instrument_type.upper())
+        if not camera_type:
+            return instrument_type
+        return camera_type.name
 
     def get_active_instrument_types(self, location):
         '''
@@ -191,42 +557,28 @@ class ConfigDB(object):
             Location should be a dictionary of the location, with site, observatory, and telescope fields
         :return: Set of available instrument_types (i.e. 1M0-SCICAM-SBIG, etc.)
         '''
-        instrument_types = set()
-        for instrument in self.get_instruments(only_schedulable=True):
-            split_string = instrument['__str__'].lower().split('.')
-            if (location.get('site', '').lower() in split_string[0]
-                    and location.get('observatory', '').lower() in split_string[1]
-                    and location.get('telescope', '').lower() in split_string[2]):
-                instrument_types.add(instrument['science_camera']['camera_type']['code'].upper())
-        return instrument_types
+        return set(self.get_snapshot().get_active_instrument_types(
+            location.get('site', '').lower(), location.get('observatory', '').lower(),
+            location.get('telescope', '').lower()
+        ))
 
-    def get_exposure_overhead(self, instrument_type, binning):
-        # using the instrument type, build an instrument with the correct configdb parameters
-        for instrument in self.get_instruments():
-            camera_type = instrument['science_camera']['camera_type']
-            if camera_type['code'].upper() == instrument_type.upper():
-                # get the binnings and put them into a dictionary
-                for mode in camera_type['mode_set']:
-                    if mode['binning'] == binning:
-                        return mode['readout'] + camera_type['fixed_overhead_per_exposure']
+    def get_overheads(self):
+        '''
+        :return: the OverheadTables of the current snapshot, to compute many durations from without further lookups
+        '''
+        return self.get_snapshot().overheads
 
-        raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+    def get_exposure_overhead(self, instrument_type, binning):
+        return self.get_overheads().exposure_overhead(instrument_type, binning)
 
     def get_request_overheads(self, instrument_type):
-        for instrument in self.get_instruments():
-            camera_type = instrument['science_camera']['camera_type']
-            if camera_type['code'].upper() == instrument_type.upper():
-                return {'config_change_time': camera_type['config_change_time'],
-                        'acquire_processing_time': camera_type['acquire_processing_time'],
-                        'acquire_exposure_time': camera_type['acquire_exposure_time'],
-                        'front_padding': camera_type['front_padding'],
-                        'filter_change_time': camera_type['filter_change_time']}
-
-        raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+        request_overheads = self.get_overheads().request_overheads(instrument_type)._asdict()
+        del request_overheads['is_spectrograph']
+        return dict(request_overheads)
 
     @staticmethod
     def is_spectrograph(instrument_type):
-        return instrument_type.upper() in ['2M0-FLOYDS-SCICAM', '0M8-NRES-SCICAM', '1M0-NRES-SCICAM']
+        return instrument_type.upper() in SPECTROGRAPH_INSTRUMENT_TYPES
 
 
 configdb = ConfigDB()
@@ -0,0 +1,131 @@
+'''
+    Sun and Moon positions and sidereal time for a site on a shared grid. slalib is evaluated at whole multiples of
+    EPHEMERIS_STEP seconds and everything in between is interpolated. Each process keeps one grid per site that covers
+    the coming EPHEMERIS_DAYS days, so the Sun and Moon are computed once per site instead of once per request.
+'''
+from datetime import timedelta
+from math import floor, ceil
+from django.conf import settings
+from django.utils import timezone
+from pyslalib import slalib as sla
+from rise_set.astrometry import gregorian_to_ut_mjd, ut_mjd_to_tdb
+import numpy as np
+import threading
+
+SECONDS_PER_DAY = 86400.0
+SUN = 0
+MOON = 3
+
+_ephemerides = {}
+_ephemerides_lock = threading.Lock()
+
+
+def greenwich_mean_sidereal_time(ut_mjd):
+    '''sla_gmst for an array of UT MJDs, in radians'''
+    tu = (ut_mjd - 51544.5) / 36525.0
+    seconds = 24110.54841 + (8640184.812866 + (0.093104 - 6.2e-6 * tu) * tu) * tu
+    return np.mod(np.mod(ut_mjd, 1.0) * 2 * np.pi + seconds * (2 * np.pi / SECONDS_PER_DAY), 2 * np.pi)
+
+
+def unit_vectors(ra, dec):
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def sin_altitudes(latitude, local_sidereal_time, positions):
+    '''
+        Sines of the altitudes of apparent unit vectors of shape (..., 3) at local sidereal times broadcast against
+        them. cos(dec)cos(hour angle) expands into the vector components times the cosine and sine of sidereal time.
+    '''
+    return np.sin(latitude) * positions[..., 2] + np.cos(latitude) * (
+        positions[..., 0] * np.cos(local_sidereal_time) + positions[..., 1] * np.sin(local_sidereal_time)
+    )
+
+
+class SiteEphemeris(object):
+    '''
+        Topocentric apparent Sun and Moon positions and the equation of the equinoxes for one site, computed with
+        slalib at whole multiples of step seconds and interpolated onto any UT MJDs. Nodes outside the precomputed
+        range are computed as they are needed.
+    '''
+
+    def __init__(self, site_detail, step):
+        self.longitude = np.radians(site_detail['longitude'])
+        self.latitude = np.radians(site_detail['latitude'])
+        self.step = step
+        self.nodes = {}
+        self.computed_on = None
+
+    def _node(self, index):
+        node = self.nodes.get(index)
+        if node is None:
+            tt_mjd = ut_mjd_to_tdb(index * self.step / SECONDS_PER_DAY)
+            sun_ra, sun_dec, _ = sla.sla_rdplan(tt_mjd, SUN, self.longitude, self.latitude)
+            moon_ra, moon_dec, _ = sla.sla_rdplan(tt_mjd, MOON, self.longitude, self.latitude)
+            node = (sun_ra, moon_ra, sun_dec, moon_dec, sla.sla_eqeqx(tt_mjd))
+            self.nodes[index] = node
+        return node
+
+    def precompute(self, start, end):
+        '''Computes the nodes covering start to end, and drops any others'''
+        first = int(floor(gregorian_to_ut_mjd(start) * SECONDS_PER_DAY / self.step))
+        last = int(ceil(gregorian_to_ut_mjd(end) * SECONDS_PER_DAY / self.step))
+        self.nodes = {index: self._node(index) for index in range(first, last + 1)}
+
+    def _interpolation(self, ut_mjd):
+        position = ut_mjd * (SECONDS_PER_DAY / self.step)
+        first = int(floor(position.min()))
+        nodes = np.array([self._node(index) for index in range(first, int(floor(position.max())) + 2)])
+        offset = position - first
+        index = np.minimum(offset.astype(int), len(nodes) - 2)
+        return nodes, index, offset - index
+
+    def sun_and_moon(self, ut_mjd):
+        '''Sun and Moon unit vectors at each of the UT MJDs, each an array of shape (len(ut_mjd), 3)'''
+        nodes, index, weight = self._interpolation(ut_mjd)
+        nodes = unit_vectors(nodes[:, :2], nodes[:, 2:4])
+        weight = weight[:, np.newaxis, np.newaxis]
+        vectors = nodes[index] * (1 - weight) + nodes[index + 1] * weight
+        vectors /= np.linalg.norm(vectors, axis=2)[:, :, np.newaxis]
+        return vectors[:, 0], vectors[:, 1]
+
+    def local_sidereal_time(self, ut_mjd):
+        '''Local apparent sidereal time at each of the UT MJDs, in radians'''
+        nodes, index, weight = self._interpolation(ut_mjd)
+        equation_of_the_equinoxes = nodes[index, 4] * (1 - weight) + nodes[index + 1, 4] * weight
+        return greenwich_mean_sidereal_time(ut_mjd) + equation_of_the_equinoxes + self.longitude
+
+    def sun_altitude(self, ut_mjd):
+        '''Altitude of the Sun in degrees at each of the UT MJDs'''
+        sun, _ = self.sun_and_moon(ut_mjd)
+        sin_altitude = sin_altitudes(self.latitude, self.local_sidereal_time(ut_mjd), sun)
+        return np.degrees(np.arcsin(np.clip(sin_altitude, -1.0, 1.0)))
+
+    def moon_phase(self, ut_mjd):
+        '''Illuminated fraction of the Moon at each of the UT MJDs, from its elongation from the Sun'''
+        sun, moon = self.sun_and_moon(ut_mjd)
+        return (1.0 - np.einsum('ij,ij->i', sun, moon)) / 2.0
+
+
+def get_site_ephemeris(site_detail):
+    '''
+        Returns this process's ephemeris for the site. Once a day its grid is moved forward to cover from a day ago to
+        EPHEMERIS_DAYS days from now, dropping whatever else was computed since.
+    '''
+    key = (site_detail['latitude'], site_detail['longitude'], settings.EPHEMERIS_STEP)
+    now = timezone.now()
+    ephemeris = _ephemerides.get(key)
+    if ephemeris is None or ephemeris.computed_on != now.date():
+        with _ephemerides_lock:
+            ephemeris = _ephemerides.get(key)
+            if ephemeris is None or ephemeris.computed_on != now.date():
+                ephemeris = ephemeris or SiteEphemeris(site_detail, settings.EPHEMERIS_STEP)
+                ephemeris.precompute(now - timedelta(days=1), now + timedelta(days=settings.EPHEMERIS_DAYS))
+                ephemeris.computed_on = now.date()
+                _ephemerides[key] = ephemeris
+    return ephemeris
+
+
+def clear_site_ephemerides():
+    with _ephemerides_lock:
+        _ephemerides.clear()
@@ -0,0 +1,131 @@
+from django.conf import settings
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+import requests
+import threading
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upstream responses that are worth trying again after a short wait
+RETRY_STATUS_CODES = (502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class ServiceUnavailable(requests.exceptions.ConnectionError):
+    '''Raised without contacting the service while its circuit breaker is open'''
+    pass
+
+
+def get_session(url):
+    '''Returns the shared session for the host of the url, so connections to each host are pooled and reused'''
+    parts = urlsplit(url)
+    host = '{}://{}'.format(parts.scheme, parts.netloc)
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.HTTP_POOL_SIZE)
+                session.mount(host, adapter)
+                _sessions[host] = session
+    return session
+
+
+class CircuitBreaker(object):
+    '''
+        Counts consecutive failed calls to a service. Once CIRCUIT_BREAKER_THRESHOLD is reached the circuit opens and
+        calls fail fast for CIRCUIT_BREAKER_RESET_TIMEOUT seconds, after which a single trial call is let through.
+        A threshold of 0 disables the breaker.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= settings.CIRCUIT_BREAKER_RESET_TIMEOUT:
+                # Half open: let this call through as a trial, and push the next trial out by another timeout
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            threshold = settings.CIRCUIT_BREAKER_THRESHOLD
+            if threshold and self.failures >= threshold:
+                if self.opened_at is None:
+                    logger.error('Circuit breaker for {} opened after {} failures'.format(self.name, self.failures))
+                self.opened_at = time.monotonic()
+
+    def reset(self):
+        self.record_success()
+
+
+class ServiceClient(object):
+    '''
+        Makes GET requests to an upstream service over pooled sessions, with connect and read timeouts, retries with
+        jittered exponential backoff on connection errors and gateway errors, and a circuit breaker per service.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.breaker = CircuitBreaker(name)
+
+    def _backoff(self, attempt):
+        delay = settings.HTTP_RETRY_BACKOFF * (2 ** attempt)
+        time.sleep(random.uniform(0, delay))
+
+    def get(self, url, **kwargs):
+        if not self.breaker.allow_request():
+            raise ServiceUnavailable('{} is currently unavailable'.format(self.name))
+
+        kwargs.setdefault('timeout', (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+        session = get_session(url)
+        max_retries = settings.HTTP_MAX_RETRIES
+        attempt = 0
+        while True:
+            try:
+                response = session.get(url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt < max_retries:
+                    self._backoff(attempt)
+                    attempt += 1
+                    continue
+                self.breaker.record_failure()
+                raise
+
+            if response.status_code in RETRY_STATUS_CODES and attempt < max_retries:
+                self._backoff(attempt)
+                attempt += 1
+                continue
+
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            return response
+
+
+configdb_client = ServiceClient('configdb')
+pond_client = ServiceClient('pond')
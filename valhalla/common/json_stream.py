@@ -0,0 +1,67 @@
+'''
+    Parses the items of a json array as its text arrives, so a large response body can be processed without ever
+    holding all of it, or all of its parsed items, in memory.
+'''
+import codecs
+import json
+
+WHITESPACE = ' \t\n\r'
+
+
+def _skip_whitespace(text, pos):
+    while pos < len(text) and text[pos] in WHITESPACE:
+        pos += 1
+    return pos
+
+
+def iter_json_array(chunks):
+    '''
+        Yields the items of the json array whose text is split across chunks, as soon as each is complete. Only the
+        text of the item being parsed is kept. Raises a ValueError if the text is not a json array.
+    '''
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    has_items = False
+    expect_item = True
+    for chunk in chunks:
+        buffer += chunk
+        pos = _skip_whitespace(buffer, 0)
+        while pos < len(buffer):
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError('Expected a json array, found {!r}'.format(buffer[pos:pos + 20]))
+                started = True
+                pos = _skip_whitespace(buffer, pos + 1)
+                continue
+            if buffer[pos] == ']' and (not expect_item or not has_items):
+                return
+            if not expect_item:
+                if buffer[pos] != ',':
+                    raise ValueError('Expected , or ] in json array, found {!r}'.format(buffer[pos:pos + 20]))
+                expect_item = True
+                pos = _skip_whitespace(buffer, pos + 1)
+                continue
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # The item is incomplete, or invalid, until more text shows otherwise
+                break
+            if end == len(buffer) or (isinstance(item, (int, float)) and buffer[end] not in WHITESPACE + ',]'):
+                # A number that runs to the end of the text, or into what cannot follow it, may go on in the next
+                # chunk, as 1 does in 1.5
+                break
+            yield item
+            has_items = True
+            expect_item = False
+            pos = _skip_whitespace(buffer, end)
+        buffer = buffer[pos:]
+    raise ValueError('The json array is incomplete or invalid near {!r}'.format(buffer[:20]))
+
+
+def iter_response_json_array(response, chunk_size=64 * 1024):
+    '''Yields the items of the json array in the body of a streamed requests response'''
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    return iter_json_array(
+        decoder.decode(chunk) for chunk in response.iter_content(chunk_size=chunk_size) if chunk
+    )
@@ -0,0 +1,45 @@
+class LoadedFieldsMixin(object):
+    '''
+        Remembers the values of a model's loaded_fields as the instance was loaded from the database with, or last
+        saved with, so signal handlers can tell what a save changes without reading the row again
+    '''
+    loaded_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_loaded_values()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        # Refreshing other fields leaves any unsaved values of these on the instance, which are not in the database
+        self._remember_loaded_values(fields)
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        super().save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        self._remember_loaded_values(update_fields)
+
+    def _remember_loaded_values(self, fields=None):
+        loaded_values = self.__dict__.setdefault('_loaded_values', {})
+        for field in self.loaded_fields:
+            if fields is None or field in fields:
+                # A deferred field is not known until it is read
+                if field in self.__dict__:
+                    loaded_values[field] = self.__dict__[field]
+                else:
+                    loaded_values.pop(field, None)
+
+    def get_loaded_value(self, field):
+        '''The value of the field in the database as of when the instance was loaded or last saved'''
+        loaded_values = self.__dict__.setdefault('_loaded_values', {})
+        if field not in loaded_values:
+            loaded_values[field] = type(self).objects.filter(pk=self.pk).values_list(field, flat=True).get()
+        return loaded_values[field]
+
+    def loaded_values_changed(self, fields=None):
+        '''Whether any of the loaded_fields, or of those of them in fields, differ from their loaded values'''
+        return any(
+            getattr(self, field) != self.get_loaded_value(field)
+            for field in self.loaded_fields if fields is None or field in fields
+        )
@@ -0,0 +1,40 @@
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+import msgpack
+import json
+
+
+class NDJSONRenderer(BaseRenderer):
+    '''
+        Renders a list as newline delimited json, one item per line. render_item writes a single line, so a view can
+        stream a long list as its items are produced.
+    '''
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render_item(self, item):
+        return json.dumps(item, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if not isinstance(data, list):
+            data = [data]
+        return b''.join(self.render_item(item) for item in data)
+
+
+class MessagePackRenderer(BaseRenderer):
+    '''
+        Renders MessagePack, which is smaller and quicker to parse than json. Values msgpack has no type for, like
+        datetimes, are converted the way the json renderer converts them.
+    '''
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, use_bin_type=True, default=JSONEncoder().default)
@@ -1,15 +1,46 @@
 from math import cos, radians
 from datetime import timedelta
-from rise_set.astrometry import make_ra_dec_target, make_satellite_target, make_minor_planet_target, make_comet_target
+from collections import OrderedDict
+from bisect import bisect_right
+from rise_set.astrometry import (make_ra_dec_target, make_satellite_target, make_minor_planet_target, make_comet_target,
+                                 gregorian_to_ut_mjd, date_to_tdb, mean_to_apparent, elem_to_topocentric_apparent)
 from rise_set.angle import Angle
+from rise_set.moving_objects import target_to_jform
 from rise_set.rates import ProperMotion
-from rise_set.utils import coalesce_adjacent_intervals
+from rise_set.utils import coalesce_adjacent_intervals, is_sidereal_target
 from rise_set.visibility import Visibility
 from django.core.cache import cache
+from django.conf import settings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import threading
+import hashlib
+import logging
+import json
+import numpy as np
 
 from valhalla.common.configdb import configdb
+from valhalla.common.ephemeris import get_site_ephemeris, unit_vectors
+from valhalla.common.batch_visibility import BatchTargets, get_observable_intervals, get_dark_intervals
 
 HOURS_PER_DEGREES = 15.0
+RISE_SET_CACHE_TIMEOUT = 86400 * 30  # cache for 30 days
+RISE_SET_ENGINE = 'rise_set.ephemeris'
+BATCH_ENGINE = 'batch'
+
+# The target and site fields that rise_set reads, across all target types
+RISE_SET_TARGET_FIELDS = (
+    'type', 'ra', 'dec', 'proper_motion_ra', 'proper_motion_dec', 'parallax', 'epoch', 'altitude', 'azimuth',
+    'diff_pitch_rate', 'diff_roll_rate', 'diff_pitch_acceleration', 'diff_roll_acceleration', 'diff_epoch_rate',
+    'scheme', 'epochofel', 'epochofperih', 'orbinc', 'longascnode', 'argofperih', 'meandist', 'perihdist',
+    'eccentricity', 'meananom'
+)
+RISE_SET_SITE_FIELDS = ('latitude', 'longitude', 'horizon', 'ha_limit_neg', 'ha_limit_pos')
+
+logger = logging.getLogger(__name__)
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
 
 
 def get_largest_interval(intervals):
@@ -20,43 +51,244 @@ def get_largest_interval(intervals):
     return largest_interval
 
 
-def get_rise_set_intervals(request_dict, site=''):
-    intervals = []
+def get_rise_set_cache_key(target_dict, constraints_dict, window, site_detail, engine=RISE_SET_ENGINE):
+    '''
+        Returns a cache key derived from everything that goes into the visible intervals of one window at one site, so
+        unsaved requests share entries with saved ones and any edit to the target, constraints or window misses.
+    '''
+    key_data = {
+        'engine': engine,
+        'target': {field: target_dict.get(field) for field in RISE_SET_TARGET_FIELDS},
+        'constraints': {field: constraints_dict.get(field) for field in ('max_airmass', 'min_lunar_distance')},
+        'window': (window['start'], window['end']),
+        'site': {field: site_detail.get(field) for field in RISE_SET_SITE_FIELDS},
+    }
+    serialized = json.dumps(key_data, sort_keys=True, default=str)
+    return 'rsi.{}'.format(hashlib.sha1(serialized.encode('utf-8')).hexdigest())
+
+
+class IntervalMemo(object):
+    '''
+        A least recently used map of rise/set cache key to intervals, kept by each process in front of the django
+        cache and bounded to RISE_SET_MEMORY_CACHE_SIZE entries. A size of 0 turns it off.
+    '''
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key]
+        return found
+
+    def set_many(self, entries):
+        max_size = settings.RISE_SET_MEMORY_CACHE_SIZE
+        if max_size <= 0:
+            return
+        with self._lock:
+            for key, value in entries.items():
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+interval_memo = IntervalMemo()
+
+
+def get_cached_rise_set_intervals(cache_keys):
+    intervals = interval_memo.get_many(cache_keys)
+    missing_keys = [cache_key for cache_key in cache_keys if cache_key not in intervals]
+    if missing_keys:
+        cached_intervals = cache.get_many(missing_keys)
+        interval_memo.set_many(cached_intervals)
+        intervals.update(cached_intervals)
+    return intervals
+
+
+def set_cached_rise_set_intervals(computed_intervals):
+    cache.set_many(computed_intervals, RISE_SET_CACHE_TIMEOUT)
+    interval_memo.set_many(computed_intervals)
+
+
+def get_request_site_details(request_dict, site=''):
     site = site if site else request_dict['location'].get('site', '')
-    site_details = configdb.get_sites_with_instrument_type_and_location(
+    return configdb.get_sites_with_instrument_type_and_location(
             request_dict['molecules'][0]['instrument_name'],
             site,
             request_dict['location'].get('observatory', ''),
             request_dict['location'].get('telescope', '')
     )
+
+
+def compute_rise_set_intervals(rise_set_target, rise_set_site, site_detail, window, constraints_dict):
+    visibility = get_rise_set_visibility(rise_set_site, window['start'], window['end'], site_detail)
+    return visibility.get_observable_intervals(
+        rise_set_target,
+        airmass=constraints_dict['max_airmass'],
+        moon_distance=Angle(degrees=constraints_dict['min_lunar_distance'])
+    )
+
+
+def compute_window_intervals(args):
+    '''
+        Computes the intervals of one window at one site from plain dicts, so it can run in a worker process.
+        args is a tuple of (target_dict, site_detail, window, constraints_dict).
+    '''
+    target_dict, site_detail, window, constraints_dict = args
+    return compute_rise_set_intervals(
+        get_rise_set_target(target_dict), get_rise_set_site(site_detail), site_detail, window, constraints_dict
+    )
+
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                _process_pool = ProcessPoolExecutor(max_workers=settings.RISE_SET_POOL_SIZE)
+    return _process_pool
+
+
+def reset_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False)
+        _process_pool = None
+
+
+def compute_missing_intervals(missing_windows):
+    '''
+        Computes the intervals for a dict of cache key to (target_dict, site_detail, window, constraints_dict), and
+        returns a dict of cache key to intervals. Once there are at least RISE_SET_POOL_THRESHOLD of them they are
+        spread over a pool of RISE_SET_POOL_SIZE processes, otherwise they are computed here, reusing the rise_set
+        target and sites between windows.
+    '''
+    pool_size = settings.RISE_SET_POOL_SIZE
+    if pool_size > 1 and len(missing_windows) >= settings.RISE_SET_POOL_THRESHOLD:
+        chunksize = max(1, len(missing_windows) // (pool_size * 4))
+        try:
+            results = get_process_pool().map(compute_window_intervals, missing_windows.values(), chunksize=chunksize)
+            return dict(zip(missing_windows.keys(), results))
+        except BrokenProcessPool:
+            logger.exception('Rise/set process pool broke, computing intervals in process')
+            reset_process_pool()
+
+    computed_intervals = {}
+    rise_set_targets = {}
+    rise_set_sites = {}
+    for cache_key, (target_dict, site_detail, window, constraints_dict) in missing_windows.items():
+        if id(target_dict) not in rise_set_targets:
+            rise_set_targets[id(target_dict)] = get_rise_set_target(target_dict)
+        if id(site_detail) not in rise_set_sites:
+            rise_set_sites[id(site_detail)] = get_rise_set_site(site_detail)
+        computed_intervals[cache_key] = compute_rise_set_intervals(
+            rise_set_targets[id(target_dict)], rise_set_sites[id(site_detail)], site_detail, window, constraints_dict
+        )
+    return computed_intervals
+
+
+def get_rise_set_intervals(request_dict, site=''):
+    site_details = get_request_site_details(request_dict, site)
     if not site_details:
-        return intervals
-    intervals_by_site = {}
-    if request_dict.get('id'):
-        cache_key = '{0}.rsi'.format(request_dict['id'])
-        intervals_by_site = cache.get(cache_key, {})
+        return []
+    cache_keys = OrderedDict()
     for site in site_details:
-        if intervals_by_site.get(site):
-            intervals.extend(intervals_by_site[site])
-        else:
-            intervals_by_site[site] = []
-            rise_set_site = get_rise_set_site(site_details[site])
-            rise_set_target = get_rise_set_target(request_dict['target'])
-            for window in request_dict['windows']:
-                visibility = get_rise_set_visibility(rise_set_site, window['start'], window['end'], site_details[site])
-
-                intervals_by_site[site].extend(
-                    visibility.get_observable_intervals(
-                        rise_set_target,
-                        airmass=request_dict['constraints']['max_airmass'],
-                        moon_distance=Angle(degrees=request_dict['constraints']['min_lunar_distance'])
-                    )
+        for i, window in enumerate(request_dict['windows']):
+            cache_keys[(site, i)] = get_rise_set_cache_key(
+                request_dict['target'], request_dict['constraints'], window, site_details[site]
+            )
+    intervals = get_cached_rise_set_intervals(list(cache_keys.values()))
+    missing_windows = OrderedDict(
+        (cache_key, (request_dict['target'], site_details[site], request_dict['windows'][i],
+                     request_dict['constraints']))
+        for (site, i), cache_key in cache_keys.items() if cache_key not in intervals
+    )
+    if missing_windows:
+        computed_intervals = compute_missing_intervals(missing_windows)
+        set_cached_rise_set_intervals(computed_intervals)
+        intervals.update(computed_intervals)
+
+    return coalesce_adjacent_intervals(
+        [interval for cache_key in cache_keys.values() for interval in intervals[cache_key]]
+    )
+
+
+def get_rise_set_intervals_by_site(request_dicts, site=''):
+    '''
+        The batch form of get_rise_set_intervals. Returns, for each request dict, a dict of site code to the request's
+        intervals at that site. The uncached windows of all sidereal targets are computed together by the batch
+        visibility engine, and only other targets go through rise_set window by window. The batch results have their
+        own cache entries since they can differ slightly from rise_set's.
+    '''
+    site_details = [get_request_site_details(request_dict, site) for request_dict in request_dicts]
+    cache_keys = OrderedDict()
+    for i, request_dict in enumerate(request_dicts):
+        engine = BATCH_ENGINE if request_dict['target']['type'] == 'SIDEREAL' else RISE_SET_ENGINE
+        for site_code, site_detail in site_details[i].items():
+            for w, window in enumerate(request_dict['windows']):
+                cache_keys[(i, site_code, w)] = get_rise_set_cache_key(
+                    request_dict['target'], request_dict['constraints'], window, site_detail, engine
                 )
-            intervals.extend(intervals_by_site[site])
-    if request_dict.get('id'):
-        cache.set(cache_key, intervals_by_site, 86400 * 30)  # cache for 30 days
+    intervals = get_cached_rise_set_intervals(list(cache_keys.values()))
+    computed_intervals = {}
+    missing_windows = OrderedDict()
 
-    return coalesce_adjacent_intervals(intervals)
+    # Sites are keyed on their details, as telescopes at one site can have different horizons and hour angle limits
+    batch_site_details = {}
+    batch_sites = OrderedDict()
+    for (i, site_code, w), cache_key in cache_keys.items():
+        if cache_key in intervals or cache_key in missing_windows:
+            continue
+        request_dict = request_dicts[i]
+        site_detail = site_details[i][site_code]
+        if request_dict['target']['type'] == 'SIDEREAL':
+            site_key = tuple(site_detail.get(field) for field in RISE_SET_SITE_FIELDS)
+            batch_site_details[site_key] = site_detail
+            batch_sites.setdefault(i, {})[site_code] = site_key
+        else:
+            missing_windows[cache_key] = (
+                request_dict['target'], site_detail, request_dict['windows'][w], request_dict['constraints']
+            )
+    if missing_windows:
+        computed_intervals.update(compute_missing_intervals(missing_windows))
+    if batch_sites:
+        batch_requests = [request_dicts[i] for i in batch_sites]
+        batch_windows = [[(window['start'], window['end']) for window in r['windows']] for r in batch_requests]
+        batch_intervals = get_observable_intervals(
+            batch_site_details,
+            BatchTargets.from_request_dicts(batch_requests),
+            batch_windows,
+            [set(sites.values()) for sites in batch_sites.values()]
+        )
+        for n, (i, sites) in enumerate(batch_sites.items()):
+            for site_code, site_key in sites.items():
+                for w, window_intervals in enumerate(batch_intervals[site_key][n]):
+                    computed_intervals[cache_keys[(i, site_code, w)]] = window_intervals
+    if computed_intervals:
+        set_cached_rise_set_intervals(computed_intervals)
+        intervals.update(computed_intervals)
+
+    intervals_by_site = []
+    for i, request_dict in enumerate(request_dicts):
+        intervals_by_site.append(OrderedDict(
+            (site_code, coalesce_adjacent_intervals([
+                interval for w in range(len(request_dict['windows']))
+                for interval in intervals[cache_keys[(i, site_code, w)]]
+            ]))
+            for site_code in site_details[i]
+        ))
+    return intervals_by_site
 
 
 def get_rise_set_target(target_dict):
@@ -110,8 +342,52 @@ def get_rise_set_site(site_detail):
     }
 
 
+class EphemerisVisibility(Visibility):
+    '''
+        rise_set's Visibility with the Sun and Moon taken from the site's shared ephemeris. The dark intervals are
+        interpolated from the ephemeris' Sun, and the lunar distance is checked every 30 minutes as rise_set checks it,
+        against the ephemeris' Moon. The target is still followed by rise_set itself.
+    '''
+
+    def __init__(self, site_detail, **kwargs):
+        super().__init__(**kwargs)
+        self.site_detail = site_detail
+
+    def get_dark_intervals(self):
+        if not self.dark_intervals:
+            self.dark_intervals = get_dark_intervals(self.site_detail, self.start_date, self.end_date)
+        return self.dark_intervals
+
+    def get_moon_distance_intervals(self, target, target_intervals, moon_distance=Angle(degrees=30),
+                                    chunksize=timedelta(minutes=30)):
+        chunks = []
+        for start, end in target_intervals:
+            chunk_start = start
+            while chunk_start < end:
+                chunks.append((chunk_start, min(chunk_start + chunksize, end)))
+                chunk_start = chunks[-1][1]
+        if not chunks:
+            return []
+        ut_mjd = np.array([gregorian_to_ut_mjd(chunk_start) for chunk_start, _ in chunks])
+        _, moon_vectors = get_site_ephemeris(self.site_detail).sun_and_moon(ut_mjd)
+
+        intervals = []
+        for (chunk_start, chunk_end), moon_vector in zip(chunks, moon_vectors):
+            if is_sidereal_target(target):
+                target_ra, target_dec = mean_to_apparent(target, date_to_tdb(chunk_start))
+            else:
+                target_ra, target_dec = elem_to_topocentric_apparent(chunk_start, target, self.site,
+                                                                     target_to_jform(target))
+            target_vector = unit_vectors(target_ra.in_radians(), target_dec.in_radians())
+            moon_degrees = np.degrees(np.arccos(np.clip(np.dot(target_vector, moon_vector), -1.0, 1.0)))
+            if moon_degrees >= moon_distance.in_degrees():
+                intervals.append((chunk_start, chunk_end))
+        return coalesce_adjacent_intervals(intervals)
+
+
 def get_rise_set_visibility(rise_set_site, start, end, site_detail):
-        return Visibility(
+        return EphemerisVisibility(
+            site_detail,
             site=rise_set_site,
             start_date=start,
             end_date=end,
@@ -122,13 +398,62 @@ def get_rise_set_visibility(rise_set_site, start, end, site_detail):
         )
 
 
+def get_dark_interval_calendar_cache_key(site_code, site_detail):
+    site_data = json.dumps({field: site_detail.get(field) for field in RISE_SET_SITE_FIELDS}, sort_keys=True)
+    return 'dark_intervals.{}.{}'.format(site_code, hashlib.sha1(site_data.encode('utf-8')).hexdigest())
+
+
+def compute_site_dark_intervals(site_detail, start, end):
+    rise_set_site = get_rise_set_site(site_detail)
+    return get_rise_set_visibility(rise_set_site, start, end, site_detail).get_dark_intervals()
+
+
+def update_site_dark_interval_calendar(site_code, start, end):
+    '''
+        Makes sure the stored calendar of nautical twilight dark intervals for a site covers start to end. A calendar
+        that already covers start is only extended past its current end, and intervals that finished before start are
+        dropped. Returns the calendar, or None if the site is not in configdb.
+    '''
+    site_details = configdb.get_sites_with_instrument_type_and_location(site_code=site_code)
+    if site_code not in site_details:
+        return None
+    site_detail = site_details[site_code]
+    cache_key = get_dark_interval_calendar_cache_key(site_code, site_detail)
+    calendar = cache.get(cache_key)
+    if calendar and calendar['start'] <= start and calendar['end'] >= end:
+        return calendar
+    if calendar and calendar['start'] <= start <= calendar['end']:
+        intervals = coalesce_adjacent_intervals(
+            [interval for interval in calendar['intervals'] if interval[1] > start] +
+            compute_site_dark_intervals(site_detail, calendar['end'], end)
+        )
+    else:
+        intervals = compute_site_dark_intervals(site_detail, start, end)
+    calendar = {
+        'start': start,
+        'end': end,
+        'intervals': intervals,
+        'ends': [interval[1] for interval in intervals]
+    }
+    cache.set(cache_key, calendar, None)
+    return calendar
+
+
 def get_site_rise_set_intervals(start, end, site_code):
     site_details = configdb.get_sites_with_instrument_type_and_location(site_code=site_code)
     if site_code in site_details:
         site_detail = site_details[site_code]
-        rise_set_site = get_rise_set_site(site_detail)
-        v = get_rise_set_visibility(rise_set_site, start, end, site_detail)
+        calendar = cache.get(get_dark_interval_calendar_cache_key(site_code, site_detail))
+        if not calendar or calendar['start'] > start or calendar['end'] < end:
+            return compute_site_dark_intervals(site_detail, start, end)
 
-        return v.get_dark_intervals()
+        # the first interval that ends after start, clipped like Visibility clips to its own start and end dates
+        intervals = []
+        index = bisect_right(calendar['ends'], start)
+        while index < len(calendar['intervals']) and calendar['intervals'][index][0] < end:
+            dark_start, dark_end = calendar['intervals'][index]
+            intervals.append((max(dark_start, start), min(dark_end, end)))
+            index += 1
+        return intervals
 
     return []
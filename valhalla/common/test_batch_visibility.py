@@ -0,0 +1,196 @@
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from rise_set.angle import Angle
+from rise_set.astrometry import calculate_airmass_at_times
+from rise_set.visibility import Visibility
+import numpy as np
+
+from valhalla.common import rise_set_utils
+from valhalla.common.batch_visibility import (BatchTargets, get_observable_intervals, effective_horizon, get_airmasses,
+                                              get_dark_intervals)
+from valhalla.common.test_helpers import ConfigDBTestMixin
+
+SITE_DETAILS = {
+    'tst': {'latitude': -32.3805542, 'longitude': 20.8100352, 'horizon': 15.0, 'ha_limit_neg': -4.6,
+            'ha_limit_pos': 4.6},
+    'nth': {'latitude': 30.67, 'longitude': -104.02, 'horizon': 0.0, 'ha_limit_neg': -12.0, 'ha_limit_pos': 12.0},
+}
+
+# (ra, dec, max_airmass, min_lunar_distance) covering circumpolar, never rising, airmass limited and moon limited cases
+TARGETS = [
+    (83.82, -5.39, 1.6, 30.0),
+    (10.68, 41.27, 2.0, 0.0),
+    (201.37, -43.02, 1.2, 10.0),
+    (95.99, -52.7, 30.0, 0.0),
+    (279.23, 38.78, 1.6, 60.0),
+    (37.95, 89.26, 2.0, 0.0),
+    (250.0, -80.0, 1.5, 0.0),
+    (150.0, 10.0, 3.0, 45.0),
+]
+
+EDGE_TOLERANCE = timedelta(minutes=2)
+# rise_set checks the lunar distance every 30 minutes, so edges set by the moon can be that far out
+MOON_EDGE_TOLERANCE = timedelta(minutes=31)
+
+
+def get_request_dict(ra, dec, max_airmass, min_lunar_distance, windows):
+    return {
+        'location': {'telescope_class': '1m0'},
+        'molecules': [{'instrument_name': '1M0-SCICAM-SBIG'}],
+        'target': {'type': 'SIDEREAL', 'ra': ra, 'dec': dec, 'proper_motion_ra': 0.0, 'proper_motion_dec': 0.0,
+                   'parallax': 0.0, 'epoch': 2000},
+        'constraints': {'max_airmass': max_airmass, 'min_lunar_distance': min_lunar_distance},
+        'windows': [{'start': start, 'end': end} for start, end in windows]
+    }
+
+
+def get_scalar_intervals(request_dict, site_detail, window):
+    return rise_set_utils.compute_rise_set_intervals(
+        rise_set_utils.get_rise_set_target(request_dict['target']), rise_set_utils.get_rise_set_site(site_detail),
+        site_detail, {'start': window[0], 'end': window[1]}, request_dict['constraints']
+    )
+
+
+def get_plain_visibility(site_detail, window):
+    return Visibility(
+        site=rise_set_utils.get_rise_set_site(site_detail), start_date=window[0], end_date=window[1],
+        horizon=site_detail['horizon'], ha_limit_neg=site_detail['ha_limit_neg'],
+        ha_limit_pos=site_detail['ha_limit_pos'], twilight='nautical'
+    )
+
+
+class TestBatchVisibility(TestCase):
+    def setUp(self):
+        start = datetime(2017, 5, 3, 7, 30, tzinfo=timezone.utc)
+        self.windows = [
+            [(start, start + timedelta(days=3))],
+            [(start + timedelta(days=1), start + timedelta(days=1, hours=10)),
+             (start + timedelta(days=20), start + timedelta(days=22))],
+        ]
+        self.request_dicts = [
+            get_request_dict(*target, windows=self.windows[i % 2]) for i, target in enumerate(TARGETS)
+        ]
+        self.batch_intervals = get_observable_intervals(
+            SITE_DETAILS, BatchTargets.from_request_dicts(self.request_dicts),
+            [self.windows[i % 2] for i in range(len(TARGETS))]
+        )
+
+    def test_matches_rise_set_within_tolerance(self):
+        for site, site_detail in SITE_DETAILS.items():
+            for i, request_dict in enumerate(self.request_dicts):
+                tolerance = MOON_EDGE_TOLERANCE if TARGETS[i][3] > 0.5 else EDGE_TOLERANCE
+                for w, window in enumerate(self.windows[i % 2]):
+                    scalar = get_scalar_intervals(request_dict, site_detail, window)
+                    batch = self.batch_intervals[site][i][w]
+                    self.assertEqual(len(batch), len(scalar), msg='{} {} {}'.format(site, TARGETS[i], window))
+                    for (scalar_start, scalar_end), (batch_start, batch_end) in zip(scalar, batch):
+                        self.assertLessEqual(abs(scalar_start - batch_start), tolerance)
+                        self.assertLessEqual(abs(scalar_end - batch_end), tolerance)
+
+    def test_intervals_are_within_windows(self):
+        for site in SITE_DETAILS:
+            for i in range(len(TARGETS)):
+                for w, (start, end) in enumerate(self.windows[i % 2]):
+                    for interval_start, interval_end in self.batch_intervals[site][i][w]:
+                        self.assertTrue(start <= interval_start < interval_end <= end)
+
+    def test_targets_can_be_restricted_to_sites(self):
+        intervals = get_observable_intervals(
+            SITE_DETAILS, BatchTargets.from_request_dicts(self.request_dicts[:2]), self.windows, [{'tst'}, {'nth'}]
+        )
+        self.assertEqual(list(intervals['tst'].keys()), [0])
+        self.assertEqual(list(intervals['nth'].keys()), [1])
+        self.assertEqual(intervals['nth'][1], self.batch_intervals['nth'][1])
+
+    def test_dark_intervals_match_rise_set(self):
+        start = datetime(2017, 5, 3, 7, 30, tzinfo=timezone.utc)
+        end = start + timedelta(days=20)
+        for site_detail in SITE_DETAILS.values():
+            scalar = get_plain_visibility(site_detail, (start, end)).get_dark_intervals()
+            dark = get_dark_intervals(site_detail, start, end)
+            self.assertEqual(len(dark), len(scalar))
+            for (scalar_start, scalar_end), (dark_start, dark_end) in zip(scalar, dark):
+                self.assertLessEqual(abs(scalar_start - dark_start), EDGE_TOLERANCE)
+                self.assertLessEqual(abs(scalar_end - dark_end), EDGE_TOLERANCE)
+
+    def test_ephemeris_visibility_matches_rise_set(self):
+        for site_detail in SITE_DETAILS.values():
+            for i, request_dict in enumerate(self.request_dicts):
+                target = rise_set_utils.get_rise_set_target(request_dict['target'])
+                moon_distance = Angle(degrees=TARGETS[i][3])
+                for window in self.windows[i % 2]:
+                    expected = get_plain_visibility(site_detail, window).get_observable_intervals(
+                        target, airmass=TARGETS[i][2], moon_distance=moon_distance
+                    )
+                    intervals = rise_set_utils.get_rise_set_visibility(
+                        rise_set_utils.get_rise_set_site(site_detail), window[0], window[1], site_detail
+                    ).get_observable_intervals(target, airmass=TARGETS[i][2], moon_distance=moon_distance)
+                    self.assertEqual(len(intervals), len(expected))
+                    for (expected_start, expected_end), (start, end) in zip(expected, intervals):
+                        self.assertLessEqual(abs(expected_start - start), EDGE_TOLERANCE)
+                        self.assertLessEqual(abs(expected_end - end), EDGE_TOLERANCE)
+
+    def test_ephemeris_visibility_takes_the_moon_from_the_ephemeris(self):
+        site_detail = SITE_DETAILS['tst']
+        target = rise_set_utils.get_rise_set_target(self.request_dicts[2]['target'])
+        with patch('rise_set.visibility.apparent_planet_pos') as mock_planet:
+            intervals = rise_set_utils.get_rise_set_visibility(
+                rise_set_utils.get_rise_set_site(site_detail), self.windows[0][0][0], self.windows[0][0][1], site_detail
+            ).get_observable_intervals(target, airmass=2.0, moon_distance=Angle(degrees=30))
+        self.assertTrue(intervals)
+        self.assertFalse(mock_planet.called)
+
+    def test_airmasses_match_rise_set(self):
+        site_detail = dict(SITE_DETAILS['tst'], altitude=1460.0)
+        start = datetime(2017, 5, 3, 18, tzinfo=timezone.utc)
+        times = [start + timedelta(minutes=10 * i) for i in range(60)]
+        airmasses = get_airmasses(site_detail, BatchTargets.from_request_dicts(self.request_dicts), times)
+        for request_dict, target_airmasses in zip(self.request_dicts, airmasses):
+            expected = np.array(calculate_airmass_at_times(
+                times, rise_set_utils.get_rise_set_target(request_dict['target']),
+                Angle(degrees=site_detail['latitude']), Angle(degrees=site_detail['longitude']), site_detail['altitude']
+            ))
+            below_horizon = expected > 10
+            np.testing.assert_allclose(target_airmasses[~below_horizon], expected[~below_horizon], rtol=1e-3)
+
+    def test_effective_horizon_matches_rise_set(self):
+        horizons = effective_horizon(np.array([0.0, 1.2, 2.0, 30.0]), 15.0)
+        np.testing.assert_allclose(horizons, [15.0, 56.442690, 30.0, 15.0], atol=1e-5)
+        self.assertEqual(effective_horizon(np.array([0.0]), 0.0)[0], -0.5667)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'batch-visibility-tests'}})
+class TestRiseSetIntervalsBySite(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        start = datetime(2017, 5, 3, tzinfo=timezone.utc)
+        self.request_dicts = [
+            get_request_dict(*target, windows=[(start, start + timedelta(days=2))]) for target in TARGETS
+        ]
+
+    def tearDown(self):
+        rise_set_utils.cache.clear()
+        super().tearDown()
+
+    def test_sidereal_targets_are_batched(self):
+        with patch('valhalla.common.rise_set_utils.get_observable_intervals',
+                   wraps=rise_set_utils.get_observable_intervals) as mock_batch:
+            intervals_by_site = rise_set_utils.get_rise_set_intervals_by_site(self.request_dicts)
+            self.assertEqual(mock_batch.call_count, 1)
+            self.assertEqual(rise_set_utils.get_rise_set_intervals_by_site(self.request_dicts), intervals_by_site)
+            self.assertEqual(mock_batch.call_count, 1)
+        for request_dict, intervals in zip(self.request_dicts, intervals_by_site):
+            self.assertEqual(list(intervals.keys()), ['tst'])
+            scalar = rise_set_utils.get_rise_set_intervals(request_dict)
+            self.assertEqual(len(intervals['tst']), len(scalar))
+
+    def test_other_targets_use_rise_set(self):
+        self.request_dicts[0]['target'] = {'type': 'SATELLITE', 'altitude': 33.0, 'azimuth': 2.0,
+                                           'diff_pitch_rate': 3.0, 'diff_roll_rate': 4.0,
+                                           'diff_pitch_acceleration': 5.0, 'diff_roll_acceleration': 0.1,
+                                           'diff_epoch_rate': 11.0}
+        intervals_by_site = rise_set_utils.get_rise_set_intervals_by_site(self.request_dicts[:1])
+        self.assertEqual(intervals_by_site[0]['tst'], rise_set_utils.get_rise_set_intervals(self.request_dicts[0]))
@@ -0,0 +1,74 @@
+from django.test import TestCase, RequestFactory
+from django.http import HttpResponse, StreamingHttpResponse
+from datetime import datetime
+from unittest.mock import patch
+import msgpack
+import gzip
+
+from valhalla.common.compression import compress_response, get_accepted_encodings, get_compressors
+from valhalla.common.renderers import MessagePackRenderer
+
+CONTENT = b'{"observation_type":"NORMAL","operator":"SINGLE"}' * 20
+
+
+class TestCompression(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_accepted_encodings(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=1.0, identity; q=0.5, zstd;q=0, *;q=0')
+        self.assertEqual(get_accepted_encodings(request), {'gzip', 'identity'})
+
+    @patch('valhalla.common.compression.zstandard', None)
+    def test_gzip(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = compress_response(request, HttpResponse(CONTENT))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), CONTENT)
+
+    @patch('valhalla.common.compression.zstandard', None)
+    def test_zstd_is_not_offered_without_zstandard(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='zstd')
+        self.assertNotIn('zstd', dict(get_compressors()))
+        self.assertNotIn('Content-Encoding', compress_response(request, HttpResponse(CONTENT)))
+
+    def test_zstd_is_preferred(self):
+        zstandard = self.skip_without_zstandard()
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip, zstd')
+        response = compress_response(request, HttpResponse(CONTENT))
+        self.assertEqual(response['Content-Encoding'], 'zstd')
+        self.assertEqual(zstandard.ZstdDecompressor().decompressobj().decompress(response.content), CONTENT)
+
+    @patch('valhalla.common.compression.zstandard', None)
+    def test_streaming(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        response = StreamingHttpResponse(CONTENT[i:i + 100] for i in range(0, len(CONTENT), 100))
+        response['ETag'] = '"1"'
+        response = compress_response(request, response)
+        self.assertEqual(response['ETag'], 'W/"1"')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), CONTENT)
+
+    def test_left_alone(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', compress_response(request, HttpResponse(b'{}')))
+        encoded = HttpResponse(CONTENT)
+        encoded['Content-Encoding'] = 'br'
+        self.assertEqual(compress_response(request, encoded).content, CONTENT)
+        request = self.factory.get('/')
+        self.assertEqual(compress_response(request, HttpResponse(CONTENT)).content, CONTENT)
+
+    def skip_without_zstandard(self):
+        try:
+            import zstandard
+        except ImportError:
+            self.skipTest('zstandard is not installed')
+        return zstandard
+
+
+class TestMessagePackRenderer(TestCase):
+    def test_render(self):
+        data = [{'id': 1, 'created': datetime(2016, 9, 1, 12), 'name': 'ur'}]
+        rendered = msgpack.unpackb(MessagePackRenderer().render(data), raw=False)
+        self.assertEqual(rendered, [{'id': 1, 'created': '2016-09-01T12:00:00', 'name': 'ur'}])
@@ -0,0 +1,245 @@
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+from unittest.mock import patch
+from io import StringIO
+import responses
+import tempfile
+import shutil
+import json
+import os
+
+from valhalla.common.configdb import ConfigDB, ConfigDBSnapshot, ConfigDBException, TelescopeKey
+from valhalla.common.test_helpers import CONFIGDB_TEST_FILE, FILTERWHEELS_FILE, ConfigDBTestMixin
+
+SNAPSHOT_DIR = os.path.dirname(CONFIGDB_TEST_FILE)
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'configdb'}}
+
+
+def get_test_site_data():
+    with open(CONFIGDB_TEST_FILE) as f:
+        return json.loads(f.read())['results']
+
+
+def get_test_configdb_data(resource, use_cache=True):
+    with open(FILTERWHEELS_FILE if resource == 'filterwheels' else CONFIGDB_TEST_FILE) as f:
+        return json.loads(f.read())['results']
+
+
+class TestConfigDBSnapshot(TestCase):
+    def setUp(self):
+        self.snapshot = ConfigDBSnapshot(get_test_site_data())
+
+    def test_indexes_instruments_by_type(self):
+        self.assertIn('1M0-SCICAM-SBIG', self.snapshot.camera_types)
+        self.assertIn('2M0-FLOYDS-SCICAM', self.snapshot.camera_types)
+        self.assertEqual(self.snapshot.filters['1M0-SCICAM-SBIG'], {'air'})
+
+    def test_indexes_exposure_overhead_by_type_and_binning(self):
+        self.assertEqual(self.snapshot.exposure_overheads[('1M0-SCICAM-SBIG', 2)], 15.5)
+        self.assertNotIn(('1M0-SCICAM-SBIG', 4), self.snapshot.exposure_overheads)
+
+    def test_indexes_request_overheads_by_type(self):
+        floyds = self.snapshot.request_overheads['2M0-FLOYDS-SCICAM']
+        self.assertTrue(floyds.is_spectrograph)
+        self.assertEqual(floyds.front_padding, 240)
+        self.assertFalse(self.snapshot.request_overheads['1M0-SCICAM-SBIG'].is_spectrograph)
+        self.assertEqual(self.snapshot.overheads.exposure_overhead('1m0-scicam-sbig', 2), 15.5)
+        with self.assertRaises(ConfigDBException):
+            self.snapshot.overheads.request_overheads('FAKE-CAMERA')
+
+    def test_indexes_telescopes(self):
+        tk = TelescopeKey(site='tst', observatory='doma', telescope='1m0a')
+        self.assertIn(tk, self.snapshot.telescopes['1M0-SCICAM-SBIG'])
+        self.assertIn('2M0-FLOYDS-SCICAM', self.snapshot.instrument_types[tk])
+
+    def test_instruments_are_annotated_with_telescope_key(self):
+        for instrument in self.snapshot.instruments:
+            self.assertIsInstance(instrument.telescope_key, TelescopeKey)
+
+    def test_instruments_are_compact_records(self):
+        sbig_instruments = [i for i in self.snapshot.instruments if i.instrument_type == '1M0-SCICAM-SBIG']
+        self.assertEqual(len(sbig_instruments), 2)
+        self.assertIs(sbig_instruments[0].camera_type, sbig_instruments[1].camera_type)
+        self.assertFalse(hasattr(sbig_instruments[0], '__dict__'))
+        self.assertEqual(sbig_instruments[0].camera_type.binnings, {1, 2, 3})
+        self.assertEqual(sbig_instruments[0].filters, {'air'})
+
+    def test_site_records(self):
+        site = self.snapshot.site_records['tst']
+        self.assertEqual([telescope.observatory for telescope in site.telescopes], ['doma', 'domb'])
+        self.assertEqual(site.telescopes[0].horizon, 15.0)
+        self.assertEqual(len(site.telescopes[0].instruments), 2)
+
+    def test_site_data_is_kept_without_instruments(self):
+        site_data = get_test_site_data()
+        snapshot = ConfigDBSnapshot(site_data)
+        telescope = snapshot.site_data[0]['enclosure_set'][0]['telescope_set'][0]
+        self.assertEqual(telescope['code'], '1m0a')
+        self.assertNotIn('instrument_set', telescope)
+        self.assertIn('instrument_set', site_data[0]['enclosure_set'][0]['telescope_set'][0])
+
+    def test_site_details_are_memoized(self):
+        details = self.snapshot.get_site_details('1m0-scicam-sbig', 'tst', '', '')
+        self.assertIn('tst', details)
+        self.assertIs(details, self.snapshot.get_site_details('1M0-SCICAM-SBIG', 'tst', None, None))
+
+    def test_site_details_for_unknown_site(self):
+        self.assertEqual(self.snapshot.get_site_details('', 'xyz', '', ''), {})
+
+
+class TestConfigDB(TestCase):
+    def setUp(self):
+        self.configdb_patcher = patch('valhalla.common.configdb.ConfigDB._get_configdb_data')
+        self.mock_configdb_data = self.configdb_patcher.start()
+        self.mock_configdb_data.side_effect = get_test_configdb_data
+        self.configdb = ConfigDB()
+
+    def tearDown(self):
+        self.configdb_patcher.stop()
+
+    def test_snapshot_is_built_once(self):
+        self.configdb.get_filters('1M0-SCICAM-SBIG')
+        self.configdb.get_binnings('1M0-SCICAM-SBIG')
+        self.configdb.get_exposure_overhead('1M0-SCICAM-SBIG', 2)
+        self.configdb.get_filter_map()
+        # one call for the sites and one for the filterwheels
+        self.assertEqual(self.mock_configdb_data.call_count, 2)
+        self.assertEqual(self.configdb.stats['miss'], 1)
+        self.assertEqual(self.configdb.stats['hit'], 3)
+
+    def test_empty_snapshot_is_fetched_again(self):
+        self.mock_configdb_data.side_effect = None
+        self.mock_configdb_data.return_value = {}
+        self.assertEqual(self.configdb.get_filters('1M0-SCICAM-SBIG'), set())
+        self.mock_configdb_data.side_effect = get_test_configdb_data
+        self.assertEqual(self.configdb.get_filters('1M0-SCICAM-SBIG'), {'air'})
+
+    def test_new_snapshot_replaces_old(self):
+        old_snapshot = self.configdb.get_snapshot()
+        self.configdb.snapshot = ConfigDBSnapshot(get_test_site_data())
+        self.assertIsNot(self.configdb.get_snapshot(), old_snapshot)
+
+    def test_accessors(self):
+        self.assertEqual(self.configdb.get_binnings('1M0-SCICAM-SBIG'), {1, 2, 3})
+        self.assertEqual(self.configdb.get_default_binning('1M0-SCICAM-SBIG'), 2)
+        self.assertIsNone(self.configdb.get_default_binning('FAKE-CAMERA'))
+        self.assertEqual(self.configdb.get_instrument_name('FAKE-CAMERA'), 'FAKE-CAMERA')
+        self.assertEqual(self.configdb.get_active_instrument_types({}),
+                         {'1M0-SCICAM-SBIG', '2M0-FLOYDS-SCICAM'})
+        self.assertEqual(self.configdb.get_active_instrument_types({'telescope': '2m0'}), set())
+
+    def test_request_overheads(self):
+        self.assertEqual(self.configdb.get_request_overheads('2m0-floyds-scicam'), {
+            'config_change_time': 30, 'acquire_processing_time': 60, 'acquire_exposure_time': 30,
+            'front_padding': 240, 'filter_change_time': 0
+        })
+
+    def test_exposure_overhead_unknown_instrument(self):
+        with self.assertRaises(ConfigDBException):
+            self.configdb.get_exposure_overhead('FAKE-CAMERA', 1)
+        with self.assertRaises(ConfigDBException):
+            self.configdb.get_request_overheads('FAKE-CAMERA')
+
+    @override_settings(CONFIGDB_SOFT_TTL=-1)
+    def test_stale_snapshot_is_served_while_refreshing(self):
+        old_snapshot = self.configdb.get_snapshot()
+        self.assertIs(self.configdb.get_snapshot(), old_snapshot)
+        self.configdb._refresh_thread.join()
+        self.assertIsNot(self.configdb.snapshot, old_snapshot)
+        self.assertEqual(self.configdb.stats['stale'], 1)
+        self.assertEqual(self.configdb.stats['refresh'], 2)
+
+    @override_settings(CONFIGDB_SOFT_TTL=-1)
+    def test_failed_background_refresh_keeps_snapshot(self):
+        old_snapshot = self.configdb.get_snapshot()
+        self.mock_configdb_data.side_effect = ConfigDBException('down')
+        self.assertIs(self.configdb.get_snapshot(), old_snapshot)
+        self.configdb._refresh_thread.join()
+        self.assertIs(self.configdb.snapshot, old_snapshot)
+
+    @override_settings(CONFIGDB_HARD_TTL=-1)
+    def test_expired_snapshot_is_refreshed_before_use(self):
+        old_snapshot = self.configdb.get_snapshot()
+        self.assertIsNot(self.configdb.get_snapshot(), old_snapshot)
+
+    @override_settings(CONFIGDB_HARD_TTL=-1)
+    def test_expired_snapshot_is_served_when_refresh_fails(self):
+        old_snapshot = self.configdb.get_snapshot()
+        self.mock_configdb_data.side_effect = ConfigDBException('down')
+        self.assertIs(self.configdb.get_snapshot(), old_snapshot)
+        self.assertEqual(self.configdb.stats['stale'], 1)
+
+    def test_missing_snapshot_raises_when_configdb_is_down(self):
+        self.mock_configdb_data.side_effect = ConfigDBException('down')
+        with self.assertRaises(ConfigDBException):
+            self.configdb.get_snapshot()
+
+    def test_refresh_logs_snapshot_events(self):
+        self.configdb.get_snapshot()
+        self.configdb.get_snapshot()
+        with patch('valhalla.common.configdb.logger') as mock_logger:
+            self.configdb.refresh()
+        self.assertIn('1 hit, 1 miss, 2 refresh', mock_logger.info.call_args[0][0])
+
+
+@responses.activate
+class TestConfigDBSnapshotFiles(TestCase):
+    def setUp(self):
+        self.configdb = ConfigDB()
+
+    @override_settings(CONFIGDB_URL=SNAPSHOT_DIR)
+    def test_reads_snapshot_directory(self):
+        self.assertEqual(self.configdb.get_filters('1M0-SCICAM-SBIG'), {'air'})
+        self.assertTrue(self.configdb.get_filter_map())
+        self.assertEqual(len(responses.calls), 0)
+
+    @override_settings(CONFIGDB_URL='file://' + CONFIGDB_TEST_FILE)
+    def test_reads_snapshot_file_url(self):
+        self.assertEqual(self.configdb.get_site_data()[0]['code'], 'tst')
+        self.assertTrue(self.configdb.get_filter_map())
+        self.assertEqual(len(responses.calls), 0)
+
+    @override_settings(CONFIGDB_URL='file:///nonexistent/configdb')
+    def test_missing_snapshot_raises(self):
+        with self.assertRaises(ConfigDBException):
+            self.configdb.get_snapshot()
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_warm_cache_serves_every_process_from_one_fetch(self):
+        responses.add(responses.GET, 'http://localhost/sites/', json={'results': get_test_site_data()})
+        responses.add(responses.GET, 'http://localhost/filterwheels/', json={'results': []})
+        self.assertEqual(self.configdb.warm_cache(), ['sites', 'filterwheels'])
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(ConfigDB().get_site_data()[0]['code'], 'tst')
+        self.assertEqual(len(responses.calls), 2)
+
+    @override_settings(CONFIGDB_URL=SNAPSHOT_DIR)
+    def test_warm_cache_skips_snapshot_directory(self):
+        self.assertEqual(self.configdb.warm_cache(), [])
+        self.assertEqual(len(responses.calls), 0)
+
+    @override_settings(CONFIGDB_FALLBACK_DIR=SNAPSHOT_DIR)
+    def test_falls_back_to_snapshot_when_configdb_is_down(self):
+        responses.add(responses.GET, 'http://localhost/sites/', status=500)
+        responses.add(responses.GET, 'http://localhost/filterwheels/', status=500)
+        self.assertEqual(self.configdb.get_filters('1M0-SCICAM-SBIG'), {'air'})
+        self.assertEqual(len(responses.calls), 2)
+
+
+class TestDumpConfigDB(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def test_dumped_snapshot_can_be_served(self):
+        call_command('dump_configdb', self.directory, stdout=StringIO())
+        self.assertEqual(sorted(os.listdir(self.directory)), ['configdb.json', 'filterwheels.json'])
+        with self.settings(CONFIGDB_URL=self.directory):
+            configdb = ConfigDB()
+            self.assertEqual(configdb.get_site_data(), ConfigDBSnapshot(get_test_site_data()).site_data)
+            self.assertEqual(configdb.get_binnings('1M0-SCICAM-SBIG'), {1, 2, 3})
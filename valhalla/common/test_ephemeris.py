@@ -0,0 +1,69 @@
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from pyslalib import slalib as sla
+from rise_set.astrometry import gregorian_to_ut_mjd, ut_mjd_to_tdb
+import numpy as np
+
+from valhalla.common import ephemeris
+from valhalla.common.ephemeris import get_site_ephemeris, clear_site_ephemerides
+
+SITE_DETAIL = {'latitude': -32.3805542, 'longitude': 20.8100352, 'altitude': 1460.0}
+
+
+def slalib_sun_altitude(ut_mjd, site_detail):
+    longitude = np.radians(site_detail['longitude'])
+    latitude = np.radians(site_detail['latitude'])
+    tt_mjd = ut_mjd_to_tdb(ut_mjd)
+    ra, dec, _ = sla.sla_rdplan(tt_mjd, ephemeris.SUN, longitude, latitude)
+    local_sidereal_time = sla.sla_gmst(ut_mjd) + longitude + sla.sla_eqeqx(tt_mjd)
+    return np.degrees(sla.sla_de2h(local_sidereal_time - ra, dec, latitude)[1])
+
+
+@patch('valhalla.common.ephemeris.timezone.now', return_value=datetime(2016, 10, 1, tzinfo=timezone.utc))
+class TestSiteEphemeris(TestCase):
+    def setUp(self):
+        clear_site_ephemerides()
+        start = gregorian_to_ut_mjd(datetime(2016, 10, 1, 12, tzinfo=timezone.utc))
+        self.ut_mjd = start + np.arange(0, 2, 7 / 1440.0)
+
+    def tearDown(self):
+        clear_site_ephemerides()
+
+    def test_sun_altitude_matches_slalib(self, mock_now):
+        altitudes = get_site_ephemeris(SITE_DETAIL).sun_altitude(self.ut_mjd)
+        expected = [slalib_sun_altitude(ut_mjd, SITE_DETAIL) for ut_mjd in self.ut_mjd]
+        np.testing.assert_allclose(altitudes, expected, atol=1e-3)
+
+    def test_moon_phase(self, mock_now):
+        site_ephemeris = get_site_ephemeris(SITE_DETAIL)
+        # New moon on 2016-09-30 and full moon on 2016-10-16
+        new_moon = site_ephemeris.moon_phase(np.array([gregorian_to_ut_mjd(datetime(2016, 9, 30, 23))]))
+        full_moon = site_ephemeris.moon_phase(np.array([gregorian_to_ut_mjd(datetime(2016, 10, 16, 5))]))
+        self.assertLess(new_moon[0], 0.01)
+        self.assertGreater(full_moon[0], 0.99)
+
+    def test_grid_is_shared_and_covers_the_coming_days(self, mock_now):
+        with patch('valhalla.common.ephemeris.sla.sla_rdplan', wraps=sla.sla_rdplan) as mock_rdplan:
+            site_ephemeris = get_site_ephemeris(SITE_DETAIL)
+            computed = mock_rdplan.call_count
+            self.assertIs(get_site_ephemeris(dict(SITE_DETAIL)), site_ephemeris)
+            site_ephemeris.sun_and_moon(self.ut_mjd)
+            self.assertEqual(mock_rdplan.call_count, computed)
+        self.assertGreaterEqual(len(site_ephemeris.nodes) * site_ephemeris.step, 31 * 86400)
+
+    def test_grid_moves_forward_each_day(self, mock_now):
+        site_ephemeris = get_site_ephemeris(SITE_DETAIL)
+        first_node = min(site_ephemeris.nodes)
+        mock_now.return_value += timedelta(days=1)
+        self.assertIs(get_site_ephemeris(SITE_DETAIL), site_ephemeris)
+        self.assertEqual(min(site_ephemeris.nodes), first_node + 86400 // site_ephemeris.step)
+
+    @override_settings(EPHEMERIS_STEP=1800)
+    def test_step_is_configurable(self, mock_now):
+        site_ephemeris = get_site_ephemeris(SITE_DETAIL)
+        self.assertEqual(site_ephemeris.step, 1800)
+        altitudes = site_ephemeris.sun_altitude(self.ut_mjd)
+        expected = [slalib_sun_altitude(ut_mjd, SITE_DETAIL) for ut_mjd in self.ut_mjd]
+        np.testing.assert_allclose(altitudes, expected, atol=1e-3)
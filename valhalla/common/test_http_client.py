@@ -0,0 +1,80 @@
+from django.test import TestCase, override_settings
+from unittest.mock import patch
+import responses
+import requests
+
+from valhalla.common.http_client import ServiceClient, ServiceUnavailable, get_session
+
+URL = 'http://service.test/resource/'
+
+
+@patch('valhalla.common.http_client.time.sleep')
+class TestServiceClient(TestCase):
+    def setUp(self):
+        self.client = ServiceClient('test')
+
+    @responses.activate
+    @override_settings(HTTP_MAX_RETRIES=2)
+    def test_retries_gateway_errors(self, mock_sleep):
+        responses.add(responses.GET, URL, status=503)
+        responses.add(responses.GET, URL, json={'ok': True}, status=200)
+        response = self.client.get(URL)
+        self.assertEqual(response.json(), {'ok': True})
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    @responses.activate
+    @override_settings(HTTP_MAX_RETRIES=2)
+    def test_gives_up_after_max_retries(self, mock_sleep):
+        responses.add(responses.GET, URL, status=502)
+        response = self.client.get(URL)
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    @override_settings(HTTP_MAX_RETRIES=2)
+    def test_does_not_retry_client_errors(self, mock_sleep):
+        responses.add(responses.GET, URL, status=404)
+        self.assertEqual(self.client.get(URL).status_code, 404)
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    @override_settings(HTTP_MAX_RETRIES=1)
+    def test_retries_connection_errors(self, mock_sleep):
+        responses.add(responses.GET, URL, body=requests.exceptions.ConnectionError())
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.client.get(URL)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    @override_settings(HTTP_MAX_RETRIES=0, CIRCUIT_BREAKER_THRESHOLD=2, CIRCUIT_BREAKER_RESET_TIMEOUT=60)
+    def test_circuit_opens_and_fails_fast(self, mock_sleep):
+        responses.add(responses.GET, URL, status=500)
+        self.client.get(URL)
+        self.client.get(URL)
+        self.assertTrue(self.client.breaker.is_open)
+        with self.assertRaises(ServiceUnavailable):
+            self.client.get(URL)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    @override_settings(HTTP_MAX_RETRIES=0, CIRCUIT_BREAKER_THRESHOLD=1, CIRCUIT_BREAKER_RESET_TIMEOUT=0)
+    def test_circuit_closes_after_successful_trial(self, mock_sleep):
+        responses.add(responses.GET, URL, status=500)
+        responses.add(responses.GET, URL, status=200)
+        self.client.get(URL)
+        self.assertTrue(self.client.breaker.is_open)
+        self.assertEqual(self.client.get(URL).status_code, 200)
+        self.assertFalse(self.client.breaker.is_open)
+
+    @responses.activate
+    @override_settings(HTTP_MAX_RETRIES=0, CIRCUIT_BREAKER_THRESHOLD=0)
+    def test_disabled_circuit_never_opens(self, mock_sleep):
+        responses.add(responses.GET, URL, status=500)
+        for _ in range(10):
+            self.client.get(URL)
+        self.assertFalse(self.client.breaker.is_open)
+
+    def test_sessions_are_shared_per_host(self, mock_sleep):
+        self.assertIs(get_session('http://service.test/a/'), get_session('http://service.test/b/?c=d'))
+        self.assertIsNot(get_session('http://service.test/a/'), get_session('http://other.test/a/'))
@@ -0,0 +1,26 @@
+from django.test import TestCase
+import json
+
+from valhalla.common.json_stream import iter_json_array
+
+ITEMS = [{'id': 1, 'molecules': [{'tracking_num': '0000000001', 'event': []}]}, 12, 'text ] , [', None, -3.5e2]
+
+
+class TestIterJsonArray(TestCase):
+    def test_items_split_at_every_position(self):
+        text = json.dumps(ITEMS, indent=2)
+        for size in (1, 2, 7, len(text)):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            self.assertEqual(list(iter_json_array(chunks)), ITEMS)
+
+    def test_empty_array(self):
+        self.assertEqual(list(iter_json_array([' [', ' ] '])), [])
+
+    def test_items_are_yielded_as_they_complete(self):
+        items = iter_json_array(iter(['[{"id": 1}, {"id"', ': 2}]']))
+        self.assertEqual(next(items), {'id': 1})
+
+    def test_invalid_text(self):
+        for chunks in (['{"id": 1}'], ['[{"id": 1}, {"id"'], ['[1 2]'], ['[1,]'], ['']):
+            with self.assertRaises(ValueError):
+                list(iter_json_array(chunks))
@@ -4,10 +4,10 @@ from valhalla.common.configdb import TelescopeKey
 from valhalla.common.test_helpers import ConfigDBTestMixin
 from valhalla.common import rise_set_utils
 
-from django.test import TestCase
-from datetime import datetime
+from django.test import TestCase, override_settings
+from datetime import datetime, timedelta
 from django.utils import timezone
-from unittest.mock import patch
+from unittest.mock import patch, ANY
 import json
 
 
@@ -415,3 +415,197 @@ class TestRiseSetUtils(ConfigDBTestMixin, TestCase):
         start = timezone.datetime(year=2017, month=5, day=5, tzinfo=timezone.utc)
         end = timezone.datetime(year=2017, month=5, day=6, tzinfo=timezone.utc)
         self.assertFalse(rise_set_utils.get_site_rise_set_intervals(start=start, end=end, site_code='bpl'))
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'rise-set-tests'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestRiseSetIntervalCache(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.request_dict = {
+            'location': {'site': 'tst', 'telescope_class': '1m0'},
+            'molecules': [{'instrument_name': '1M0-SCICAM-SBIG'}],
+            'constraints': {'max_airmass': 2.0, 'min_lunar_distance': 30.0},
+            'target': {'type': 'SIDEREAL', 'name': 'fake target', 'ra': 34.4375, 'dec': -20.0,
+                       'proper_motion_ra': 0.0, 'proper_motion_dec': 0.0, 'parallax': 0.0, 'epoch': 2000},
+            'windows': [
+                {'start': datetime(2016, 9, 4, tzinfo=timezone.utc), 'end': datetime(2016, 9, 5, tzinfo=timezone.utc)},
+                {'start': datetime(2016, 9, 6, tzinfo=timezone.utc), 'end': datetime(2016, 9, 7, tzinfo=timezone.utc)},
+            ]
+        }
+        self.visibility_patcher = patch('valhalla.common.rise_set_utils.get_rise_set_visibility',
+                                        wraps=rise_set_utils.get_rise_set_visibility)
+        self.mock_visibility = self.visibility_patcher.start()
+
+    def tearDown(self):
+        self.visibility_patcher.stop()
+        rise_set_utils.cache.clear()
+        super().tearDown()
+
+    def test_repeated_request_is_served_from_cache(self):
+        intervals = rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.assertTrue(intervals)
+        self.assertEqual(self.mock_visibility.call_count, 2)
+        self.assertEqual(rise_set_utils.get_rise_set_intervals(self.request_dict), intervals)
+        self.assertEqual(self.mock_visibility.call_count, 2)
+
+    def test_saved_and_unsaved_requests_share_entries(self):
+        rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.request_dict['id'] = 5
+        self.request_dict['target']['name'] = 'renamed target'
+        rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.assertEqual(self.mock_visibility.call_count, 2)
+
+    def test_changed_window_recomputes_only_that_window(self):
+        rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.request_dict['windows'][1]['end'] = datetime(2016, 9, 8, tzinfo=timezone.utc)
+        rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.assertEqual(self.mock_visibility.call_count, 3)
+        self.assertEqual(self.mock_visibility.call_args[0][1], self.request_dict['windows'][1]['start'])
+
+    def test_changed_target_or_constraints_are_recomputed(self):
+        intervals = rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.request_dict['target']['dec'] = 80.0
+        self.assertNotEqual(rise_set_utils.get_rise_set_intervals(self.request_dict), intervals)
+        self.request_dict['constraints']['max_airmass'] = 1.1
+        rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.assertEqual(self.mock_visibility.call_count, 6)
+
+
+@override_settings(RISE_SET_MEMORY_CACHE_SIZE=100)
+class TestRiseSetIntervalMemo(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        start = datetime(2016, 9, 1, tzinfo=timezone.utc)
+        self.request_dict = {
+            'location': {'site': 'tst', 'telescope_class': '1m0'},
+            'molecules': [{'instrument_name': '1M0-SCICAM-SBIG'}],
+            'constraints': {'max_airmass': 2.0, 'min_lunar_distance': 30.0},
+            'target': {'type': 'SIDEREAL', 'name': 'fake target', 'ra': 34.4375, 'dec': -20.0,
+                       'proper_motion_ra': 0.0, 'proper_motion_dec': 0.0, 'parallax': 0.0, 'epoch': 2000},
+            'windows': [
+                {'start': start + timedelta(hours=6 * i), 'end': start + timedelta(hours=6 * i + 3)} for i in range(50)
+            ]
+        }
+        self.visibility_patcher = patch('valhalla.common.rise_set_utils.get_rise_set_visibility',
+                                        wraps=rise_set_utils.get_rise_set_visibility)
+        self.mock_visibility = self.visibility_patcher.start()
+
+    def tearDown(self):
+        self.visibility_patcher.stop()
+        rise_set_utils.interval_memo.clear()
+        super().tearDown()
+
+    def test_changed_window_recomputes_only_that_window(self):
+        intervals = rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.assertEqual(self.mock_visibility.call_count, 50)
+        self.request_dict['windows'][20]['end'] += timedelta(hours=1)
+        changed_intervals = rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.assertEqual(self.mock_visibility.call_count, 51)
+        self.assertEqual(self.mock_visibility.call_args[0][1], self.request_dict['windows'][20]['start'])
+        with self.settings(RISE_SET_MEMORY_CACHE_SIZE=0):
+            self.assertEqual(rise_set_utils.get_rise_set_intervals(self.request_dict), changed_intervals)
+        self.assertNotEqual(changed_intervals, intervals)
+
+    @override_settings(RISE_SET_MEMORY_CACHE_SIZE=10)
+    def test_least_recently_used_windows_are_evicted(self):
+        self.request_dict['windows'] = self.request_dict['windows'][:12]
+        rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.assertEqual(self.mock_visibility.call_count, 12)
+        self.request_dict['windows'] = self.request_dict['windows'][2:]
+        rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.assertEqual(self.mock_visibility.call_count, 12)
+        self.request_dict['windows'] = self.request_dict['windows'][:1] + [
+            {'start': datetime(2016, 9, 1, tzinfo=timezone.utc), 'end': datetime(2016, 9, 1, 3, tzinfo=timezone.utc)}
+        ]
+        rise_set_utils.get_rise_set_intervals(self.request_dict)
+        self.assertEqual(self.mock_visibility.call_count, 13)
+
+
+class TestRiseSetProcessPool(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.request_dict = {
+            'location': {'telescope_class': '1m0'},
+            'molecules': [{'instrument_name': '1M0-SCICAM-SBIG'}],
+            'constraints': {'max_airmass': 2.0, 'min_lunar_distance': 30.0},
+            'target': {'type': 'SIDEREAL', 'name': 'fake target', 'ra': 34.4375, 'dec': -20.0,
+                       'proper_motion_ra': 0.0, 'proper_motion_dec': 0.0, 'parallax': 0.0, 'epoch': 2000},
+            'windows': [
+                {'start': datetime(2016, 9, day, tzinfo=timezone.utc),
+                 'end': datetime(2016, 9, day + 1, tzinfo=timezone.utc)} for day in range(1, 12, 2)
+            ]
+        }
+
+    def tearDown(self):
+        rise_set_utils.reset_process_pool()
+        super().tearDown()
+
+    @override_settings(RISE_SET_POOL_SIZE=2, RISE_SET_POOL_THRESHOLD=4)
+    def test_pool_matches_serial_intervals(self):
+        with patch('valhalla.common.rise_set_utils.get_process_pool', wraps=rise_set_utils.get_process_pool) as mock:
+            pooled = rise_set_utils.get_rise_set_intervals(self.request_dict)
+            self.assertEqual(mock.call_count, 1)
+        with self.settings(RISE_SET_POOL_SIZE=0):
+            self.assertEqual(rise_set_utils.get_rise_set_intervals(self.request_dict), pooled)
+        self.assertTrue(pooled)
+
+    @override_settings(RISE_SET_POOL_SIZE=2, RISE_SET_POOL_THRESHOLD=100)
+    def test_small_requests_stay_in_process(self):
+        with patch('valhalla.common.rise_set_utils.get_process_pool') as mock:
+            self.assertTrue(rise_set_utils.get_rise_set_intervals(self.request_dict))
+            self.assertFalse(mock.called)
+
+    @override_settings(RISE_SET_POOL_SIZE=2, RISE_SET_POOL_THRESHOLD=1)
+    def test_broken_pool_falls_back_to_serial(self):
+        with patch('valhalla.common.rise_set_utils.get_process_pool') as mock:
+            mock.return_value.map.side_effect = rise_set_utils.BrokenProcessPool()
+            intervals = rise_set_utils.get_rise_set_intervals(self.request_dict)
+        with self.settings(RISE_SET_POOL_SIZE=0):
+            self.assertEqual(rise_set_utils.get_rise_set_intervals(self.request_dict), intervals)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestDarkIntervalCalendar(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.start = datetime(2017, 5, 1, tzinfo=timezone.utc)
+        self.end = datetime(2017, 8, 1, tzinfo=timezone.utc)
+
+    def tearDown(self):
+        rise_set_utils.cache.clear()
+        super().tearDown()
+
+    def test_calendar_matches_direct_computation(self):
+        query_start = datetime(2017, 5, 5, 3, 30, tzinfo=timezone.utc)
+        query_end = datetime(2017, 5, 9, 17, tzinfo=timezone.utc)
+        direct = rise_set_utils.get_site_rise_set_intervals(query_start, query_end, 'tst')
+        rise_set_utils.update_site_dark_interval_calendar('tst', self.start, self.end)
+        with patch('valhalla.common.rise_set_utils.compute_site_dark_intervals') as mock_compute:
+            self.assertEqual(rise_set_utils.get_site_rise_set_intervals(query_start, query_end, 'tst'), direct)
+            self.assertFalse(mock_compute.called)
+
+    def test_query_outside_calendar_is_computed(self):
+        rise_set_utils.update_site_dark_interval_calendar('tst', self.start, self.end)
+        query_start = datetime(2017, 7, 30, tzinfo=timezone.utc)
+        query_end = datetime(2017, 8, 3, tzinfo=timezone.utc)
+        with patch('valhalla.common.rise_set_utils.compute_site_dark_intervals') as mock_compute:
+            rise_set_utils.get_site_rise_set_intervals(query_start, query_end, 'tst')
+            mock_compute.assert_called_once_with(ANY, query_start, query_end)
+
+    def test_calendar_is_extended_from_its_end(self):
+        rise_set_utils.update_site_dark_interval_calendar('tst', self.start, self.end)
+        new_start = datetime(2017, 6, 1, tzinfo=timezone.utc)
+        new_end = datetime(2017, 10, 1, tzinfo=timezone.utc)
+        with patch('valhalla.common.rise_set_utils.compute_site_dark_intervals',
+                   wraps=rise_set_utils.compute_site_dark_intervals) as mock_compute:
+            rise_set_utils.update_site_dark_interval_calendar('tst', new_start, new_end)
+            mock_compute.assert_called_once_with(ANY, self.end, new_end)
+            site_detail = mock_compute.call_args[0][0]
+        self.assertEqual(rise_set_utils.get_site_rise_set_intervals(new_start, new_end, 'tst'),
+                         rise_set_utils.compute_site_dark_intervals(site_detail, new_start, new_end))
+
+    def test_unknown_site_has_no_calendar(self):
+        self.assertIsNone(rise_set_utils.update_site_dark_interval_calendar('bpl', self.start, self.end))
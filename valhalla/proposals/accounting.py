@@ -2,6 +2,8 @@ import logging
 import requests
 from django.conf import settings
 
+from valhalla.common.http_client import pond_client
+
 logger = logging.getLogger(__name__)
 
 
@@ -38,7 +40,7 @@ def query_pond(proposal_id, start, end, telescope_class, too):
         settings.POND_URL, proposal_id, start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S'),
         telescope_class, too
     )
-    response = requests.get(url)
+    response = pond_client.get(url)
     response.raise_for_status()
     if too:
         return response.json()['block_bounded_attempted_hours']
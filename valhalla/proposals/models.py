@@ -8,6 +8,7 @@ from collections import namedtuple
 import logging
 
 from valhalla.celery import send_mail
+from valhalla.common.loaded_fields import LoadedFieldsMixin
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +34,7 @@ class TimeAllocationGroup(models.Model):
         return self.id
 
 
-class Proposal(models.Model):
+class Proposal(LoadedFieldsMixin, models.Model):
     id = models.CharField(max_length=255, primary_key=True)
     active = models.BooleanField(default=True)
     title = models.CharField(max_length=255, default='', blank=True)
@@ -44,6 +45,9 @@ class Proposal(models.Model):
     public = models.BooleanField(default=False)
     users = models.ManyToManyField(User, through='Membership')
 
+    # Its user requests leave or rejoin the schedulable set when this changes
+    loaded_fields = ('active',)
+
     class Meta:
         ordering = ('title',)
 
@@ -86,7 +90,7 @@ class Proposal(models.Model):
 TimeAllocationKey = namedtuple('TimeAllocationKey', ['semester', 'telescope_class'])
 
 
-class TimeAllocation(models.Model):
+class TimeAllocation(LoadedFieldsMixin, models.Model):
     TELESCOPE_CLASSES = (
         ('2m0', '2m0'),
         ('1m0', '1m0'),
@@ -104,6 +108,9 @@ class TimeAllocation(models.Model):
     proposal = models.ForeignKey(Proposal)
     telescope_class = models.CharField(max_length=20, choices=TELESCOPE_CLASSES)
 
+    # Whether its user requests have time left to be scheduled depends on these
+    loaded_fields = ('std_allocation', 'std_time_used', 'too_allocation', 'too_time_used')
+
     def __str__(self):
         return 'Timeallocation for {0}-{1}'.format(self.proposal, self.semester)
 
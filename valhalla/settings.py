@@ -209,6 +209,33 @@ SERVER_EMAIL = DEFAULT_FROM_EMAIL
 ELASTICSEARCH_URL = os.getenv('ELASTICSEARCH_URL', 'http://localhost')
 POND_URL = os.getenv('POND_URL', 'http://localhost')
 CONFIGDB_URL = os.getenv('CONFIGDB_URL', 'http://localhost')
+CONFIGDB_FALLBACK_DIR = os.getenv('CONFIGDB_FALLBACK_DIR', '')
+CONFIGDB_SOFT_TTL = int(os.getenv('CONFIGDB_SOFT_TTL', 300))
+CONFIGDB_HARD_TTL = int(os.getenv('CONFIGDB_HARD_TTL', 86400))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 60))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 2))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', 0.5))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv('CIRCUIT_BREAKER_THRESHOLD', 5))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.getenv('CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+RISE_SET_POOL_SIZE = int(os.getenv('RISE_SET_POOL_SIZE', 0))
+RISE_SET_POOL_THRESHOLD = int(os.getenv('RISE_SET_POOL_THRESHOLD', 12))
+RISE_SET_MEMORY_CACHE_SIZE = int(os.getenv('RISE_SET_MEMORY_CACHE_SIZE', 5000))
+EPHEMERIS_STEP = int(os.getenv('EPHEMERIS_STEP', 3600))
+EPHEMERIS_DAYS = int(os.getenv('EPHEMERIS_DAYS', 30))
+SCHEDULABLE_REQUESTS_CHUNK_SIZE = int(os.getenv('SCHEDULABLE_REQUESTS_CHUNK_SIZE', 500))
+SCHEDULABLE_CHANGES_OVERLAP = int(os.getenv('SCHEDULABLE_CHANGES_OVERLAP', 60))
+SCHEDULABLE_TOMBSTONE_DAYS = int(os.getenv('SCHEDULABLE_TOMBSTONE_DAYS', 7))
+WINDOW_EXPIRATION_BATCH_SIZE = int(os.getenv('WINDOW_EXPIRATION_BATCH_SIZE', 1000))
+POND_BLOCK_CHUNK_SIZE = int(os.getenv('POND_BLOCK_CHUNK_SIZE', 500))
+POND_BLOCK_INGEST_CHUNK_SIZE = int(os.getenv('POND_BLOCK_INGEST_CHUNK_SIZE', 5000))
+ISDIRTY_ASYNC = os.getenv('ISDIRTY_ASYNC', 'false').lower() in ('1', 'true', 'yes')
+ISDIRTY_ASYNC_INTERVAL = float(os.getenv('ISDIRTY_ASYNC_INTERVAL', 60))
+ISDIRTY_LOCK_TIMEOUT = int(os.getenv('ISDIRTY_LOCK_TIMEOUT', 1800))
+SCHEDULABLE_SNAPSHOT_ENABLED = os.getenv('SCHEDULABLE_SNAPSHOT_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+SCHEDULABLE_SNAPSHOT_DIR = os.getenv('SCHEDULABLE_SNAPSHOT_DIR', os.path.join(MEDIA_ROOT, 'schedulable'))
+SCHEDULABLE_SNAPSHOT_GZIP = os.getenv('SCHEDULABLE_SNAPSHOT_GZIP', 'false').lower() in ('1', 'true', 'yes')
 
 REST_FRAMEWORK = {
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
@@ -249,6 +276,22 @@ CELERY_BEAT_SCHEDULE = {
     'expire-access-tokens-every-day': {
         'task': 'valhalla.accounts.tasks.expire_access_tokens',
         'schedule': 86400.0
+    },
+    'warm-configdb-cache-every-5-minutes': {
+        'task': 'valhalla.userrequests.tasks.warm_configdb_cache',
+        'schedule': 300.0
+    },
+    'update-dark-intervals-every-day': {
+        'task': 'valhalla.userrequests.tasks.update_dark_interval_calendars',
+        'schedule': 86400.0
+    },
+    'prune-tombstones-every-day': {
+        'task': 'valhalla.userrequests.tasks.prune_tombstones',
+        'schedule': 86400.0
+    },
+    'ingest-pond-blocks': {
+        'task': 'valhalla.userrequests.tasks.ingest_pond_blocks',
+        'schedule': ISDIRTY_ASYNC_INTERVAL
     }
 }
 try:
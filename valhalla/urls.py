@@ -9,7 +9,7 @@ from django.conf.urls.static import static
 from valhalla.userrequests.viewsets import RequestViewSet, UserRequestViewSet, DraftUserRequestViewSet
 from valhalla.userrequests.views import TelescopeStatesView, TelescopeAvailabilityView, AirmassView
 from valhalla.userrequests.views import InstrumentsInformationView, UserRequestStatusIsDirty
-from valhalla.userrequests.views import ContentionView, PressureView, UserRequestListView
+from valhalla.userrequests.views import ContentionView, PressureView, UserRequestListView, PondIngestionStatusView
 from valhalla.proposals.viewsets import ProposalViewSet, SemesterViewSet
 from valhalla.accounts.views import ProfileApiView
 import valhalla.accounts.urls as accounts_urls
@@ -32,6 +32,7 @@ api_urlpatterns = [
     url(r'profile/', ProfileApiView.as_view(), name='profile'),
     url(r'airmass/', AirmassView.as_view(), name='airmass'),
     url(r'instruments/', InstrumentsInformationView.as_view(), name='instruments_information'),
+    url(r'isDirty/status/', PondIngestionStatusView.as_view(), name='isDirty_status'),
     url(r'isDirty/', UserRequestStatusIsDirty.as_view(), name='isDirty'),
     url(r'contention/(?P<instrument_name>.+)/', ContentionView.as_view(), name='contention'),
     url(r'pressure/', PressureView.as_view(), name='pressure'),
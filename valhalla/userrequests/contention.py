@@ -3,7 +3,9 @@ from datetime import timedelta
 import math
 
 from valhalla.userrequests.models import Request
-from valhalla.common.rise_set_utils import get_rise_set_intervals, get_site_rise_set_intervals
+from valhalla.userrequests.request_dicts import get_request_dicts
+from valhalla.userrequests.duration_utils import get_request_duration
+from valhalla.common.rise_set_utils import get_rise_set_intervals_by_site, get_site_rise_set_intervals
 from valhalla.common.configdb import configdb
 
 
@@ -21,19 +23,30 @@ class Contention(object):
             state='PENDING',
             molecules__instrument_name=instrument_name,
             target__type='SIDEREAL'
-        ).prefetch_related(
-            'molecules', 'windows', 'target', 'constraints', 'location', 'user_request', 'user_request__proposal'
         ).distinct()
 
+    def _durations(self):
+        '''
+            Yields the target ra, proposal and duration of each request. Stored durations are read in a single query,
+            and only requests made before durations were stored have theirs computed.
+        '''
+        requests = Request.objects.filter(id__in=self.requests.values('id'))
+        yield from requests.filter(stored_duration__isnull=False).values_list(
+            'target__ra', 'user_request__proposal', 'stored_duration'
+        )
+        unstored = requests.filter(stored_duration__isnull=True)
+        proposals = dict(unstored.values_list('id', 'user_request__proposal'))
+        for request_dict in get_request_dicts(unstored).values():
+            yield request_dict['target']['ra'], proposals[request_dict['id']], get_request_duration(request_dict)
+
     def _binned_durations_by_proposal_and_ra(self):
         ra_bins = [{} for x in range(0, 24)]
-        for request in self.requests:
-            ra = math.floor(request.target.ra / 15)
-            proposal_id = request.user_request.proposal.id
+        for ra, proposal_id, duration in self._durations():
+            ra = math.floor(ra / 15)
             if not ra_bins[ra].get(proposal_id):
-                ra_bins[ra][proposal_id] = request.duration
+                ra_bins[ra][proposal_id] = duration
             else:
-                ra_bins[ra][proposal_id] += request.duration
+                ra_bins[ra][proposal_id] += duration
         return ra_bins
 
     def _anonymize(self, data):
@@ -74,9 +87,7 @@ class Pressure(object):
         if instrument_name:
             requests = requests.filter(molecules__instrument_name=instrument_name)
 
-        return requests.prefetch_related(
-            'molecules', 'windows', 'target', 'constraints', 'location', 'user_request', 'user_request__proposal'
-        ).distinct()
+        return requests.prefetch_related('molecules', 'location', 'user_request').distinct()
 
     def _telescopes(self, instrument_name):
         if instrument_name not in self.telescopes:
@@ -117,14 +128,32 @@ class Pressure(object):
                     n_telescopes += sum([1 for t in self._telescopes(instrument_name) if t.site == site])
         return n_telescopes
 
-    def _visible_intervals(self, request):
+    def _request_dicts(self, requests):
+        return get_request_dicts(Request.objects.filter(id__in=[request.id for request in requests]))
+
+    def _rise_set_intervals(self, request_dicts):
+        # The targets are all sidereal, so this computes every request's intervals in one batch
+        intervals_by_site = get_rise_set_intervals_by_site(list(request_dicts.values()), self.site or '')
+        return dict(zip(request_dicts.keys(), intervals_by_site))
+
+    def _duration(self, request, request_dict):
+        # A request made before durations were stored gets its duration from the dict
+        if request.stored_duration is None:
+            return get_request_duration(request_dict)
+        return request.stored_duration
+
+    def _visible_intervals(self, request, rise_set_intervals=None, duration=None):
+        if rise_set_intervals is None:
+            rise_set_intervals = self._rise_set_intervals(self._request_dicts([request]))[request.id]
+        if duration is None:
+            duration = request.duration
         visible_intervals = {}
         for site in self.sites:
             if not request.location.site or request.location.site == site['code']:
-                intervals = get_rise_set_intervals(request.as_dict, site['code'])
+                intervals = rise_set_intervals.get(site['code'], [])
                 for r, s in intervals:
                     effective_rise = max(r, self.now)
-                    if s > self.now and (s-effective_rise).seconds >= request.duration:
+                    if s > self.now and (s-effective_rise).seconds >= duration:
                         if site['code'] in visible_intervals:
                             visible_intervals[site['code']].append((effective_rise, s))
                         else:
@@ -141,15 +170,19 @@ class Pressure(object):
         quarter_hour_bins = [{} for x in range(0, 24 * 4)]
         bin_start_times = self._time_bins()
 
-        for request in self.requests:
-            site_intervals = self._visible_intervals(request)
+        requests = list(self.requests)
+        request_dicts = self._request_dicts(requests)
+        rise_set_intervals = self._rise_set_intervals(request_dicts)
+        for request in requests:
+            duration = self._duration(request, request_dicts[request.id])
+            site_intervals = self._visible_intervals(request, rise_set_intervals[request.id], duration)
             total_time_visible = self._time_visible(site_intervals)
             instrument_name = request.molecules.all()[0].instrument_name
 
             if total_time_visible < 1:
                 continue
 
-            base_pressure = request.duration / total_time_visible
+            base_pressure = duration / total_time_visible
             for i, bin_start in enumerate(bin_start_times):
                 n_telescopes = self._n_possible_telescopes(bin_start, site_intervals, instrument_name)
 
@@ -157,7 +190,7 @@ class Pressure(object):
                     continue
 
                 pressure = base_pressure / n_telescopes
-                proposal = request.user_request.proposal.id
+                proposal = request.user_request.proposal_id
                 if not quarter_hour_bins[i].get(proposal):
                     quarter_hour_bins[i][proposal] = pressure
                 else:
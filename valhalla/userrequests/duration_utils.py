@@ -42,14 +42,16 @@ def get_num_filter_changes(molecules):
     return len(list(itertools.groupby([mol.get('filter', '') for mol in molecules])))
 
 
-def get_molecule_duration_per_exposure(molecule_dict):
-    total_overhead_per_exp = configdb.get_exposure_overhead(molecule_dict['instrument_name'], molecule_dict['bin_x'])
+def get_molecule_duration_per_exposure(molecule_dict, overheads=None):
+    if overheads is None:
+        overheads = configdb.get_overheads()
+    total_overhead_per_exp = overheads.exposure_overhead(molecule_dict['instrument_name'], molecule_dict['bin_x'])
     mol_duration_per_exp = molecule_dict['exposure_time'] + total_overhead_per_exp
     return mol_duration_per_exp
 
 
-def get_molecule_duration(molecule_dict):
-    mol_duration_per_exp = get_molecule_duration_per_exposure(molecule_dict)
+def get_molecule_duration(molecule_dict, overheads=None):
+    mol_duration_per_exp = get_molecule_duration_per_exposure(molecule_dict, overheads)
     mol_duration = molecule_dict['exposure_count'] * mol_duration_per_exp
     duration = mol_duration + PER_MOLECULE_GAP + PER_MOLECULE_STARTUP_TIME
 
@@ -57,10 +59,11 @@ def get_molecule_duration(molecule_dict):
 
 
 def get_request_duration_dict(request_dict):
+    overheads = configdb.get_overheads()
     req_durations = {'requests': []}
     for req in request_dict:
-        req_info = {'duration': get_request_duration(req)}
-        mol_durations = [{'duration': get_molecule_duration_per_exposure(mol)} for mol in req['molecules']]
+        req_info = {'duration': get_request_duration(req, overheads)}
+        mol_durations = [{'duration': get_molecule_duration_per_exposure(mol, overheads)} for mol in req['molecules']]
         req_info['molecules'] = mol_durations
         req_info['largest_interval'] = get_largest_interval(get_rise_set_intervals(req)).total_seconds()
         req_info['largest_interval'] -= (PER_MOLECULE_STARTUP_TIME + PER_MOLECULE_GAP)
@@ -93,9 +96,10 @@ def get_max_ipp_for_userrequest(userrequest_dict):
 
 
 def get_request_duration_sum(userrequest_dict):
+    overheads = configdb.get_overheads()
     duration_sum = {}
     for req in userrequest_dict['requests']:
-        duration = get_request_duration(req)
+        duration = get_request_duration(req, overheads)
         tak = get_time_allocation_key(
             telescope_class=req['location']['telescope_class'],
             min_window_time=min([w['start'] for w in req['windows']]),
@@ -107,28 +111,30 @@ def get_request_duration_sum(userrequest_dict):
     return duration_sum
 
 
-def get_num_exposures(molecule_dict, time_available):
-    mol_duration_per_exp = get_molecule_duration_per_exposure(molecule_dict)
+def get_num_exposures(molecule_dict, time_available, overheads=None):
+    mol_duration_per_exp = get_molecule_duration_per_exposure(molecule_dict, overheads)
     exposure_time = time_available.total_seconds() - PER_MOLECULE_GAP - PER_MOLECULE_STARTUP_TIME
     num_exposures = exposure_time // mol_duration_per_exp
 
     return max(1, num_exposures)
 
 
-def get_request_duration(request_dict):
+def get_request_duration(request_dict, overheads=None):
     # calculate the total time needed by the request, based on its instrument and exposures
-    request_overheads = configdb.get_request_overheads(request_dict['molecules'][0]['instrument_name'])
-    duration = sum([get_molecule_duration(m) for m in request_dict['molecules']])
-    if configdb.is_spectrograph(request_dict['molecules'][0]['instrument_name']):
-        duration += get_num_mol_changes(request_dict['molecules']) * request_overheads['config_change_time']
+    if overheads is None:
+        overheads = configdb.get_overheads()
+    request_overheads = overheads.request_overheads(request_dict['molecules'][0]['instrument_name'])
+    duration = sum([get_molecule_duration(m, overheads) for m in request_dict['molecules']])
+    if request_overheads.is_spectrograph:
+        duration += get_num_mol_changes(request_dict['molecules']) * request_overheads.config_change_time
 
         for molecule in request_dict['molecules']:
             if molecule['acquire_mode'].upper() != 'OFF' and molecule['type'].upper() in ['SPECTRUM', 'NRES_SPECTRUM']:
-                duration += request_overheads['acquire_exposure_time'] + request_overheads['acquire_processing_time']
+                duration += request_overheads.acquire_exposure_time + request_overheads.acquire_processing_time
     else:
-        duration += get_num_filter_changes(request_dict['molecules']) * request_overheads['filter_change_time']
+        duration += get_num_filter_changes(request_dict['molecules']) * request_overheads.filter_change_time
 
-    duration += request_overheads['front_padding']
+    duration += request_overheads.front_padding
     duration = ceil(duration)
 
     return duration
@@ -152,6 +158,7 @@ def get_time_allocation_key(telescope_class, min_window_time, max_window_time):
 
 
 def get_total_duration_dict(userrequest_dict):
+    overheads = configdb.get_overheads()
     durations = []
     for request in userrequest_dict['requests']:
         min_window_time = min([window['start'] for window in request['windows']])
@@ -160,7 +167,7 @@ def get_total_duration_dict(userrequest_dict):
                                       min_window_time,
                                       max_window_time
                                       )
-        duration = get_request_duration(request)
+        duration = get_request_duration(request, overheads)
         durations.append((tak, duration))
     # check the proposal has a time allocation with enough time for all requests depending on operator
     total_duration = {}
@@ -0,0 +1,127 @@
+'''
+    Builds the output of UserRequestSerializer and RequestSerializer from the dicts of request_dicts, without DRF's
+    per object field machinery. Which fields are output and how each is represented is read from those serializers
+    once, so the output stays the same as theirs. These are read only, anything written still goes through the
+    serializers.
+'''
+from django.contrib.auth.models import User
+from rest_framework import serializers, ISO_8601
+from rest_framework.settings import api_settings
+
+from valhalla.userrequests.request_dicts import get_user_request_dicts, get_request_dicts
+from valhalla.userrequests.duration_utils import get_request_duration
+from valhalla.userrequests.serializers import (UserRequestSerializer, RequestSerializer, LocationSerializer,
+                                               ConstraintsSerializer, TargetSerializer, MoleculeSerializer,
+                                               WindowSerializer)
+
+
+def represent_datetime(value):
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def represent_as_is(value):
+    return value
+
+
+# Fields whose to_representation amounts to these for the values the database gives back. Related and nested fields
+# are filled in already represented.
+REPRESENTATIONS = {
+    serializers.IntegerField: int,
+    serializers.FloatField: float,
+    serializers.CharField: str,
+    serializers.ChoiceField: represent_as_is,
+    serializers.ReadOnlyField: represent_as_is,
+    serializers.PrimaryKeyRelatedField: represent_as_is,
+    serializers.StringRelatedField: represent_as_is,
+}
+
+_fields = {}
+_target_fields = {}
+
+
+def get_representation(field):
+    if isinstance(field, serializers.BaseSerializer):
+        return represent_as_is
+    if type(field) is serializers.DateTimeField:
+        if getattr(field, 'format', api_settings.DATETIME_FORMAT).lower() == ISO_8601:
+            return represent_datetime
+    return REPRESENTATIONS.get(type(field), field.to_representation)
+
+
+def get_fields(serializer_class):
+    '''The (name, representation) of each field the serializer outputs, in its order'''
+    if serializer_class not in _fields:
+        _fields[serializer_class] = tuple(
+            (name, get_representation(field)) for name, field in serializer_class().fields.items()
+            if not field.write_only
+        )
+    return _fields[serializer_class]
+
+
+def get_target_fields(target_type, scheme):
+    '''The fields TargetSerializer outputs for a target of this type and scheme'''
+    if (target_type, scheme) not in _target_fields:
+        target_helper = TargetSerializer.TYPE_HELPER_MAP[target_type]({'type': target_type, 'scheme': scheme})
+        _target_fields[(target_type, scheme)] = target_helper.fields
+    return _target_fields[(target_type, scheme)]
+
+
+def represent(row, serializer_class):
+    '''
+        The serializer's output for row, a dict of field name to value. Fields missing from the row are left out, as
+        the serializer leaves out attributes the instance does not have.
+    '''
+    return {
+        name: None if row[name] is None else representation(row[name])
+        for name, representation in get_fields(serializer_class) if name in row
+    }
+
+
+def represent_target(target_dict):
+    data = represent(target_dict, TargetSerializer)
+    return {key: data.get(key) for key in get_target_fields(data['type'], data.get('scheme'))}
+
+
+def represent_request(request_dict):
+    location = represent(request_dict['location'], LocationSerializer)
+    row = dict(
+        request_dict,
+        location={key: value for key, value in location.items() if value},
+        constraints=represent(request_dict['constraints'], ConstraintsSerializer),
+        target=represent_target(request_dict['target']),
+        molecules=[represent(molecule, MoleculeSerializer) for molecule in request_dict['molecules']],
+        windows=[represent(window, WindowSerializer) for window in request_dict['windows']],
+        duration=request_dict['stored_duration']
+    )
+    if row['duration'] is None:
+        row['duration'] = get_request_duration(request_dict)
+    return represent(row, RequestSerializer)
+
+
+def serialize_user_request_dicts(user_request_dicts):
+    '''UserRequestSerializer's output for each of user_request_dicts, which are loaded with all_fields'''
+    user_request_dicts = list(user_request_dicts)
+    submitters = dict(User.objects.filter(
+        id__in={user_request_dict['submitter'] for user_request_dict in user_request_dicts}
+    ).values_list('id', User.USERNAME_FIELD))
+    return [
+        represent(dict(
+            user_request_dict,
+            requests=[represent_request(request_dict) for request_dict in user_request_dict['requests']],
+            submitter=submitters[user_request_dict['submitter']]
+        ), UserRequestSerializer)
+        for user_request_dict in user_request_dicts
+    ]
+
+
+def serialize_user_requests(user_requests):
+    '''UserRequestSerializer's output for each of a queryset of user requests, in the queryset's order'''
+    return serialize_user_request_dicts(get_user_request_dicts(user_requests, all_fields=True).values())
+
+
+def serialize_requests(requests):
+    '''RequestSerializer's output for each of a queryset of requests, in the queryset's order'''
+    return [represent_request(request_dict) for request_dict in get_request_dicts(requests, all_fields=True).values()]
@@ -0,0 +1,77 @@
+from datetime import timedelta
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from valhalla.proposals.models import Proposal, TimeAllocationGroup
+from valhalla.userrequests.models import UserRequest, Request, Target, Location, Constraints, Window, Molecule
+from valhalla.userrequests.serializers import UserRequestSerializer
+from valhalla.userrequests.fast_serializers import serialize_user_requests
+
+
+class Command(BaseCommand):
+    help = (
+        'Times serializing user requests with UserRequestSerializer against the read only fast path. The user '
+        'requests are created in a transaction that is rolled back afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=10000, help='Number of user requests to serialize')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            user_requests = self.create_user_requests(options['count'])
+
+            start = time.perf_counter()
+            slow = UserRequestSerializer(user_requests.prefetch_related(
+                'requests', 'requests__windows', 'requests__molecules', 'requests__constraints',
+                'requests__target', 'requests__location'
+            ), many=True).data
+            slow_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            fast = serialize_user_requests(user_requests)
+            fast_time = time.perf_counter() - start
+
+            if [dict(ur) for ur in slow] != fast:
+                self.stderr.write('The outputs of the serializers differ')
+            self.stdout.write('UserRequestSerializer: {:.3f}s'.format(slow_time))
+            self.stdout.write('Fast path: {:.3f}s'.format(fast_time))
+            transaction.set_rollback(True)
+
+    def create_user_requests(self, count):
+        user = User.objects.create(username='benchmark_serializers')
+        tag = TimeAllocationGroup.objects.create(id='benchmark')
+        proposal = Proposal.objects.create(id='benchmark_serializers', tag=tag)
+        UserRequest.objects.bulk_create(
+            UserRequest(submitter=user, proposal=proposal, group_id='benchmark {}'.format(index),
+                        observation_type='NORMAL', operator='SINGLE', ipp_value=1.0)
+            for index in range(count)
+        )
+        user_requests = UserRequest.objects.filter(proposal=proposal).order_by('id')
+        Request.objects.bulk_create(
+            Request(user_request_id=ur_id, stored_duration=600)
+            for ur_id in user_requests.values_list('id', flat=True)
+        )
+        request_ids = list(Request.objects.filter(user_request__in=user_requests).values_list('id', flat=True))
+        now = timezone.now()
+        Target.objects.bulk_create(
+            Target(request_id=request_id, name='fake target', type='SIDEREAL', ra=34.4, dec=20)
+            for request_id in request_ids
+        )
+        Location.objects.bulk_create(
+            Location(request_id=request_id, telescope_class='1m0') for request_id in request_ids
+        )
+        Constraints.objects.bulk_create(Constraints(request_id=request_id) for request_id in request_ids)
+        Window.objects.bulk_create(
+            Window(request_id=request_id, start=now, end=now + timedelta(days=1)) for request_id in request_ids
+        )
+        Molecule.objects.bulk_create(
+            Molecule(request_id=request_id, type='EXPOSE', instrument_name='1M0-SCICAM-SBIG', filter='air',
+                     exposure_time=30, exposure_count=1)
+            for request_id in request_ids
+        )
+        return user_requests
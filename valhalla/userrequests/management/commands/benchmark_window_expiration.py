@@ -0,0 +1,59 @@
+from datetime import timedelta
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from valhalla.proposals.models import Proposal, TimeAllocationGroup
+from valhalla.userrequests.models import UserRequest, Request, Window
+from valhalla.userrequests.state_changes import update_request_states_for_window_expiration
+
+
+class Command(BaseCommand):
+    help = (
+        'Times expiring the windows of pending requests, of which every other one has expired. The requests are '
+        'created in a transaction that is rolled back afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100000, help='Number of pending requests')
+        parser.add_argument('--requests-per-user-request', type=int, default=5,
+                            help='Number of requests in each user request')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.create_requests(options['count'], options['requests_per_user_request'])
+
+            start = time.perf_counter()
+            update_request_states_for_window_expiration()
+            elapsed = time.perf_counter() - start
+
+            self.stdout.write('Expired {} of {} requests in {:.3f}s'.format(
+                Request.objects.filter(state='WINDOW_EXPIRED').count(), options['count'], elapsed
+            ))
+            transaction.set_rollback(True)
+
+    def create_requests(self, count, requests_per_user_request):
+        user = User.objects.create(username='benchmark_window_expiration')
+        tag = TimeAllocationGroup.objects.create(id='benchmark')
+        proposal = Proposal.objects.create(id='benchmark_window_expiration', tag=tag)
+        UserRequest.objects.bulk_create(
+            UserRequest(submitter=user, proposal=proposal, group_id='benchmark {}'.format(index),
+                        observation_type='NORMAL', operator='MANY', ipp_value=1.0)
+            for index in range(0, count, requests_per_user_request)
+        )
+        ur_ids = list(UserRequest.objects.filter(proposal=proposal).order_by('id').values_list('id', flat=True))
+        Request.objects.bulk_create(
+            Request(user_request_id=ur_ids[index // requests_per_user_request]) for index in range(count)
+        )
+        now = timezone.now()
+        request_ids = Request.objects.filter(user_request__proposal=proposal).order_by('id').values_list(
+            'id', flat=True
+        )
+        Window.objects.bulk_create(
+            Window(request_id=request_id, start=now - timedelta(days=2),
+                   end=now - timedelta(days=1) if index % 2 == 0 else now + timedelta(days=1))
+            for index, request_id in enumerate(request_ids)
+        )
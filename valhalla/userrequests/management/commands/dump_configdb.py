@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from valhalla.common.configdb import configdb
+
+
+class Command(BaseCommand):
+    help = 'Writes the configdb sites and filterwheels into a directory that CONFIGDB_URL can point at'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory to write the snapshot to')
+
+    def handle(self, *args, **options):
+        for path in configdb.dump(options['directory']):
+            self.stdout.write('Wrote {}'.format(path))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from valhalla.userrequests.models import UserRequest
+from valhalla.userrequests.state_changes import TERMINAL_STATES
+from valhalla.userrequests.request_dicts import get_user_request_dicts
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored request durations and user request totals, e.g. after the configdb overheads change'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Include user requests in a terminal state')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of user requests loaded at a time')
+
+    def handle(self, *args, **options):
+        user_requests = UserRequest.objects.all()
+        if not options['all']:
+            user_requests = user_requests.exclude(state__in=TERMINAL_STATES)
+
+        ids = list(user_requests.order_by('id').values_list('id', flat=True))
+        for index in range(0, len(ids), options['chunk_size']):
+            chunk = UserRequest.objects.filter(id__in=ids[index:index + options['chunk_size']])
+            user_request_dicts = get_user_request_dicts(chunk)
+            for user_request in chunk:
+                user_request.update_durations(user_request_dicts[user_request.id])
+        self.stdout.write('Recomputed durations of {} user requests'.format(len(ids)))
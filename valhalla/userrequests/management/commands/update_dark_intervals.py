@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from valhalla.userrequests.tasks import update_dark_interval_calendars
+
+
+class Command(BaseCommand):
+    help = 'Precomputes the dark interval calendar of every site for the current and next semester'
+
+    def handle(self, *args, **options):
+        update_dark_interval_calendars()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 17:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposals', '0007_remove_semester_public'),
+        ('userrequests', '0016_auto_20171009_1746'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRequestTotalDuration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('telescope_class', models.CharField(max_length=20)),
+                ('duration', models.PositiveIntegerField()),
+                ('semester', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='proposals.Semester')),
+                ('user_request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='total_durations', to='userrequests.UserRequest')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='request',
+            name='stored_duration',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='userrequesttotalduration',
+            unique_together=set([('user_request', 'semester', 'telescope_class')]),
+        ),
+    ]
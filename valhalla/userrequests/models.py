@@ -4,11 +4,14 @@ from django.utils.functional import cached_property
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.urls import reverse
 from django.conf import settings
+from django.utils import timezone
 from django.forms.models import model_to_dict
 import requests
 import logging
 
-from valhalla.proposals.models import Proposal, TimeAllocationKey
+from valhalla.proposals.models import Proposal, TimeAllocationKey, Semester
+from valhalla.common.http_client import pond_client
+from valhalla.common.loaded_fields import LoadedFieldsMixin
 from valhalla.userrequests.external_serializers import BlockSerializer
 from valhalla.common.rise_set_utils import get_rise_set_target
 from valhalla.userrequests.duration_utils import (get_request_duration, get_molecule_duration, get_total_duration_dict,
@@ -17,7 +20,20 @@ from valhalla.userrequests.duration_utils import (get_request_duration, get_mole
 logger = logging.getLogger(__name__)
 
 
-class UserRequest(models.Model):
+class LoadedStateMixin(LoadedFieldsMixin):
+    '''
+        Remembers the state an instance was loaded from the database with, or last saved with, so the state change
+        handlers know the previous state without reading the row again
+    '''
+    loaded_fields = ('state',)
+
+    @property
+    def loaded_state(self):
+        '''The state in the database as of when the instance was loaded or last saved'''
+        return self.get_loaded_value('state')
+
+
+class UserRequest(LoadedStateMixin, models.Model):
     NORMAL = 'NORMAL'
     TOO = 'TARGET_OF_OPPORTUNITY'
 
@@ -85,10 +101,58 @@ class UserRequest(models.Model):
 
     @property
     def total_duration(self):
+        total_durations = self.total_durations.all()
+        if total_durations:
+            return {
+                TimeAllocationKey(total.semester_id, total.telescope_class): total.duration
+                for total in total_durations
+            }
         return get_total_duration_dict(self.as_dict)
 
+    def update_durations(self, user_request_dict=None):
+        '''
+            Computes the duration of each request and the total per time allocation key from the current configdb
+            overheads, and stores them. user_request_dict is this user request's as_dict, if it is already loaded.
+        '''
+        user_request_dict = user_request_dict or self.as_dict
+        for request_dict in user_request_dict['requests']:
+            # Bumping modified puts the new duration into the scheduler's feed of changes
+            Request.objects.filter(pk=request_dict['id']).update(
+                stored_duration=get_request_duration(request_dict), modified=timezone.now()
+            )
+        self.total_durations.all().delete()
+        UserRequestTotalDuration.objects.bulk_create([
+            UserRequestTotalDuration(
+                user_request=self, semester_id=tak.semester, telescope_class=tak.telescope_class, duration=duration
+            )
+            for tak, duration in get_total_duration_dict(user_request_dict).items()
+        ])
+
 
-class Request(models.Model):
+class UserRequestTombstone(models.Model):
+    '''Records when a user request stopped being schedulable, so the scheduler's feed of changes can remove it'''
+    tracking_num = models.PositiveIntegerField(db_index=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return '{} at {}'.format(self.tracking_num, self.created)
+
+
+class UserRequestTotalDuration(models.Model):
+    '''The total duration of a user request's requests in one time allocation, stored when the user request is made'''
+    user_request = models.ForeignKey(UserRequest, related_name='total_durations', on_delete=models.CASCADE)
+    semester = models.ForeignKey(Semester, on_delete=models.CASCADE)
+    telescope_class = models.CharField(max_length=20)
+    duration = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('user_request', 'semester', 'telescope_class')
+
+    def __str__(self):
+        return '{} {} {}: {}s'.format(self.user_request_id, self.semester_id, self.telescope_class, self.duration)
+
+
+class Request(LoadedStateMixin, models.Model):
     STATE_CHOICES = (
         ('PENDING', 'PENDING'),
         ('SCHEDULED', 'SCHEDULED'),
@@ -114,6 +178,9 @@ class Request(models.Model):
     # Minimum completable block threshold (percentage, 0-100)
     completion_threshold = models.FloatField(default=90.0, validators=[MinValueValidator(0.0), MaxValueValidator(100.0)])
 
+    # Duration in seconds, stored when the request is made
+    stored_duration = models.PositiveIntegerField(null=True, blank=True, editable=False)
+
     class Meta:
         ordering = ('id',)
 
@@ -135,6 +202,8 @@ class Request(models.Model):
 
     @cached_property
     def duration(self):
+        if self.stored_duration is not None:
+            return self.stored_duration
         return get_request_duration(self.as_dict)
 
     @property
@@ -164,14 +233,14 @@ class Request(models.Model):
     @cached_property
     def blocks(self):
         try:
-            response = requests.get(
+            response = pond_client.get(
                 '{0}/pond/pond/block/request/{1}.json'.format(
                     settings.POND_URL, self.get_id_display().zfill(10)  # the pond hardcodes 0 padded strings... awesome
                 )
             )
             response.raise_for_status()
             return BlockSerializer(response.json(), many=True).data
-        except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
+        except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError, requests.exceptions.Timeout):
             logger.error('Could not connect to the pond.')
             return BlockSerializer([], many=True).data
 
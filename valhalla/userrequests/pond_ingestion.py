@@ -0,0 +1,180 @@
+'''
+    Pulls the pond blocks changed since the last pull and updates the states of their requests and user requests.
+    The blocks are parsed as the response streams in and reconciled POND_BLOCK_INGEST_CHUNK_SIZE at a time, with the
+    blocks reconciled so far saved after each chunk, so a pull that is cut off resumes without reconciling them again.
+
+    Each pull is recorded for the isDirty status API. With ISDIRTY_ASYNC the pulls run in a celery task, which counts
+    those that changed states so isDirty can report whether any did since the scheduler last asked.
+'''
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import timedelta
+import hashlib
+import logging
+import json
+import time
+
+from valhalla.common.http_client import pond_client
+from valhalla.common.json_stream import iter_response_json_array
+from valhalla.userrequests.state_changes import reconcile_pond_blocks
+
+logger = logging.getLogger(__name__)
+
+QUERY_TIME_KEY = 'isDirty_query_time'
+PROGRESS_KEY = 'isDirty_progress'
+STATUS_KEY = 'isDirty_status'
+LOCK_KEY = 'isDirty_lock'
+CHANGES_KEY = 'isDirty_changes'
+REPORTED_CHANGES_KEY = 'isDirty_reported_changes'
+
+
+def get_last_query_time():
+    '''The time of the last pull that finished, or a week ago if there was none'''
+    return cache.get(QUERY_TIME_KEY, timezone.now() - timedelta(days=7))
+
+
+def get_new_pond_blocks_url(since):
+    return settings.POND_URL + '/pond/pond/blocks/new/?since={}&using=default'.format(
+        since.strftime('%Y-%m-%dT%H:%M:%S')
+    )
+
+
+def get_block_fingerprint(block):
+    '''The id of the block and a digest of its contents, which changes whenever the pond modifies the block'''
+    digest = hashlib.sha1(json.dumps(block, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return str(block.get('id', digest)), digest
+
+
+def ingest_new_pond_blocks(since=None):
+    '''
+        Reconciles the pond blocks changed since `since`, or since the last pull that finished. If an earlier pull
+        from the same time was cut off, the blocks it already reconciled are skipped unless the pond modified them
+        since. Returns the number of blocks reconciled and skipped, the number of requests and user requests whose
+        states changed, and whether any did over this pull and those it resumed (is_dirty).
+    '''
+    if since is None:
+        since = get_last_query_time()
+    since_key = since.strftime('%Y-%m-%dT%H:%M:%S')
+    now = timezone.now()
+
+    progress = cache.get(PROGRESS_KEY)
+    if not progress or progress['since'] != since_key:
+        progress = {'since': since_key, 'reconciled': {}, 'is_dirty': False}
+    counts = {'blocks': 0, 'skipped': 0, 'requests_changed': 0, 'user_requests_changed': 0}
+
+    response = pond_client.get(get_new_pond_blocks_url(since), stream=True)
+    try:
+        response.raise_for_status()
+        chunk = []
+        for block in iter_response_json_array(response):
+            # The feed of blocks changed since a time can be reordered, and gain or change blocks, between pulls,
+            # so a block is only skipped if this exact version of it was reconciled
+            block_id, digest = get_block_fingerprint(block)
+            if progress['reconciled'].get(block_id) == digest:
+                counts['skipped'] += 1
+                continue
+            chunk.append((block_id, digest, block))
+            if len(chunk) >= settings.POND_BLOCK_INGEST_CHUNK_SIZE:
+                _reconcile_chunk(chunk, progress, counts)
+                chunk = []
+        if chunk:
+            _reconcile_chunk(chunk, progress, counts)
+    finally:
+        response.close()
+
+    if counts['skipped']:
+        logger.info('Resumed the pull of pond blocks since %s, skipping %d reconciled blocks', since_key,
+                    counts['skipped'])
+    counts['is_dirty'] = progress['is_dirty']
+    cache.set(QUERY_TIME_KEY, now, None)
+    cache.delete(PROGRESS_KEY)
+    return counts
+
+
+def _reconcile_chunk(chunk, progress, counts):
+    chunk_counts = reconcile_pond_blocks([block for block_id, digest, block in chunk])
+    counts['blocks'] += len(chunk)
+    counts['requests_changed'] += chunk_counts['requests_changed']
+    counts['user_requests_changed'] += chunk_counts['user_requests_changed']
+    progress['reconciled'].update((block_id, digest) for block_id, digest, block in chunk)
+    progress['is_dirty'] = bool(
+        progress['is_dirty'] or chunk_counts['requests_changed'] or chunk_counts['user_requests_changed']
+    )
+    cache.set(PROGRESS_KEY, progress, None)
+
+
+def run_pond_ingestion(since=None):
+    '''
+        Runs ingest_new_pond_blocks and records when it ran, how long it took and what it found, or the error it
+        raised, as the last run in the status
+    '''
+    started = timezone.now()
+    start = time.perf_counter()
+    last_success = (cache.get(STATUS_KEY) or {}).get('last_success')
+    run = {'started': started, 'since': since or get_last_query_time(), 'error': None}
+    try:
+        counts = ingest_new_pond_blocks(since)
+        run.update(counts)
+        last_success = started
+        return counts
+    except Exception as e:
+        run['error'] = repr(e)
+        raise
+    finally:
+        run['duration'] = time.perf_counter() - start
+        cache.set(STATUS_KEY, {'last_run': run, 'last_success': last_success}, None)
+
+
+def acquire_ingestion_lock():
+    '''Whether no other pull is running. The lock expires after ISDIRTY_LOCK_TIMEOUT in case its holder died'''
+    return cache.add(LOCK_KEY, timezone.now(), settings.ISDIRTY_LOCK_TIMEOUT)
+
+
+def release_ingestion_lock():
+    cache.delete(LOCK_KEY)
+
+
+def mark_dirty():
+    '''Counts a pull that changed states'''
+    cache.add(CHANGES_KEY, 0, None)
+    try:
+        cache.incr(CHANGES_KEY)
+    except ValueError:
+        # The count was evicted since it was added
+        cache.set(CHANGES_KEY, 1, None)
+
+
+def pop_is_dirty():
+    '''
+        Whether any pull changed states since the last time this was called. The changes counted is only ever
+        incremented, and what is recorded as reported is the count that was read, so a pull counted after the read is
+        reported by the next call instead of being lost.
+    '''
+    changes = cache.get(CHANGES_KEY, 0)
+    is_dirty = changes != cache.get(REPORTED_CHANGES_KEY, 0)
+    cache.set(REPORTED_CHANGES_KEY, changes, None)
+    return is_dirty
+
+
+def get_ingestion_status():
+    '''
+        The cursor the next pull starts from and how far it lags behind now in seconds, whether a pull is running and
+        how far a cut off one got, and the last run of a pull
+    '''
+    status = cache.get(STATUS_KEY) or {'last_run': None, 'last_success': None}
+    cursor = cache.get(QUERY_TIME_KEY)
+    status.update({
+        'async': settings.ISDIRTY_ASYNC,
+        'cursor': cursor,
+        'lag': (timezone.now() - cursor).total_seconds() if cursor else None,
+        'running_since': cache.get(LOCK_KEY),
+        'progress': _summarize_progress(cache.get(PROGRESS_KEY)),
+    })
+    return status
+
+
+def _summarize_progress(progress):
+    if not progress:
+        return None
+    return {'since': progress['since'], 'reconciled': len(progress['reconciled']), 'is_dirty': progress['is_dirty']}
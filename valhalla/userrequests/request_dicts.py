@@ -0,0 +1,60 @@
+'''
+    Builds the dicts of UserRequest.as_dict and Request.as_dict for many user requests or requests at once. Each model
+    is read with one .values() query instead of a model_to_dict per instance, so loading any number of user requests
+    takes the same handful of queries.
+'''
+from collections import OrderedDict
+
+from valhalla.userrequests.models import Request, Target, Location, Constraints, Window, Molecule
+
+SINGLE_CHILDREN = ((Target, 'target'), (Location, 'location'), (Constraints, 'constraints'))
+MANY_CHILDREN = ((Molecule, 'molecules'), (Window, 'windows'))
+
+
+def dict_fields(model, all_fields=False):
+    '''
+        The (attname, name) pairs of the fields model_to_dict reads, which are the editable ones, or of every concrete
+        field with all_fields
+    '''
+    return [
+        (field.attname, field.name) for field in model._meta.concrete_fields if field.editable or all_fields
+    ]
+
+
+def get_values(queryset, all_fields=False):
+    '''Yields a dict for each row of the queryset with the same keys and values as model_to_dict'''
+    fields = dict_fields(queryset.model, all_fields)
+    for row in queryset.values(*[attname for attname, _ in fields]):
+        yield {name: row[attname] for attname, name in fields}
+
+
+def get_request_dicts(requests, all_fields=False):
+    '''Returns an OrderedDict of request id to its as_dict for a queryset of requests, in the queryset's order'''
+    request_dicts = OrderedDict((row['id'], row) for row in get_values(requests, all_fields))
+    for request_dict in request_dicts.values():
+        for _, key in MANY_CHILDREN:
+            request_dict[key] = []
+
+    request_ids = requests.order_by().values('id')
+    for model, key in SINGLE_CHILDREN:
+        for row in get_values(model.objects.filter(request__in=request_ids), all_fields):
+            request_dicts[row['request']][key] = row
+    for model, key in MANY_CHILDREN:
+        for row in get_values(model.objects.filter(request__in=request_ids), all_fields):
+            request_dicts[row['request']][key].append(row)
+    return request_dicts
+
+
+def get_user_request_dicts(user_requests, all_fields=False):
+    '''
+        Returns an OrderedDict of user request id to its as_dict for a queryset of user requests, in the queryset's
+        order
+    '''
+    user_request_dicts = OrderedDict((row['id'], row) for row in get_values(user_requests, all_fields))
+    for user_request_dict in user_request_dicts.values():
+        user_request_dict['requests'] = []
+
+    requests = Request.objects.filter(user_request__in=user_requests.order_by().values('id'))
+    for request_dict in get_request_dicts(requests, all_fields).values():
+        user_request_dicts[request_dict['user_request']]['requests'].append(request_dict)
+    return user_request_dicts
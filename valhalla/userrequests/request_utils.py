@@ -5,6 +5,7 @@ from rise_set.astrometry import calculate_airmass_at_times
 from valhalla.common.configdb import configdb
 from valhalla.common.telescope_states import TelescopeStates, filter_telescope_states_by_intervals
 from valhalla.common.rise_set_utils import get_rise_set_target, get_rise_set_intervals
+from valhalla.common.batch_visibility import BatchTargets, get_airmasses
 
 MOLECULE_TYPE_DISPLAY = {
   'EXPOSE': 'Imaging',
@@ -75,10 +76,11 @@ def get_airmasses_for_request_at_sites(request_dict):
       telescope_code=request_dict['location'].get('telescope')
     )
 
-    rs_target = get_rise_set_target(request_dict['target'])
+    target_type = request_dict['target']['type'].upper()
+    rs_target = get_rise_set_target(request_dict['target']) if target_type == 'NON_SIDEREAL' else None
 
     data = {'airmass_data': {}}
-    if request_dict['target']['type'].upper() != 'SATELLITE':
+    if target_type != 'SATELLITE':
         for site_id, site_details in site_data.items():
             night_times = []
             site_lat = Angle(degrees=site_details['latitude'])
@@ -93,9 +95,14 @@ def get_airmasses_for_request_at_sites(request_dict):
                 if site_id not in data:
                     data['airmass_data'][site_id] = {}
                 data['airmass_data'][site_id]['times'] = [time.strftime('%Y-%m-%dT%H:%M') for time in night_times]
-                data['airmass_data'][site_id]['airmasses'] = calculate_airmass_at_times(
-                  night_times, rs_target, site_lat, site_lon, site_alt
-                )
+                if target_type == 'SIDEREAL':
+                    data['airmass_data'][site_id]['airmasses'] = get_airmasses(
+                      site_details, BatchTargets.from_request_dicts([request_dict]), night_times
+                    )[0].tolist()
+                else:
+                    data['airmass_data'][site_id]['airmasses'] = calculate_airmass_at_times(
+                      night_times, rs_target, site_lat, site_lon, site_alt
+                    )
                 data['airmass_limit'] = constraints['max_airmass']
 
     return data
@@ -0,0 +1,157 @@
+'''
+    Finds the User requests the scheduler can schedule, and keeps a snapshot of those of the current semester on disk
+    so the scheduler's polls can be served without running the queries again. The snapshot is written when the
+    schedulable set may have changed, and only becomes a new version when its contents did.
+'''
+from django.conf import settings
+from rest_framework.renderers import JSONRenderer
+import hashlib
+import logging
+import gzip
+import json
+import os
+import tempfile
+
+from valhalla.proposals.models import Semester, TimeAllocation, TimeAllocationKey
+from valhalla.userrequests.models import UserRequest, UserRequestTotalDuration
+from valhalla.userrequests.duration_utils import OVERHEAD_ALLOWANCE, get_total_duration_dict
+from valhalla.userrequests.state_changes import TERMINAL_STATES
+from valhalla.userrequests.request_dicts import get_user_request_dicts
+from valhalla.userrequests.fast_serializers import serialize_user_request_dicts
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PREFIX = 'schedulable_requests.'
+SNAPSHOT_POINTER = 'current.json'
+
+
+def get_schedulable_user_requests(start, end, user_requests=None):
+    '''
+        Yields the serialized schedulable User requests with a window starting between start and end, of user_requests
+        if given, loading SCHEDULABLE_REQUESTS_CHUNK_SIZE of them with their requests at a time so memory does not grow
+        with the number of User requests
+    '''
+    if user_requests is None:
+        user_requests = UserRequest.objects.all()
+    # Schedulable requests are not in a terminal state, are part of an active proposal,
+    # and have a window within this semester
+    schedulable = user_requests.exclude(state__in=TERMINAL_STATES).filter(
+        requests__windows__start__lte=end, requests__windows__start__gte=start, proposal__active=True
+    )
+    ur_ids = list(schedulable.distinct().values_list('id', flat=True))
+    # Every time allocation the User requests could draw on, read in one query
+    time_allocations = {
+        (ta.semester_id, ta.telescope_class, ta.proposal_id): ta
+        for ta in TimeAllocation.objects.filter(proposal__in=schedulable.order_by().values('proposal'))
+    }
+
+    for index in range(0, len(ur_ids), settings.SCHEDULABLE_REQUESTS_CHUNK_SIZE):
+        queryset = UserRequest.objects.filter(id__in=ur_ids[index:index + settings.SCHEDULABLE_REQUESTS_CHUNK_SIZE])
+
+        # user_request_dicts now contains a chunk of the schedulable URs and their associated requests and data
+        # Check that each request time available in its proposal still
+        user_request_dicts = get_user_request_dicts(queryset, all_fields=True)
+        total_durations = get_total_durations(queryset, user_request_dicts)
+        yield from serialize_user_request_dicts(
+            ur for ur in user_request_dicts.values()
+            if has_time_left(ur, total_durations[ur['id']], time_allocations)
+        )
+
+
+def get_total_durations(queryset, user_request_dicts):
+    '''
+        The total duration dict of each of the user_request_dicts by id. Those made before durations were stored
+        have theirs computed from their dicts.
+    '''
+    total_durations = {}
+    for total in UserRequestTotalDuration.objects.filter(user_request__in=queryset):
+        total_durations.setdefault(total.user_request_id, {})[
+            TimeAllocationKey(total.semester_id, total.telescope_class)
+        ] = total.duration
+    for ur in user_request_dicts.values():
+        if ur['id'] not in total_durations:
+            total_durations[ur['id']] = get_total_duration_dict(ur)
+    return total_durations
+
+
+def has_time_left(ur, total_duration_dict, time_allocations):
+    for tak, duration in total_duration_dict.items():
+        time_allocation = time_allocations.get((tak.semester, tak.telescope_class, ur['proposal']))
+        if time_allocation is None:
+            logger.warning('no time allocation in proposal {0} for ur {1} in {2}, skipping'.format(
+                ur['proposal'], ur['id'], tak
+            ))
+            continue
+        if ur['observation_type'] == UserRequest.NORMAL:
+            time_left = time_allocation.std_allocation - time_allocation.std_time_used
+        else:
+            time_left = time_allocation.too_allocation - time_allocation.too_time_used
+        if time_left * OVERHEAD_ALLOWANCE >= (duration / 3600.0):
+            return True
+        else:
+            logger.warning(
+                'not enough time left {0} in proposal {1} for ur {2} of duration {3}, skipping'.format(
+                    time_left, ur['proposal'], ur['id'], (duration / 3600.0)
+                )
+            )
+    return False
+
+
+def _write_file(path, content):
+    # Written next to its destination and renamed over it, so readers never see a partial file
+    descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+    with os.fdopen(descriptor, 'wb') as snapshot_file:
+        snapshot_file.write(content)
+    os.replace(tmp_path, path)
+
+
+def get_schedulable_snapshot():
+    '''
+        The current snapshot as a dict of its version, semester, path and whether it is gzipped, or None if there is
+        none yet
+    '''
+    try:
+        with open(os.path.join(settings.SCHEDULABLE_SNAPSHOT_DIR, SNAPSHOT_POINTER)) as pointer_file:
+            snapshot = json.load(pointer_file)
+    except (OSError, ValueError):
+        return None
+    snapshot['path'] = os.path.join(settings.SCHEDULABLE_SNAPSHOT_DIR, snapshot['filename'])
+    return snapshot
+
+
+def write_schedulable_snapshot():
+    '''
+        Writes the schedulable User requests of the current semester, as schedulable_requests returns them, to a new
+        version of the snapshot if they changed. Returns the current snapshot.
+    '''
+    semester = Semester.current_semesters().first()
+    if semester is None:
+        return None
+    content = JSONRenderer().render(list(get_schedulable_user_requests(semester.start, semester.end)))
+    version = hashlib.sha1(content).hexdigest()
+    compressed = settings.SCHEDULABLE_SNAPSHOT_GZIP
+
+    current = get_schedulable_snapshot()
+    if current and (current['version'], current['semester'], current['gzip']) == (version, semester.id, compressed):
+        return current
+
+    filename = SNAPSHOT_PREFIX + version + ('.json.gz' if compressed else '.json')
+    os.makedirs(settings.SCHEDULABLE_SNAPSHOT_DIR, exist_ok=True)
+    _write_file(
+        os.path.join(settings.SCHEDULABLE_SNAPSHOT_DIR, filename),
+        gzip.compress(content) if compressed else content
+    )
+    snapshot = {'version': version, 'semester': semester.id, 'gzip': compressed, 'filename': filename}
+    _write_file(
+        os.path.join(settings.SCHEDULABLE_SNAPSHOT_DIR, SNAPSHOT_POINTER), json.dumps(snapshot).encode('utf-8')
+    )
+
+    # Readers that already opened an older version keep reading it, later ones get this one
+    for old_filename in os.listdir(settings.SCHEDULABLE_SNAPSHOT_DIR):
+        if old_filename.startswith(SNAPSHOT_PREFIX) and old_filename != filename:
+            try:
+                os.remove(os.path.join(settings.SCHEDULABLE_SNAPSHOT_DIR, old_filename))
+            except OSError:
+                pass
+    logger.info('Wrote version %s of the schedulable requests snapshot of semester %s', version, semester.id)
+    return get_schedulable_snapshot()
@@ -10,7 +10,7 @@ import json
 
 from valhalla.proposals.models import TimeAllocation
 from valhalla.userrequests.models import Request, Target, Window, UserRequest, Location, Molecule, Constraints
-from valhalla.userrequests.models import DraftUserRequest
+from valhalla.userrequests.models import DraftUserRequest, UserRequestTotalDuration
 from valhalla.userrequests.state_changes import debit_ipp_time, TimeAllocationError, validate_ipp
 from valhalla.userrequests.target_helpers import SiderealTargetHelper, NonSiderealTargetHelper, SatelliteTargetHelper
 from valhalla.common.configdb import configdb
@@ -248,7 +248,7 @@ class RequestSerializer(serializers.ModelSerializer):
         read_only_fields = (
             'id', 'fail_count', 'scheduled_count', 'created', 'completed', 'duration', 'state',
         )
-        exclude = ('user_request',)
+        exclude = ('user_request', 'stored_duration')
 
     def validate_molecules(self, value):
         if not value:
@@ -369,18 +369,27 @@ class UserRequestSerializer(serializers.ModelSerializer):
 
     @transaction.atomic
     def create(self, validated_data):
+        total_duration_dict = get_total_duration_dict(validated_data)
         request_data = validated_data.pop('requests')
 
         user_request = UserRequest.objects.create(**validated_data)
+        UserRequestTotalDuration.objects.bulk_create([
+            UserRequestTotalDuration(
+                user_request=user_request, semester_id=tak.semester, telescope_class=tak.telescope_class,
+                duration=duration
+            )
+            for tak, duration in total_duration_dict.items()
+        ])
 
         for r in request_data:
+            duration = get_request_duration(r)
             target_data = r.pop('target')
             constraints_data = r.pop('constraints')
             window_data = r.pop('windows')
             molecule_data = r.pop('molecules')
             location_data = r.pop('location')
 
-            request = Request.objects.create(user_request=user_request, **r)
+            request = Request.objects.create(user_request=user_request, stored_duration=duration, **r)
             Location.objects.create(request=request, **location_data)
             Target.objects.create(request=request, **target_data)
             Constraints.objects.create(request=request, **constraints_data)
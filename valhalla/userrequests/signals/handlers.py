@@ -1,30 +1,146 @@
 from django.dispatch import receiver
-from django.db.models.signals import pre_save, post_save
-from valhalla.userrequests.models import UserRequest, Request
-from valhalla.userrequests.state_changes import on_request_state_change, on_userrequest_state_change
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from functools import partial, reduce
+from math import ceil, floor
+from operator import or_
+from valhalla.userrequests.models import UserRequest, Request, UserRequestTombstone, UserRequestTotalDuration
+from valhalla.userrequests.duration_utils import OVERHEAD_ALLOWANCE
+from valhalla.userrequests.state_changes import on_request_state_change, on_userrequest_state_change, TERMINAL_STATES
+from valhalla.userrequests.tasks import queue_schedulable_snapshot_update
+from valhalla.proposals.models import Proposal, TimeAllocation
 from valhalla.proposals.notifications import userrequest_notifications
 
+# The allocation and time used fields of a time allocation that the user requests of each observation type draw on
+TIME_LEFT_FIELDS = {
+    UserRequest.NORMAL: ('std_allocation', 'std_time_used'),
+    UserRequest.TOO: ('too_allocation', 'too_time_used'),
+}
+
 
 @receiver(pre_save, sender=UserRequest)
-def cb_userrequest_pre_save(sender, instance, *args, **kwargs):
-    # instance has the new data, query the model for the current data
-    # TODO refactor and make clear what is actually happening here
-    if instance.id:
+def cb_userrequest_pre_save(sender, instance, update_fields=None, *args, **kwargs):
+    # instance has the new data, and remembers the state it had in the database
+    if instance.id and (update_fields is None or 'state' in update_fields):
         # This is an update to the model
-        current_data = UserRequest.objects.get(pk=instance.pk)
-        on_userrequest_state_change(current_data, instance)
+        old_state = instance.loaded_state
+        on_userrequest_state_change(old_state, instance)
+        if instance.state == 'CANCELED' and old_state != 'CANCELED':
+            queue_schedulable_snapshot_update()
 
 
 @receiver(pre_save, sender=Request)
-def cb_request_pre_save(sender, instance, *args, **kwargs):
-    # instance has the new data, query the model for the current data
-    # TODO refactor and make clear what is actually happening here
-    if instance.id:
+def cb_request_pre_save(sender, instance, update_fields=None, *args, **kwargs):
+    # instance has the new data, and remembers the state it had in the database
+    if instance.id and (update_fields is None or 'state' in update_fields):
         # This is an update to the model
-        current_data = Request.objects.get(pk=instance.pk)
-        on_request_state_change(current_data, instance)
+        on_request_state_change(instance.loaded_state, instance)
 
 
 @receiver(post_save, sender=UserRequest)
 def cb_userrequest_send_notifications(sender, instance, *args, **kwargs):
     userrequest_notifications(instance)
+
+
+@receiver(post_save, sender=UserRequest)
+def cb_userrequest_post_save(sender, instance, created, *args, **kwargs):
+    # Submitting and canceling change the schedulable set, isDirty updates the snapshot after its other changes
+    if created:
+        queue_schedulable_snapshot_update()
+
+
+@receiver(post_delete, sender=UserRequest)
+def cb_userrequest_post_delete(sender, instance, *args, **kwargs):
+    UserRequestTombstone.objects.create(tracking_num=instance.id)
+    queue_schedulable_snapshot_update()
+
+
+def touch_schedulable_user_requests(proposal_id, user_requests=None):
+    '''
+        Bumps the modified time of the proposal's user requests that could be scheduled, or of those of them in
+        user_requests, for a change to whether they can be that their own modified times don't show, so the scheduler's
+        feed of changes picks them up
+    '''
+    if user_requests is None:
+        user_requests = UserRequest.objects.all()
+    touched = user_requests.filter(proposal=proposal_id).exclude(state__in=TERMINAL_STATES).update(
+        modified=timezone.now()
+    )
+    if touched:
+        queue_schedulable_snapshot_update()
+
+
+@receiver(pre_save, sender=Proposal)
+def cb_proposal_pre_save(sender, instance, update_fields=None, *args, **kwargs):
+    # A proposal's user requests leave or rejoin the schedulable set with it
+    if instance._state.adding or not instance.loaded_values_changed(update_fields):
+        return
+    if instance.active:
+        touch_schedulable_user_requests(instance.id)
+    else:
+        user_requests = UserRequest.objects.filter(proposal=instance).exclude(state__in=TERMINAL_STATES)
+        UserRequestTombstone.objects.bulk_create([
+            UserRequestTombstone(tracking_num=tracking_num)
+            for tracking_num in user_requests.values_list('id', flat=True)
+        ])
+        queue_schedulable_snapshot_update()
+
+
+def get_time_lefts(time_allocation, loaded=False):
+    '''The time left in the time allocation for each observation type, as of when it was loaded if loaded'''
+    get_value = time_allocation.get_loaded_value if loaded else partial(getattr, time_allocation)
+    return {
+        observation_type: get_value(allocation_field) - get_value(time_used_field)
+        for observation_type, (allocation_field, time_used_field) in TIME_LEFT_FIELDS.items()
+    }
+
+
+def get_time_left_flipped_user_requests(time_allocation, observation_type, old_time_left, new_time_left):
+    '''
+        The user requests of the time allocation's proposal and observation type whose total duration in it is enough
+        time left at one of old_time_left and new_time_left but not the other, as has_time_left decides it. None is no
+        time allocation at all. Those without stored durations are included, since it cannot tell for them.
+    '''
+    time_lefts = [time_left for time_left in (old_time_left, new_time_left) if time_left is not None]
+    # Rounded outward, so a duration right on a limit is touched rather than missed
+    durations = UserRequestTotalDuration.objects.filter(
+        semester=time_allocation.semester_id, telescope_class=time_allocation.telescope_class,
+        duration__lte=ceil(max(time_lefts) * OVERHEAD_ALLOWANCE * 3600)
+    )
+    if len(time_lefts) == 2:
+        durations = durations.filter(duration__gt=floor(min(time_lefts) * OVERHEAD_ALLOWANCE * 3600))
+    return UserRequest.objects.filter(observation_type=observation_type).filter(
+        Q(id__in=durations.values('user_request')) | Q(total_durations__isnull=True)
+    )
+
+
+def touch_time_left_flipped_user_requests(time_allocation, old_time_lefts, new_time_lefts):
+    '''Touches, once the transaction commits, the user requests whose time left the change to it may have flipped'''
+    user_requests = [
+        get_time_left_flipped_user_requests(time_allocation, observation_type, old_time_lefts.get(observation_type),
+                                            new_time_lefts.get(observation_type))
+        for observation_type in TIME_LEFT_FIELDS
+        if old_time_lefts.get(observation_type) != new_time_lefts.get(observation_type)
+    ]
+    if user_requests:
+        proposal_id = time_allocation.proposal_id
+        transaction.on_commit(lambda: touch_schedulable_user_requests(
+            proposal_id, UserRequest.objects.filter(id__in=reduce(or_, user_requests).values('id'))
+        ))
+
+
+@receiver(post_save, sender=TimeAllocation)
+def cb_timeallocation_post_save(sender, instance, created, update_fields=None, *args, **kwargs):
+    # Accounting saves every time allocation hourly, but the user requests only leave or rejoin the schedulable set
+    # when their time left is crossed. The loaded values are still those from before the save.
+    if not created and not instance.loaded_values_changed(update_fields):
+        return
+    old_time_lefts = {} if created else get_time_lefts(instance, loaded=True)
+    touch_time_left_flipped_user_requests(instance, old_time_lefts, get_time_lefts(instance))
+
+
+@receiver(post_delete, sender=TimeAllocation)
+def cb_timeallocation_post_delete(sender, instance, *args, **kwargs):
+    touch_time_left_flipped_user_requests(instance, get_time_lefts(instance), {})
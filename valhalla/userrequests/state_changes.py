@@ -1,12 +1,14 @@
 from django.utils import timezone
 from django.db import transaction
+from django.db.models import Max, F
+from django.conf import settings
 from django.utils.translation import ugettext as _
 
 from valhalla.proposals.models import TimeAllocation, TimeAllocationKey
 from valhalla.userrequests.request_utils import exposure_completion_percentage_from_pond_block
-from valhalla.userrequests.models import UserRequest, Request
+from valhalla.userrequests.models import UserRequest, Request, Window, UserRequestTombstone
+from valhalla.proposals.notifications import userrequest_notifications
 
-import itertools
 import logging
 import dateutil.parser
 from math import isclose
@@ -37,10 +39,10 @@ def valid_state_change(old_state, new_state, obj):
 
 
 @transaction.atomic
-def on_request_state_change(old_request, new_request):
-    if old_request.state == new_request.state:
+def on_request_state_change(old_state, new_request):
+    if old_state == new_request.state:
         return
-    valid_state_change(old_request.state, new_request.state, old_request)
+    valid_state_change(old_state, new_request.state, new_request)
     # it must be a valid transition, so do time accounting here
     if new_request.state == 'COMPLETED':
         new_request.completed = timezone.now()
@@ -48,7 +50,7 @@ def on_request_state_change(old_request, new_request):
         if ipp_value < 1.0:
             modify_ipp_time_from_requests(ipp_value, [new_request], 'credit')
         else:
-            if old_request.state == 'WINDOW_EXPIRED':
+            if old_state == 'WINDOW_EXPIRED':
                 try:
                     modify_ipp_time_from_requests(ipp_value, [new_request], 'debit')
                 except TimeAllocationError as tae:
@@ -62,10 +64,10 @@ def on_request_state_change(old_request, new_request):
 
 
 @transaction.atomic
-def on_userrequest_state_change(old_userrequest, new_userrequest):
-    if old_userrequest.state == new_userrequest.state:
+def on_userrequest_state_change(old_state, new_userrequest):
+    if old_state == new_userrequest.state:
         return
-    valid_state_change(old_userrequest.state, new_userrequest.state, old_userrequest)
+    valid_state_change(old_state, new_userrequest.state, new_userrequest)
     if new_userrequest.state == 'COMPLETED':
         if new_userrequest.ipp_value >= 1.0 and new_userrequest.operator == 'oneof':
             requests_to_credit = new_userrequest.requests_set.filter(state__in=['PENDING', 'SCHEDULED'])
@@ -74,6 +76,8 @@ def on_userrequest_state_change(old_userrequest, new_userrequest):
         for r in new_userrequest.requests.filter(state__in=['PENDING', 'SCHEDULED']):
             r.state = new_userrequest.state
             r.save()
+    if new_userrequest.state in TERMINAL_STATES and old_state not in TERMINAL_STATES:
+        UserRequestTombstone.objects.create(tracking_num=new_userrequest.id)
 
 
 def validate_ipp(ur_dict, total_duration_dict):
@@ -170,11 +174,11 @@ def get_request_state_from_pond_blocks(request_state, completion_threshold, requ
     return request_state
 
 
-def update_request_state(request, request_blocks, ur_expired):
-    '''Update a request state given a set of pond blocks for that request'''
-    if request.state == 'COMPLETED':
-        return False
-
+def get_new_request_state(request, request_blocks, ur_expired):
+    '''
+        The state a set of pond blocks puts a request in, whether that counts as a state change even when the state
+        stays the same, and how much the request's fail_count goes up
+    '''
     state_changed = False
     fail_count = 0
 
@@ -190,6 +194,15 @@ def update_request_state(request, request_blocks, ur_expired):
     elif new_r_state == 'FAILED' and request.state not in TERMINAL_STATES:
         new_r_state = 'PENDING'
         state_changed = True
+    return new_r_state, state_changed, fail_count
+
+
+def update_request_state(request, request_blocks, ur_expired):
+    '''Update a request state given a set of pond blocks for that request'''
+    if request.state == 'COMPLETED':
+        return False
+
+    new_r_state, state_changed, fail_count = get_new_request_state(request, request_blocks, ur_expired)
     with transaction.atomic():
         # Re-get the request and lock. If the new state is a valid state transition, set it on the request atomically.
         req = Request.objects.select_for_update().get(pk=request.id)
@@ -205,11 +218,16 @@ def update_request_state(request, request_blocks, ur_expired):
 def aggregate_request_states(user_request):
     '''Aggregate the state of the user request from all of its child request states'''
     request_states = [request.state for request in Request.objects.filter(user_request=user_request)]
+    return get_aggregate_state(user_request.operator, request_states)
+
+
+def get_aggregate_state(operator, request_states):
+    '''The state of a user request with this operator whose requests are in request_states'''
     # Set the priority ordering - assume AND by default
     state_priority = ['WINDOW_EXPIRED', 'PENDING', 'COMPLETED', 'CANCELED']
-    if user_request.operator == 'ONEOF':
+    if operator == 'ONEOF':
         state_priority = ['COMPLETED', 'PENDING', 'WINDOW_EXPIRED', 'CANCELED']
-    elif user_request.operator == 'MANY':
+    elif operator == 'MANY':
         state_priority = ['PENDING', 'COMPLETED', 'WINDOW_EXPIRED', 'CANCELED']
 
     for state in state_priority:
@@ -220,47 +238,183 @@ def aggregate_request_states(user_request):
 
 
 def update_request_states_for_window_expiration():
-    '''Update the state of all requests and user_requests to WINDOW_EXPIRED if their last window has passed'''
+    '''
+        Update the state of all requests and user_requests to WINDOW_EXPIRED if their last window has passed. The
+        expired requests are found with one query and expired WINDOW_EXPIRATION_BATCH_SIZE at a time, then only the
+        user requests they belong to have their states updated.
+    '''
     now = timezone.now()
+    expired_ids = list(Request.objects.filter(state='PENDING').exclude(
+        user_request__state__in=TERMINAL_STATES
+    ).annotate(last_window_end=Max('windows__end')).filter(last_window_end__lt=now).order_by('id').values_list(
+        'id', flat=True
+    ))
     states_changed = False
-    for user_request in UserRequest.objects.exclude(state__in=TERMINAL_STATES):
-        request_states_changed = False
-        for request in user_request.requests.filter(state='PENDING').prefetch_related('windows'):
-            if request.max_window_time < now:
+    for index in range(0, len(expired_ids), settings.WINDOW_EXPIRATION_BATCH_SIZE):
+        batch_ids = expired_ids[index:index + settings.WINDOW_EXPIRATION_BATCH_SIZE]
+        with transaction.atomic():
+            # Lock the batch, and leave out any that changed state since they were found
+            requests = list(Request.objects.select_for_update().filter(id__in=batch_ids, state='PENDING'))
+            Request.objects.filter(id__in=[request.id for request in requests]).update(
+                state='WINDOW_EXPIRED', modified=now
+            )
+            user_requests = UserRequest.objects.in_bulk({request.user_request_id for request in requests})
+            for request in requests:
                 logger.info('Expiring request %s', request.id, extra={'tags': {'request_num': request.id}})
-                with transaction.atomic():
-                    req = Request.objects.select_for_update().get(pk=request.id)
-                    if req.state == 'PENDING':
-                        req.state = 'WINDOW_EXPIRED'
-                        states_changed = True
-                        request_states_changed = True
-                        req.save()
-        if request_states_changed:
-            update_user_request_state(user_request)
+                request.state = 'WINDOW_EXPIRED'
+                # The ipp crediting of on_request_state_change, which the update() does not call
+                ipp_value = user_requests[request.user_request_id].ipp_value
+                if ipp_value >= 1.0:
+                    modify_ipp_time_from_requests(ipp_value, [request], 'credit')
+        states_changed |= bool(requests)
+
+        # The states of all their requests are read at once, to only lock and save the user requests whose state changes
+        request_states = {}
+        for user_request_id, state in Request.objects.filter(user_request__in=user_requests.keys()).values_list(
+                'user_request', 'state'):
+            request_states.setdefault(user_request_id, []).append(state)
+        for user_request in user_requests.values():
+            new_state = get_aggregate_state(user_request.operator, request_states[user_request.id])
+            if new_state in REQUEST_STATE_MAP[user_request.state]:
+                update_user_request_state(user_request)
 
     return states_changed
 
 
 def update_request_states_from_pond_blocks(pond_blocks):
     '''Update the states of requests and user_requests given a set of recently changed pond blocks.'''
-    blocks_with_tracking_nums = [pb for pb in pond_blocks if pb['molecules'][0]['tracking_num']]
-    sorted_blocks_with_tracking_nums = sorted(blocks_with_tracking_nums, key=lambda x: x['molecules'][0]['tracking_num'])
-    blocks_by_tracking_num = itertools.groupby(sorted_blocks_with_tracking_nums, lambda x: x['molecules'][0]['tracking_num'])
+    counts = reconcile_pond_blocks(pond_blocks)
+    return bool(counts['requests_changed'] or counts['user_requests_changed'])
+
+
+def reconcile_pond_blocks(pond_blocks):
+    '''
+        Updates the states of requests and user requests from a set of recently changed pond blocks in bulk, for
+        POND_BLOCK_CHUNK_SIZE user requests at a time. Returns the number of blocks with a tracking number, and of the
+        requests and user requests whose states changed.
+    '''
+    blocks_by_request = {}
+    for block in pond_blocks:
+        molecule = block['molecules'][0]
+        if molecule['tracking_num']:
+            key = (int(molecule['tracking_num']), int(molecule['request_num']))
+            blocks_by_request.setdefault(key, []).append(block)
+    tracking_nums = sorted({tracking_num for tracking_num, request_num in blocks_by_request})
     now = timezone.now()
-    states_changed = False
 
-    for tracking_num, blocks in blocks_by_tracking_num:
-        sorted_blocks_by_request = sorted(blocks, key=lambda x: x['molecules'][0]['request_num'])
-        blocks_by_request_num = {int(k): list(v) for k, v in itertools.groupby(sorted_blocks_by_request, key=lambda x: x['molecules'][0]['request_num'])}
-        user_request = UserRequest.objects.prefetch_related('requests').get(pk=tracking_num)
-        ur_expired = user_request.max_window_time < now
-        requests = user_request.requests.all()
+    counts = {'blocks': sum(len(blocks) for blocks in blocks_by_request.values()), 'requests_changed': 0,
+              'user_requests_changed': 0}
+    for index in range(0, len(tracking_nums), settings.POND_BLOCK_CHUNK_SIZE):
+        requests_changed, user_requests_changed = reconcile_user_requests(
+            tracking_nums[index:index + settings.POND_BLOCK_CHUNK_SIZE], blocks_by_request, now
+        )
+        counts['requests_changed'] += requests_changed
+        counts['user_requests_changed'] += user_requests_changed
+    return counts
+
+
+def reconcile_user_requests(tracking_nums, blocks_by_request, now):
+    '''
+        Reconciles the user requests of tracking_nums with their pond blocks in one transaction. Their requests are
+        locked with one query, the new states worked out in memory and written with an update per state, then the
+        side effects the state change signals have on a save are applied: ipp time, tombstones and, after the
+        transaction, completion notifications. Returns the number of requests and user requests whose states changed.
+    '''
+    with transaction.atomic():
+        user_requests = UserRequest.objects.select_for_update().in_bulk(tracking_nums)
+        for tracking_num in set(tracking_nums) - set(user_requests):
+            logger.warning('Received pond blocks for user request %s, which does not exist', tracking_num)
+        requests = list(Request.objects.select_for_update().filter(user_request__in=tracking_nums).order_by('id'))
+        last_window_ends = dict(Window.objects.filter(request__user_request__in=tracking_nums).order_by().values(
+            'request__user_request'
+        ).annotate(last_end=Max('end')).values_list('request__user_request', 'last_end'))
+
+        # Each (request, old state, new state) in the order a save per request would have made them
+        transitions = []
+        failed_ids = []
+        requests_changed = 0
         for request in requests:
-            if request.id in blocks_by_request_num:
-                states_changed |= update_request_state(request, blocks_by_request_num[request.id], ur_expired)
-        states_changed |= update_user_request_state(user_request)
-
-    return states_changed
+            request_blocks = blocks_by_request.get((request.user_request_id, request.id))
+            if not request_blocks or request.state == 'COMPLETED':
+                continue
+            last_end = last_window_ends.get(request.user_request_id)
+            new_state, state_changed, fail_count = get_new_request_state(
+                request, request_blocks, last_end is not None and last_end < now
+            )
+            if fail_count:
+                failed_ids.append(request.id)
+            if new_state in REQUEST_STATE_MAP[request.state]:
+                transitions.append((request, request.state, new_state))
+                request.state = new_state
+                state_changed = True
+            requests_changed += state_changed
+
+        requests_by_user_request = {}
+        for request in requests:
+            requests_by_user_request.setdefault(request.user_request_id, []).append(request)
+        user_request_transitions = []
+        for user_request in user_requests.values():
+            try:
+                request_states = [request.state for request in requests_by_user_request.get(user_request.id, [])]
+                new_state = get_aggregate_state(user_request.operator, request_states)
+            except AggregateStateException as e:
+                logger.warning('Not updating the state of user request %s: %s', user_request.id, e)
+                continue
+            if new_state not in REQUEST_STATE_MAP[user_request.state]:
+                continue
+            user_request_transitions.append((user_request, user_request.state, new_state))
+            user_request.state = new_state
+            # As on_userrequest_state_change, the requests still to be done end with their user request
+            if new_state in TERMINAL_STATES and new_state != 'COMPLETED':
+                for request in requests_by_user_request[user_request.id]:
+                    if request.state in ['PENDING', 'SCHEDULED']:
+                        transitions.append((request, request.state, new_state))
+                        request.state = new_state
+
+        _bulk_update_states(Request, [transition[0] for transition in transitions], now)
+        if failed_ids:
+            Request.objects.filter(id__in=failed_ids).update(fail_count=F('fail_count') + 1, modified=now)
+        _bulk_update_states(UserRequest, [transition[0] for transition in user_request_transitions], now)
+        UserRequestTombstone.objects.bulk_create([
+            UserRequestTombstone(tracking_num=user_request.id)
+            for user_request, old_state, new_state in user_request_transitions
+            if new_state in TERMINAL_STATES and old_state not in TERMINAL_STATES
+        ])
+        _modify_ipp_time_for_transitions(transitions, user_requests)
+
+    for user_request, old_state, new_state in user_request_transitions:
+        if new_state == 'COMPLETED':
+            userrequest_notifications(user_request)
+    return requests_changed, len(user_request_transitions)
+
+
+def _bulk_update_states(model, instances, now):
+    '''Writes the state of each of the instances, with an update per state'''
+    ids_by_state = {}
+    for instance in instances:
+        ids_by_state.setdefault(instance.state, set()).add(instance.id)
+    for state, ids in ids_by_state.items():
+        fields = {'state': state, 'modified': now}
+        if model is Request and state == 'COMPLETED':
+            fields['completed'] = now
+        model.objects.filter(id__in=ids).update(**fields)
+
+
+def _modify_ipp_time_for_transitions(transitions, user_requests):
+    '''The ipp time credits and debits on_request_state_change makes for each of the transitions'''
+    for request, old_state, new_state in transitions:
+        ipp_value = user_requests[request.user_request_id].ipp_value
+        modification = None
+        if new_state == 'COMPLETED':
+            if ipp_value < 1.0:
+                modification = 'credit'
+            elif old_state == 'WINDOW_EXPIRED':
+                modification = 'debit'
+        elif new_state in ['CANCELED', 'WINDOW_EXPIRED'] and ipp_value >= 1.0:
+            modification = 'credit'
+        if modification:
+            # One request at a time, as on_request_state_change does, so a problem with one does not stop the others
+            modify_ipp_time_from_requests(ipp_value, [request], modification)
 
 
 def update_user_request_state(user_request):
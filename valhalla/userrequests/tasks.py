@@ -1,7 +1,19 @@
 from celery import shared_task
+from django.utils import timezone
+from django.conf import settings
+from django.db import transaction
+from datetime import timedelta
 import logging
 
+from valhalla.common.configdb import configdb
+from valhalla.common.rise_set_utils import update_site_dark_interval_calendar
+from valhalla.proposals.models import Semester
+from valhalla.userrequests.models import UserRequestTombstone
 from valhalla.userrequests.state_changes import update_request_states_for_window_expiration
+from valhalla.userrequests.schedulable import write_schedulable_snapshot
+from valhalla.userrequests.pond_ingestion import (
+    run_pond_ingestion, acquire_ingestion_lock, release_ingestion_lock, mark_dirty
+)
 
 logger = logging.getLogger(__name__)
 
@@ -9,4 +21,77 @@ logger = logging.getLogger(__name__)
 @shared_task
 def expire_requests():
     logger.info('Expiring requests')
-    update_request_states_for_window_expiration()
+    if update_request_states_for_window_expiration():
+        queue_schedulable_snapshot_update()
+
+
+@shared_task
+def prune_tombstones():
+    cutoff = timezone.now() - timedelta(days=settings.SCHEDULABLE_TOMBSTONE_DAYS)
+    deleted, _ = UserRequestTombstone.objects.filter(created__lt=cutoff).delete()
+    logger.info('Pruned %d tombstones older than %s', deleted, cutoff)
+
+
+@shared_task
+def update_schedulable_snapshot():
+    if settings.SCHEDULABLE_SNAPSHOT_ENABLED:
+        logger.info('Updating the schedulable requests snapshot')
+        write_schedulable_snapshot()
+
+
+def queue_schedulable_snapshot_update():
+    '''Queues an update of the schedulable requests snapshot for when the current transaction commits'''
+    if settings.SCHEDULABLE_SNAPSHOT_ENABLED:
+        transaction.on_commit(update_schedulable_snapshot.delay)
+
+
+@shared_task
+def ingest_pond_blocks():
+    if not settings.ISDIRTY_ASYNC:
+        return
+    if not acquire_ingestion_lock():
+        logger.info('Not ingesting pond blocks, another ingestion is running')
+        return
+    try:
+        counts = run_pond_ingestion()
+        if counts['is_dirty']:
+            mark_dirty()
+    except Exception:
+        logger.exception('Failed to ingest pond blocks')
+        return
+    finally:
+        release_ingestion_lock()
+    logger.info('Ingested %d pond blocks, changing %d requests and %d user requests', counts['blocks'],
+                counts['requests_changed'], counts['user_requests_changed'])
+    if counts['is_dirty']:
+        queue_schedulable_snapshot_update()
+
+
+@shared_task
+def warm_configdb_cache():
+    logger.info('Warming the configdb cache')
+    configdb.warm_cache()
+
+
+def get_dark_interval_calendar_range():
+    '''
+        The calendar covers the current and the next semester, starting a day early since availability is computed
+        from the day before the requested range. Without semesters it covers the coming year.
+    '''
+    now = timezone.now()
+    start = now - timedelta(days=1)
+    end = now + timedelta(days=365)
+    current_semester = Semester.current_semesters().order_by('start').first()
+    if current_semester:
+        start = min(start, current_semester.start - timedelta(days=1))
+        next_semester = Semester.objects.filter(start__gte=current_semester.end).order_by('start').first()
+        end = next_semester.end if next_semester else current_semester.end
+    return start, end
+
+
+@shared_task
+def update_dark_interval_calendars():
+    start, end = get_dark_interval_calendar_range()
+    logger.info('Updating dark interval calendars from %s to %s', start, end)
+    for site_code in configdb.get_sites_with_instrument_type_and_location():
+        update_site_dark_interval_calendar(site_code, start, end)
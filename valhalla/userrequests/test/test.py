@@ -1,14 +1,23 @@
 from django.utils import timezone
 from django.test import TestCase
 from mixer.backend.django import mixer
+from django.core.management import call_command
 from datetime import datetime
+from unittest.mock import patch
+from io import StringIO
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework import serializers
+import json
 import math
 
 from valhalla.userrequests.models import Request, Molecule, Target, UserRequest, Window, Location, Constraints
 from valhalla.proposals.models import Proposal, TimeAllocation, Semester
-from valhalla.common.configdb import ConfigDBException
+from valhalla.common.configdb import ConfigDBException, configdb
 from valhalla.common.test_helpers import ConfigDBTestMixin, SetTimeMixin
-from valhalla.userrequests.duration_utils import PER_MOLECULE_STARTUP_TIME, PER_MOLECULE_GAP
+from valhalla.userrequests.request_dicts import get_user_request_dicts, get_request_dicts
+from valhalla.userrequests.fast_serializers import serialize_user_requests, serialize_requests
+from valhalla.userrequests.serializers import UserRequestSerializer, RequestSerializer, TargetSerializer
+from valhalla.userrequests.duration_utils import PER_MOLECULE_STARTUP_TIME, PER_MOLECULE_GAP, get_total_duration_dict
 
 
 class TestUserRequestTotalDuration(ConfigDBTestMixin, SetTimeMixin, TestCase):
@@ -81,6 +90,150 @@ class TestUserRequestTotalDuration(ConfigDBTestMixin, SetTimeMixin, TestCase):
         tak = self.requests[0].time_allocation_key
         self.assertEqual(sum_duration, total_duration[tak])
 
+    def test_overheads_are_looked_up_once_per_user_request(self):
+        self.ur_many.operator = 'AND'
+        self.ur_many.save()
+        user_request_dict = self.ur_many.as_dict
+        with patch('valhalla.userrequests.duration_utils.configdb.get_overheads',
+                   wraps=configdb.get_overheads) as mock_overheads:
+            get_total_duration_dict(user_request_dict)
+            self.assertEqual(mock_overheads.call_count, 1)
+
+    def test_update_durations_stores_durations(self):
+        self.ur_many.operator = 'AND'
+        self.ur_many.save()
+        self.ur_many.update_durations()
+        expected_total = get_total_duration_dict(self.ur_many.as_dict)
+
+        with patch('valhalla.userrequests.models.get_request_duration') as mock_duration, \
+                patch('valhalla.userrequests.models.get_total_duration_dict') as mock_total:
+            user_request = UserRequest.objects.get(pk=self.ur_many.id)
+            self.assertEqual(user_request.total_duration, expected_total)
+            for request in user_request.requests.all():
+                self.assertEqual(request.duration, Request.objects.get(pk=request.id).stored_duration)
+            self.assertFalse(mock_duration.called)
+            self.assertFalse(mock_total.called)
+        self.assertEqual(sum(r.stored_duration for r in user_request.requests.all()), sum(expected_total.values()))
+
+    def test_update_durations_replaces_stored_durations(self):
+        self.ur_single.update_durations()
+        Request.objects.filter(pk=self.request.id).update(stored_duration=1)
+        self.ur_single.total_durations.update(duration=1)
+        self.ur_single.update_durations()
+        self.assertEqual(self.ur_single.total_durations.count(), 1)
+        self.assertEqual(Request.objects.get(pk=self.request.id).duration, self.request.duration)
+        self.assertEqual(self.ur_single.total_durations.get().duration, self.request.duration)
+
+    def test_recompute_durations_command(self):
+        UserRequest.objects.filter(pk=self.ur_many.id).update(state='COMPLETED')
+        call_command('recompute_durations', stdout=StringIO())
+        self.assertEqual(Request.objects.get(pk=self.request.id).stored_duration, self.request.duration)
+        self.assertFalse(Request.objects.filter(user_request=self.ur_many, stored_duration__isnull=False).exists())
+
+        call_command('recompute_durations', '--all', stdout=StringIO())
+        self.assertFalse(Request.objects.filter(stored_duration__isnull=True).exists())
+
+
+class TestRequestDicts(ConfigDBTestMixin, SetTimeMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        proposal = mixer.blend(Proposal)
+        self.user_requests = mixer.cycle(3).blend(UserRequest, proposal=proposal)
+        for user_request in self.user_requests:
+            for request in mixer.cycle(2).blend(Request, user_request=user_request):
+                mixer.cycle(3).blend(Molecule, request=request, instrument_name='1M0-SCICAM-SBIG', exposure_time=10,
+                                     exposure_count=1, bin_x=2, bin_y=2)
+                mixer.cycle(2).blend(Window, request=request)
+                mixer.blend(Target, request=request)
+                mixer.blend(Location, request=request, telescope_class='1m0')
+                mixer.blend(Constraints, request=request)
+        mixer.blend(Request, user_request=self.user_requests[0], stored_duration=10)
+
+    def test_user_request_dicts_match_as_dict(self):
+        user_request_dicts = get_user_request_dicts(UserRequest.objects.filter(proposal=self.user_requests[0].proposal))
+        self.assertCountEqual(user_request_dicts.keys(), [ur.id for ur in self.user_requests])
+        for user_request in self.user_requests[1:]:
+            self.assertEqual(user_request_dicts[user_request.id], user_request.as_dict)
+        self.assertNotIn('stored_duration', user_request_dicts[self.user_requests[0].id]['requests'][2])
+
+    def test_request_dicts_match_as_dict(self):
+        requests = Request.objects.filter(user_request=self.user_requests[1])
+        self.assertEqual(list(get_request_dicts(requests).values()), [r.as_dict for r in requests])
+
+    def test_number_of_queries_does_not_grow_with_user_requests(self):
+        with self.assertNumQueries(7):
+            get_user_request_dicts(UserRequest.objects.filter(id=self.user_requests[0].id))
+        with self.assertNumQueries(7):
+            get_user_request_dicts(UserRequest.objects.all())
+
+
+class TestFastSerializers(ConfigDBTestMixin, SetTimeMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        proposal = mixer.blend(Proposal)
+        self.user_requests = mixer.cycle(2).blend(UserRequest, proposal=proposal, state='PENDING')
+        targets = [
+            {'type': 'SIDEREAL', 'ra': 34.4, 'dec': 20.0},
+            {'type': 'NON_SIDEREAL', 'scheme': 'MPC_MINOR_PLANET', 'epochofel': 57660.0, 'orbinc': 9.7942900,
+             'longascnode': 122.8943400, 'argofperih': 78.3278300, 'meandist': 0.7701170, 'eccentricity': 0.5391962,
+             'meananom': 165.6860900},
+            {'type': 'SATELLITE', 'altitude': 33.0, 'azimuth': 2.0, 'diff_pitch_rate': 3.0, 'diff_roll_rate': 4.0,
+             'diff_pitch_acceleration': 5.0, 'diff_roll_acceleration': 0.1, 'diff_epoch_rate': 11.0},
+        ]
+        # The second user request fills in the location fields left out of the output when blank
+        for user_request, (observatory, telescope) in zip(self.user_requests, [('', ''), ('doma', '1m0a')]):
+            for target, stored_duration in zip(targets, [None, 1200, None]):
+                request = mixer.blend(Request, user_request=user_request, state='PENDING',
+                                      stored_duration=stored_duration, completed=None)
+                mixer.cycle(2).blend(Molecule, request=request, instrument_name='1M0-SCICAM-SBIG', exposure_time=10,
+                                     exposure_count=1, bin_x=2, bin_y=2, type='EXPOSE')
+                mixer.cycle(2).blend(Window, request=request)
+                Target.objects.create(request=request, name='fast', **target)
+                mixer.blend(Location, request=request, telescope_class='1m0', site='tst', observatory=observatory,
+                            telescope=telescope)
+                mixer.blend(Constraints, request=request)
+
+    def assertSameOutput(self, fast, expected):
+        self.assertEqual(json.dumps(fast, cls=JSONEncoder), json.dumps(expected, cls=JSONEncoder))
+
+    def test_user_requests_match_user_request_serializer(self):
+        user_requests = UserRequest.objects.all()
+        self.assertSameOutput(
+            serialize_user_requests(user_requests), UserRequestSerializer(user_requests, many=True).data
+        )
+
+    def test_requests_match_request_serializer(self):
+        requests = Request.objects.filter(user_request=self.user_requests[0])
+        self.assertSameOutput(serialize_requests(requests), RequestSerializer(requests, many=True).data)
+
+    def assertOutputsDeclaredFields(self, data, serializer, instance):
+        '''
+            Every field the serializer declares for output is in data, recursing into its nested serializers. Fields
+            are skipped where the serializer leaves them out too, when the instance has no such attribute.
+        '''
+        if isinstance(serializer, TargetSerializer):
+            # A target outputs the fields of its type
+            for name in TargetSerializer.TYPE_HELPER_MAP[instance.type](data).fields:
+                self.assertIn(name, data, 'TargetSerializer.{} is not output'.format(name))
+            return
+        for name, field in serializer.fields.items():
+            if field.write_only or (field.source != '*' and not hasattr(instance, field.source_attrs[0])):
+                continue
+            self.assertIn(name, data, '{}.{} is not output'.format(type(serializer).__name__, name))
+            if isinstance(field, serializers.ListSerializer):
+                for item, related in zip(data[name], getattr(instance, field.source).all()):
+                    self.assertOutputsDeclaredFields(item, field.child, related)
+            elif isinstance(field, serializers.BaseSerializer):
+                self.assertOutputsDeclaredFields(data[name], field, getattr(instance, field.source))
+
+    def test_every_declared_field_is_output(self):
+        user_requests = UserRequest.objects.filter(id=self.user_requests[1].id)
+        self.assertOutputsDeclaredFields(serialize_user_requests(user_requests)[0], UserRequestSerializer(),
+                                         user_requests[0])
+        requests = Request.objects.filter(user_request=self.user_requests[1])
+        for data, request in zip(serialize_requests(requests), requests):
+            self.assertOutputsDeclaredFields(data, RequestSerializer(), request)
+
 
 class TestRequestDuration(ConfigDBTestMixin, SetTimeMixin, TestCase):
     def setUp(self):
@@ -1,15 +1,21 @@
-from valhalla.userrequests.models import UserRequest, Request, DraftUserRequest
+from valhalla.userrequests.models import UserRequest, Request, DraftUserRequest, UserRequestTombstone
 from valhalla.userrequests.models import Window, Target, Molecule, Location, Constraints
 from valhalla.proposals.models import Proposal, Membership, TimeAllocation, Semester
 from valhalla.common.test_helpers import ConfigDBTestMixin, SetTimeMixin
 import valhalla.userrequests.signals.handlers  # noqa
 from valhalla.userrequests.test.test_state_changes import PondMolecule, PondBlock
 from valhalla.userrequests.contention import Pressure
+from valhalla.userrequests.schedulable import write_schedulable_snapshot
+from valhalla.userrequests.pond_ingestion import mark_dirty
 
 from django.core.urlresolvers import reverse
 from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.cache import cache
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from rest_framework.test import APITestCase
 from mixer.backend.django import mixer
 from mixer.main import mixer as basic_mixer
@@ -20,8 +26,12 @@ import responses
 import requests
 import os
 import copy
+import gzip
+import shutil
+import tempfile
 import json
 import random
+import msgpack
 
 generic_payload = {
     'proposal': 'temp',
@@ -1327,12 +1337,12 @@ class TestBlocksApi(APITestCase):
             result = self.client.get(reverse('api:requests-blocks', args=(self.request.id,)) + '?canceled=false')
             self.assertEqual(len(result.json()), 2)
 
-    @patch('requests.get', side_effect=requests.exceptions.ConnectionError())
+    @patch('valhalla.common.http_client.ServiceClient.get', side_effect=requests.exceptions.ConnectionError())
     def test_no_connection(self, request_patch):
         result = self.client.get(reverse('api:requests-blocks', args=(self.request.id,)))
         self.assertFalse(result.json())
 
-    @patch('requests.get', side_effect=requests.exceptions.HTTPError())
+    @patch('valhalla.common.http_client.ServiceClient.get', side_effect=requests.exceptions.HTTPError())
     def test_http_error(self, request_patch):
         result = self.client.get(reverse('api:requests-blocks', args=(self.request.id,)))
         self.assertFalse(result.json())
@@ -1616,9 +1626,37 @@ class TestUpdateRequestStatesAPI(APITestCase):
 
         self.assertEqual(response.status_code, 500)
 
+    @override_settings(ISDIRTY_ASYNC=True,
+                       CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_async_reports_changes_since_last_call(self, modify_mock):
+        cache.clear()
+        now = timezone.now()
+        cache.set('isDirty_query_time', now, None)
+        mark_dirty()
 
-@patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
-class TestSchedulableRequestsApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
+        response = self.client.get(reverse('api:isDirty'))
+        self.assertEqual(response.json(), {'isDirty': True, 'cursor': now.isoformat().replace('+00:00', 'Z')})
+        response = self.client.get(reverse('api:isDirty'))
+        self.assertFalse(response.json()['isDirty'])
+
+    @responses.activate
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_status_reports_last_run(self, modify_mock):
+        cache.clear()
+        responses.add(responses.GET, settings.POND_URL + '/pond/pond/blocks/new/',
+                      body='[]', status=200, content_type='application/json')
+        self.client.get(reverse('api:isDirty'))
+
+        response = self.client.get(reverse('api:isDirty_status'))
+        status = response.json()
+        self.assertEqual(status['last_run']['blocks'], 0)
+        self.assertIsNone(status['last_run']['error'])
+        self.assertGreaterEqual(status['last_run']['duration'], 0)
+        self.assertLess(status['lag'], 60)
+        self.assertFalse(status['async'])
+
+
+class SchedulableRequestsTestCase(ConfigDBTestMixin, SetTimeMixin, APITestCase):
     def setUp(self):
         super().setUp()
 
@@ -1655,6 +1693,9 @@ class TestSchedulableRequestsApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
 
         self.client.force_login(self.user)
 
+
+@patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
+class TestSchedulableRequestsApi(SchedulableRequestsTestCase):
     def test_setting_time_range_with_no_requests(self, modify_mock):
         start = datetime(2020, 1, 1, tzinfo=timezone.utc).isoformat()
         end = datetime(2020, 4, 1, tzinfo=timezone.utc).isoformat()
@@ -1672,6 +1713,19 @@ class TestSchedulableRequestsApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         for ur in response.json():
             self.assertIn(ur['id'], tracking_numbers)
 
+    def test_get_requests_as_msgpack(self, modify_mock):
+        response = self.client.get(reverse('api:user_requests-schedulable-requests') + '?format=msgpack')
+
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content, raw=False),
+                         self.client.get(reverse('api:user_requests-schedulable-requests')).json())
+
+    def test_get_requests_gzipped(self, modify_mock):
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'), HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.content).decode())), 10)
+
     def test_dont_get_requests_in_terminal_states(self, modify_mock):
         tracking_numbers = []
         # Set half the user requests to complete
@@ -1719,6 +1773,188 @@ class TestSchedulableRequestsApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         response = self.client.get(reverse('api:user_requests-schedulable-requests'))
         self.assertEqual(response.status_code, 403)
 
+    def test_queries_do_not_grow_with_user_requests(self, modify_mock):
+        with CaptureQueriesContext(connection) as all_urs:
+            response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        self.assertEqual(len(response.json()), 10)
+        UserRequest.objects.filter(id__in=[ur.id for ur in self.urs[:8]]).update(state='CANCELED')
+        with CaptureQueriesContext(connection) as two_urs:
+            response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        self.assertEqual(len(response.json()), 2)
+        self.assertEqual(len(all_urs), len(two_urs))
+
+    def test_user_requests_without_a_time_allocation_are_skipped(self, modify_mock):
+        self.time_allocation_1m0.delete()
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 0)
+
+    def test_ndjson_streams_the_same_user_requests(self, modify_mock):
+        expected = self.client.get(reverse('api:user_requests-schedulable-requests')).json()
+        response = self.client.get(reverse('api:user_requests-schedulable-requests') + '?format=ndjson')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], expected)
+
+    def test_user_requests_are_the_same_in_chunks(self, modify_mock):
+        expected = self.client.get(reverse('api:user_requests-schedulable-requests')).json()
+        with override_settings(SCHEDULABLE_REQUESTS_CHUNK_SIZE=3):
+            response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        self.assertEqual(response.json(), expected)
+
+
+@patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
+class TestSchedulableRequestsChangesApi(SchedulableRequestsTestCase):
+    def get_changes(self, since):
+        return self.client.get(
+            reverse('api:user_requests-schedulable-requests-changes') + '?since=' + since.isoformat()
+        )
+
+    def test_since_is_required(self, modify_mock):
+        response = self.client.get(reverse('api:user_requests-schedulable-requests-changes'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_malformed_since_is_rejected(self, modify_mock):
+        response = self.client.get(reverse('api:user_requests-schedulable-requests-changes') + '?since=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+    def test_time_used_changes_are_returned(self, modify_mock):
+        UserRequest.objects.update(modified=timezone.now() - timedelta(days=1))
+        Request.objects.update(modified=timezone.now() - timedelta(days=1))
+        since = timezone.now() - timedelta(seconds=1)
+        self.assertEqual(self.get_changes(since).json()['user_requests'], [])
+        with patch('valhalla.userrequests.signals.handlers.transaction.on_commit', side_effect=lambda func: func()):
+            self.time_allocation_1m0.std_time_used = 100.0
+            self.time_allocation_1m0.save()
+            response = self.get_changes(since)
+            self.assertEqual(response.json()['user_requests'], [])
+            self.assertEqual(response.json()['removed'], sorted(ur.id for ur in self.urs))
+
+            UserRequest.objects.update(modified=timezone.now() - timedelta(days=1))
+            self.time_allocation_1m0.std_time_used = 0.0
+            self.time_allocation_1m0.save()
+        response = self.get_changes(since)
+        self.assertEqual(sorted(ur['id'] for ur in response.json()['user_requests']), sorted(ur.id for ur in self.urs))
+
+    def test_since_older_than_the_tombstones_is_rejected(self, modify_mock):
+        response = self.get_changes(timezone.now() - timedelta(days=settings.SCHEDULABLE_TOMBSTONE_DAYS + 1))
+        self.assertEqual(response.status_code, 400)
+
+    def test_only_changed_user_requests_are_returned(self, modify_mock):
+        since = timezone.now() + timedelta(seconds=settings.SCHEDULABLE_CHANGES_OVERLAP)
+        UserRequest.objects.filter(pk=self.urs[3].pk).update(modified=since + timedelta(seconds=1))
+        Request.objects.filter(pk=self.urs[5].requests.first().pk).update(modified=since + timedelta(seconds=1))
+
+        response = self.get_changes(since)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(ur['id'] for ur in response.json()['user_requests']), [self.urs[3].id, self.urs[5].id])
+        self.assertEqual(response.json()['removed'], [])
+        self.assertIn('cursor', response.json())
+
+    def test_user_requests_that_left_are_removed(self, modify_mock):
+        since = timezone.now() + timedelta(seconds=settings.SCHEDULABLE_CHANGES_OVERLAP)
+        tombstone = UserRequestTombstone.objects.create(tracking_num=self.urs[1].id)
+        UserRequestTombstone.objects.filter(pk=tombstone.pk).update(created=since + timedelta(seconds=1))
+        UserRequest.objects.filter(pk=self.urs[1].pk).update(state='WINDOW_EXPIRED')
+        UserRequest.objects.filter(pk=self.urs[2].pk).update(state='CANCELED', modified=since + timedelta(seconds=1))
+
+        response = self.get_changes(since)
+        self.assertEqual(response.json()['user_requests'], [])
+        self.assertEqual(response.json()['removed'], sorted([self.urs[1].id, self.urs[2].id]))
+
+
+@patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
+class TestSchedulableRequestsSnapshot(SchedulableRequestsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.snapshot_dir)
+        self.settings_override = override_settings(SCHEDULABLE_SNAPSHOT_ENABLED=True,
+                                                   SCHEDULABLE_SNAPSHOT_DIR=self.snapshot_dir)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        write_schedulable_snapshot()
+
+    def get_schedulable_requests(self, **extra):
+        return self.client.get(reverse('api:user_requests-schedulable-requests'), **extra)
+
+    def test_missing_snapshot_is_served_from_the_database_and_queued(self, modify_mock):
+        with self.settings(SCHEDULABLE_SNAPSHOT_DIR=os.path.join(self.snapshot_dir, 'missing')):
+            with patch('valhalla.userrequests.viewsets.queue_schedulable_snapshot_update') as queue_mock:
+                response = self.get_schedulable_requests()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+        self.assertEqual(len(response.json()), 10)
+        queue_mock.assert_called_once_with()
+
+    def test_no_current_semester_is_not_found(self, modify_mock):
+        with patch('valhalla.userrequests.viewsets.Semester.current_semesters', return_value=Semester.objects.none()):
+            response = self.get_schedulable_requests()
+        self.assertEqual(response.status_code, 404)
+
+    def test_snapshot_matches_the_schedulable_requests(self, modify_mock):
+        response = self.get_schedulable_requests()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ETag', response)
+        served = json.loads(b''.join(response.streaming_content).decode())
+
+        start = datetime(2016, 9, 1, tzinfo=timezone.utc).isoformat()
+        end = datetime(2016, 12, 31, tzinfo=timezone.utc).isoformat()
+        response = self.client.get(
+            reverse('api:user_requests-schedulable-requests') + '?start=' + start + '&end=' + end
+        )
+        self.assertNotIn('ETag', response)
+        self.assertEqual(served, response.json())
+        self.assertEqual(len(served), 10)
+
+    def test_unchanged_snapshot_is_not_modified(self, modify_mock):
+        etag = self.get_schedulable_requests()['ETag']
+        response = self.get_schedulable_requests(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_changes_make_a_new_version(self, modify_mock):
+        etag = self.get_schedulable_requests()['ETag']
+        UserRequest.objects.filter(pk=self.urs[0].pk).update(state='CANCELED')
+        write_schedulable_snapshot()
+
+        response = self.get_schedulable_requests(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        served = json.loads(b''.join(response.streaming_content).decode())
+        self.assertNotIn(self.urs[0].id, [ur['id'] for ur in served])
+        self.assertEqual(len(os.listdir(self.snapshot_dir)), 2)
+
+    def test_gzipped_snapshot(self, modify_mock):
+        with self.settings(SCHEDULABLE_SNAPSHOT_GZIP=True):
+            write_schedulable_snapshot()
+            response = self.get_schedulable_requests(HTTP_ACCEPT_ENCODING='gzip, deflate')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            served = json.loads(gzip.decompress(b''.join(response.streaming_content)).decode())
+            self.assertEqual(len(served), 10)
+
+            response = self.get_schedulable_requests()
+            self.assertNotIn('Content-Encoding', response)
+            self.assertEqual(json.loads(b''.join(response.streaming_content).decode()), served)
+
+            response = self.get_schedulable_requests(HTTP_ACCEPT_ENCODING='gzip;q=0, deflate')
+            self.assertNotIn('Content-Encoding', response)
+            self.assertEqual(json.loads(b''.join(response.streaming_content).decode()), served)
+
+    def test_submitting_and_canceling_update_the_snapshot(self, modify_mock):
+        with patch('valhalla.userrequests.tasks.transaction.on_commit') as on_commit_mock:
+            ur = mixer.blend(UserRequest, proposal=self.proposal, submitter=self.user, state='PENDING')
+            self.assertEqual(on_commit_mock.call_count, 1)
+            ur.state = 'CANCELED'
+            ur.save()
+            self.assertEqual(on_commit_mock.call_count, 2)
+            ur.ipp_value = 2.0
+            ur.save()
+            self.assertEqual(on_commit_mock.call_count, 2)
+
 
 class TestContention(ConfigDBTestMixin, APITestCase):
     def setUp(self):
@@ -1874,22 +2110,22 @@ class TestPressure(ConfigDBTestMixin, APITestCase):
         # Check that the correct telescopes are returned.
         self.assertEqual(floyds_returned, p.telescopes['2M0-FLOYDS-SCICAM'])
 
-    @patch('valhalla.userrequests.contention.get_rise_set_intervals')
+    @patch('valhalla.userrequests.contention.get_rise_set_intervals_by_site')
     def test_visible_intervals(self, mock_intervals):
-        request = mixer.blend(Request, state='PENDING', duration=70*60)  # Request duration is 70 minutes.
+        request = mixer.blend(Request, state='PENDING', stored_duration=70*60)  # Request duration is 70 minutes.
         mixer.blend(Window, request=request)
         mixer.blend(Target, request=request)
         mixer.blend(Molecule, request=request)
         mixer.blend(Location, request=request, site='tst')
         mixer.blend(Constraints, request=request)
 
-        mock_intervals.return_value = [
+        mock_intervals.return_value = [{'tst': [
             [self.now - timedelta(hours=6), self.now - timedelta(hours=2)],  # Sets before now.
             [self.now + timedelta(hours=2), self.now + timedelta(hours=6)],
             [self.now + timedelta(hours=8), self.now + timedelta(hours=12)],
             [self.now - timedelta(hours=1), self.now + timedelta(minutes=30)],  # Sets too soon after now.
             [self.now + timedelta(hours=14), self.now + timedelta(hours=15)]  # Duration longer than interval.
-        ]
+        ]}]
         expected = {
             'tst': [
                 (self.now + timedelta(hours=2), self.now + timedelta(hours=6)),
@@ -1933,18 +2169,18 @@ class TestPressure(ConfigDBTestMixin, APITestCase):
         ]
         self.assertEqual(Pressure()._anonymize(data), expected)
 
-    @patch('valhalla.userrequests.contention.get_rise_set_intervals')
+    @patch('valhalla.userrequests.contention.get_rise_set_intervals_by_site')
     def test_binned_pressure_by_hours_from_now_should_be_gtzero_pressure(self, mock_intervals):
-        request = mixer.blend(Request, state='PENDING', duration=120*60)  # 2 hour duration.
+        request = mixer.blend(Request, state='PENDING', stored_duration=120*60)  # 2 hour duration.
         mixer.blend(Window, request=request)
         mixer.blend(Target, request=request)
         mixer.blend(Molecule, request=request, instrument_name='1M0-SCICAM-SBIG')
         mixer.blend(Location, request=request, site='tst')
         mixer.blend(Constraints, request=request)
 
-        mock_intervals.return_value = [
+        mock_intervals.return_value = [{'tst': [
             [self.now + timedelta(hours=2), self.now + timedelta(hours=6)],
-        ]
+        ]}]
         p = Pressure()
         p.requests = [request]
         sum_of_pressure = sum(sum(time.values()) for i, time in enumerate(p._binned_pressure_by_hours_from_now()))
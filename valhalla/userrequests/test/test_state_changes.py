@@ -1,14 +1,28 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from mixer.main import mixer
 from mixer.backend.django import mixer as dmixer
 from django.utils import timezone
 from datetime import timedelta, datetime
 from unittest.mock import patch
-
-from valhalla.userrequests.models import Request, UserRequest, Window
+import responses
+import json
+
+from valhalla.userrequests.models import Request, UserRequest, Window, UserRequestTombstone, UserRequestTotalDuration
+from valhalla.userrequests.tasks import prune_tombstones, ingest_pond_blocks
+from valhalla.userrequests.pond_ingestion import (
+    ingest_new_pond_blocks, get_ingestion_status, get_block_fingerprint, pop_is_dirty, mark_dirty,
+    acquire_ingestion_lock, PROGRESS_KEY, QUERY_TIME_KEY, REPORTED_CHANGES_KEY
+)
+from valhalla.proposals.models import Proposal, TimeAllocation
 from valhalla.userrequests.state_changes import (
     get_request_state_from_pond_blocks, update_request_state, aggregate_request_states,
-    update_request_states_from_pond_blocks, update_request_states_for_window_expiration
+    update_request_states_from_pond_blocks, update_request_states_for_window_expiration, reconcile_pond_blocks,
+    InvalidStateChange
 )
 
 
@@ -689,6 +703,271 @@ class TestUpdateRequestStates(TestCase):
         self.assertEqual(self.ur.state, 'COMPLETED')
 
 
+class TestLoadedState(TestCase):
+    def setUp(self):
+        self.userrequest = dmixer.blend(UserRequest, state='PENDING')
+        self.request = dmixer.blend(Request, state='PENDING', user_request=self.userrequest)
+
+    def test_state_change_does_not_read_the_previous_state(self):
+        request = Request.objects.get(pk=self.request.pk)
+        userrequest = UserRequest.objects.get(pk=self.userrequest.pk)
+        request.state = 'SCHEDULED'
+        userrequest.state = 'SCHEDULED'
+        with CaptureQueriesContext(connection) as queries:
+            request.save()
+            userrequest.save()
+        self.assertFalse([query['sql'] for query in queries if query['sql'].startswith('SELECT')])
+
+    def test_saved_state_is_the_previous_state(self):
+        self.request.state = 'SCHEDULED'
+        self.request.save()
+        self.request.state = 'COMPLETED'
+        self.request.save()
+        with self.assertRaises(InvalidStateChange):
+            self.request.state = 'PENDING'
+            self.request.save()
+
+    def test_saves_without_the_state_skip_the_state_change(self):
+        Request.objects.filter(pk=self.request.pk).update(state='COMPLETED')
+        request = Request.objects.get(pk=self.request.pk)
+        request.state = 'PENDING'
+        request.observation_note = 'note'
+        request.save(update_fields=['observation_note'])
+        self.assertEqual(Request.objects.get(pk=self.request.pk).state, 'COMPLETED')
+
+    def test_deferred_state_is_read_when_needed(self):
+        Request.objects.filter(pk=self.request.pk).update(state='COMPLETED')
+        request = Request.objects.only('id', 'user_request').get(pk=self.request.pk)
+        request.state = 'PENDING'
+        with self.assertRaises(InvalidStateChange):
+            request.save()
+
+    def test_refreshing_updates_the_previous_state(self):
+        Request.objects.filter(pk=self.request.pk).update(state='COMPLETED')
+        self.request.refresh_from_db()
+        with self.assertRaises(InvalidStateChange):
+            self.request.state = 'PENDING'
+            self.request.save()
+
+    def test_refreshing_other_fields_keeps_the_previous_state(self):
+        self.request.state = 'COMPLETED'
+        self.request.refresh_from_db(fields=['observation_note'])
+        self.assertEqual(self.request.loaded_state, 'PENDING')
+
+    def test_positional_update_fields_without_the_state_keep_the_previous_state(self):
+        request = Request.objects.get(pk=self.request.pk)
+        request.state = 'COMPLETED'
+        request.save(False, False, None, ['observation_note'])
+        self.assertEqual(request.loaded_state, 'PENDING')
+
+
+@patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
+class TestReconcilePondBlocks(TestCase):
+    def blend_user_request(self, window_end, completed=False, failed=False, ipp_value=1.0):
+        now = timezone.now()
+        user_request = dmixer.blend(UserRequest, operator='MANY', state='PENDING', ipp_value=ipp_value)
+        requests = dmixer.cycle(2).blend(Request, user_request=user_request, state='PENDING')
+        pond_blocks = []
+        for request in requests:
+            dmixer.blend(Window, request=request, start=now - timedelta(days=2), end=window_end)
+            molecules = mixer.cycle(2).blend(PondMolecule, completed=completed, failed=failed, request_num=request.id,
+                                             tracking_num=user_request.id, event=[])
+            pond_blocks.append(mixer.blend(PondBlock, molecules=molecules, canceled=False,
+                                           start=now - timedelta(minutes=30), end=now - timedelta(minutes=20))._to_dict())
+        return user_request, requests, pond_blocks
+
+    def test_failed_blocks_count_failures(self, modify_mock):
+        user_request, requests, pond_blocks = self.blend_user_request(timezone.now() + timedelta(days=1), failed=True)
+
+        counts = reconcile_pond_blocks(pond_blocks)
+        self.assertEqual(counts, {'blocks': 2, 'requests_changed': 2, 'user_requests_changed': 0})
+        for request in requests:
+            request.refresh_from_db()
+            self.assertEqual((request.state, request.fail_count), ('PENDING', 1))
+
+    def test_expired_requests_are_credited_one_at_a_time(self, modify_mock):
+        user_request, requests, pond_blocks = self.blend_user_request(timezone.now() - timedelta(days=1),
+                                                                      ipp_value=1.5)
+
+        counts = reconcile_pond_blocks(pond_blocks)
+        self.assertEqual(counts, {'blocks': 2, 'requests_changed': 2, 'user_requests_changed': 1})
+        self.assertEqual(set(Request.objects.values_list('state', flat=True)), {'WINDOW_EXPIRED'})
+        user_request.refresh_from_db()
+        self.assertEqual(user_request.state, 'WINDOW_EXPIRED')
+        self.assertTrue(UserRequestTombstone.objects.filter(tracking_num=user_request.id).exists())
+        self.assertEqual(
+            sorted((ipp_value, [r.id for r in credited], modification)
+                   for (ipp_value, credited, modification), _ in modify_mock.call_args_list),
+            [(1.5, [request.id], 'credit') for request in requests]
+        )
+
+    @patch('valhalla.userrequests.state_changes.userrequest_notifications')
+    def test_completed_user_requests_are_notified(self, notifications_mock, modify_mock):
+        user_request, requests, pond_blocks = self.blend_user_request(timezone.now() + timedelta(days=1),
+                                                                      completed=True)
+
+        reconcile_pond_blocks(pond_blocks)
+        for request in requests:
+            request.refresh_from_db()
+            self.assertEqual(request.state, 'COMPLETED')
+            self.assertIsNotNone(request.completed)
+        notifications_mock.assert_called_once_with(user_request)
+        self.assertEqual(notifications_mock.call_args[0][0].state, 'COMPLETED')
+
+    def test_queries_do_not_grow_with_user_requests(self, modify_mock):
+        window_end = timezone.now() + timedelta(days=1)
+        pond_blocks = self.blend_user_request(window_end, failed=True)[2]
+        with CaptureQueriesContext(connection) as few:
+            reconcile_pond_blocks(pond_blocks)
+
+        pond_blocks = []
+        for _ in range(5):
+            pond_blocks += self.blend_user_request(window_end, failed=True)[2]
+        with CaptureQueriesContext(connection) as many:
+            reconcile_pond_blocks(pond_blocks)
+        self.assertEqual(len(few), len(many))
+
+
+@patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   POND_BLOCK_INGEST_CHUNK_SIZE=2)
+class TestIngestNewPondBlocks(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.since = timezone.now() - timedelta(days=1)
+        self.user_requests = []
+        self.pond_blocks = []
+        for _ in range(3):
+            user_request, requests, pond_blocks = TestReconcilePondBlocks.blend_user_request(
+                self, timezone.now() + timedelta(days=1), failed=True
+            )
+            self.user_requests.append(user_request)
+            self.pond_blocks += pond_blocks
+        # As the pond sends them
+        self.pond_blocks = json.loads(json.dumps(self.pond_blocks, cls=DjangoJSONEncoder))
+        for index, block in enumerate(self.pond_blocks):
+            block['id'] = index + 1
+
+    def set_progress(self, blocks):
+        cache.set(PROGRESS_KEY, {'since': self.since.strftime('%Y-%m-%dT%H:%M:%S'), 'is_dirty': True,
+                                 'reconciled': dict(get_block_fingerprint(block) for block in blocks)})
+
+    def add_response(self, body):
+        responses.add(responses.GET, settings.POND_URL + '/pond/pond/blocks/new/', body=body, status=200,
+                      content_type='application/json')
+
+    def fail_counts(self):
+        return [list(Request.objects.filter(user_request=ur).values_list('fail_count', flat=True))
+                for ur in self.user_requests]
+
+    @responses.activate
+    def test_blocks_are_reconciled_in_chunks(self, modify_mock):
+        self.add_response(json.dumps(self.pond_blocks, cls=DjangoJSONEncoder))
+
+        with patch('valhalla.userrequests.pond_ingestion.reconcile_pond_blocks',
+                   wraps=reconcile_pond_blocks) as reconcile_mock:
+            counts = ingest_new_pond_blocks(self.since)
+        self.assertEqual([len(call[0][0]) for call in reconcile_mock.call_args_list], [2, 2, 2])
+        self.assertEqual(counts, {'blocks': 6, 'skipped': 0, 'requests_changed': 6, 'user_requests_changed': 0,
+                                  'is_dirty': True})
+        self.assertEqual(self.fail_counts(), [[1, 1], [1, 1], [1, 1]])
+        self.assertIsNone(cache.get(PROGRESS_KEY))
+        self.assertIsNotNone(cache.get(QUERY_TIME_KEY))
+
+    @responses.activate
+    def test_progress_is_kept_when_cut_off(self, modify_mock):
+        body = json.dumps(self.pond_blocks, cls=DjangoJSONEncoder)
+        self.add_response(body[:len(body) // 2 + len(body) // 4])
+
+        with self.assertRaises(ValueError):
+            ingest_new_pond_blocks(self.since)
+        self.assertEqual(self.fail_counts(), [[1, 1], [1, 1], [0, 0]])
+        self.assertEqual(set(cache.get(PROGRESS_KEY)['reconciled']), {'1', '2', '3', '4'})
+        self.assertIsNone(cache.get(QUERY_TIME_KEY))
+
+    @responses.activate
+    def test_resumes_without_reconciling_blocks_again(self, modify_mock):
+        self.set_progress(self.pond_blocks[:4])
+        self.add_response(json.dumps(self.pond_blocks, cls=DjangoJSONEncoder))
+
+        counts = ingest_new_pond_blocks(self.since)
+        self.assertEqual(counts, {'blocks': 2, 'skipped': 4, 'requests_changed': 2, 'user_requests_changed': 0,
+                                  'is_dirty': True})
+        self.assertEqual(self.fail_counts(), [[0, 0], [0, 0], [1, 1]])
+        self.assertIsNone(cache.get(PROGRESS_KEY))
+
+    @responses.activate
+    def test_resumes_when_blocks_are_reordered_or_modified(self, modify_mock):
+        self.set_progress(self.pond_blocks[:4])
+        # The pond moved a block it modified since the cut off pull, and a new one, to the front
+        modified = dict(self.pond_blocks[0], canceled=True)
+        self.add_response(json.dumps([self.pond_blocks[5], modified] + self.pond_blocks[1:5], cls=DjangoJSONEncoder))
+
+        counts = ingest_new_pond_blocks(self.since)
+        self.assertEqual((counts['blocks'], counts['skipped']), (3, 3))
+        self.assertEqual(self.fail_counts(), [[1, 0], [0, 0], [1, 1]])
+
+    @responses.activate
+    def test_progress_from_another_pull_is_ignored(self, modify_mock):
+        cache.set(PROGRESS_KEY, {'since': '2016-01-01T00:00:00', 'is_dirty': True,
+                                 'reconciled': dict(get_block_fingerprint(block) for block in self.pond_blocks)})
+        self.add_response(json.dumps(self.pond_blocks[:2], cls=DjangoJSONEncoder))
+
+        counts = ingest_new_pond_blocks(self.since)
+        self.assertEqual((counts['blocks'], counts['skipped']), (2, 0))
+
+    def test_dirty_flag_is_kept_when_set_while_reported(self, modify_mock):
+        mark_dirty()
+        original_set = cache.set
+
+        def set_marking_dirty(key, *args, **kwargs):
+            # Another pull changes states between the read and write of the reported count
+            if key == REPORTED_CHANGES_KEY:
+                mark_dirty()
+            return original_set(key, *args, **kwargs)
+
+        with patch.object(cache, 'set', side_effect=set_marking_dirty):
+            self.assertTrue(pop_is_dirty())
+        self.assertTrue(pop_is_dirty())
+        self.assertFalse(pop_is_dirty())
+
+    @responses.activate
+    @override_settings(ISDIRTY_ASYNC=True)
+    def test_task_records_its_run_and_the_dirty_flag(self, modify_mock):
+        self.add_response(json.dumps(self.pond_blocks, cls=DjangoJSONEncoder))
+
+        ingest_pond_blocks()
+        status = get_ingestion_status()
+        self.assertEqual((status['last_run']['blocks'], status['last_run']['requests_changed']), (6, 6))
+        self.assertIsNone(status['last_run']['error'])
+        self.assertEqual(status['last_success'], status['last_run']['started'])
+        self.assertIsNotNone(status['cursor'])
+        self.assertIsNone(status['running_since'])
+        self.assertTrue(pop_is_dirty())
+        self.assertFalse(pop_is_dirty())
+
+    @responses.activate
+    @override_settings(ISDIRTY_ASYNC=True)
+    def test_task_records_its_failure(self, modify_mock):
+        responses.add(responses.GET, settings.POND_URL + '/pond/pond/blocks/new/', body='Internal Server Error',
+                      status=500)
+
+        ingest_pond_blocks()
+        status = get_ingestion_status()
+        self.assertIn('HTTPError', status['last_run']['error'])
+        self.assertIsNone(status['last_success'])
+        self.assertIsNone(status['cursor'])
+        self.assertFalse(pop_is_dirty())
+
+    @override_settings(ISDIRTY_ASYNC=True)
+    def test_task_does_not_run_alongside_another(self, modify_mock):
+        self.assertTrue(acquire_ingestion_lock())
+        with patch('valhalla.userrequests.tasks.run_pond_ingestion') as run_mock:
+            ingest_pond_blocks()
+        self.assertFalse(run_mock.called)
+        self.assertIsNotNone(get_ingestion_status()['running_since'])
+
+
 @patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
 class TestExpireRequests(TestCase):
     def setUp(self):
@@ -724,3 +1003,170 @@ class TestExpireRequests(TestCase):
         request.refresh_from_db()
         self.assertFalse(result)
         self.assertEqual(request.state, 'COMPLETED')
+
+    @override_settings(WINDOW_EXPIRATION_BATCH_SIZE=2)
+    def test_expired_requests_are_updated_in_batches(self, ipp_mock):
+        other_userrequest = dmixer.blend(UserRequest, state='PENDING', operator='MANY')
+        requests = dmixer.cycle(3).blend(Request, state='PENDING', user_request=self.userrequest)
+        requests += dmixer.cycle(2).blend(Request, state='PENDING', user_request=other_userrequest)
+        dmixer.cycle(5).blend(
+            Window, start=timezone.now() - timedelta(days=2), end=timezone.now() - timedelta(days=1),
+            request=(request for request in requests)
+        )
+        # Only the last window of a request counts
+        dmixer.blend(Window, start=timezone.now(), end=timezone.now() + timedelta(days=1), request=requests[4])
+
+        self.assertTrue(update_request_states_for_window_expiration())
+        states = dict(Request.objects.values_list('id', 'state'))
+        self.assertEqual([states[request.id] for request in requests], ['WINDOW_EXPIRED'] * 4 + ['PENDING'])
+        self.userrequest.refresh_from_db()
+        other_userrequest.refresh_from_db()
+        self.assertEqual(self.userrequest.state, 'WINDOW_EXPIRED')
+        self.assertEqual(other_userrequest.state, 'PENDING')
+
+    def test_expired_requests_are_credited_ipp(self, ipp_mock):
+        userrequest = dmixer.blend(UserRequest, state='PENDING', ipp_value=1.5)
+        request = dmixer.blend(Request, state='PENDING', user_request=userrequest)
+        dmixer.blend(
+            Window, start=timezone.now() - timedelta(days=2), end=timezone.now() - timedelta(days=1), request=request
+        )
+        not_credited = dmixer.blend(Request, state='PENDING', user_request=self.userrequest)
+        self.userrequest.ipp_value = 0.5
+        self.userrequest.save()
+        dmixer.blend(
+            Window, start=timezone.now() - timedelta(days=2), end=timezone.now() - timedelta(days=1),
+            request=not_credited
+        )
+
+        update_request_states_for_window_expiration()
+        self.assertEqual(ipp_mock.call_count, 1)
+        ipp_value, credited, modification = ipp_mock.call_args[0]
+        self.assertEqual((ipp_value, [r.id for r in credited], modification), (1.5, [request.id], 'credit'))
+
+    def test_requests_of_terminal_user_requests_are_not_expired(self, ipp_mock):
+        userrequest = dmixer.blend(UserRequest, state='CANCELED')
+        request = dmixer.blend(Request, state='PENDING', user_request=userrequest)
+        dmixer.blend(
+            Window, start=timezone.now() - timedelta(days=2), end=timezone.now() - timedelta(days=1), request=request
+        )
+        self.assertFalse(update_request_states_for_window_expiration())
+        request.refresh_from_db()
+        self.assertEqual(request.state, 'PENDING')
+
+    def test_expired_requests_are_marked_modified(self, ipp_mock):
+        request = dmixer.blend(Request, state='PENDING', user_request=self.userrequest)
+        dmixer.blend(
+            Window, start=timezone.now() - timedelta(days=2), end=timezone.now() - timedelta(days=1), request=request
+        )
+        Request.objects.filter(pk=request.pk).update(modified=timezone.now() - timedelta(days=1))
+        update_request_states_for_window_expiration()
+        request.refresh_from_db()
+        self.assertGreater(request.modified, timezone.now() - timedelta(minutes=1))
+
+
+@patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
+class TestUserRequestTombstones(TestCase):
+    def setUp(self):
+        self.proposal = dmixer.blend(Proposal, active=True)
+        self.userrequest = dmixer.blend(UserRequest, state='PENDING', proposal=self.proposal)
+
+    def test_expired_user_request_gets_a_tombstone(self, ipp_mock):
+        request = dmixer.blend(Request, state='PENDING', user_request=self.userrequest)
+        dmixer.blend(
+            Window, start=timezone.now() - timedelta(days=2), end=timezone.now() - timedelta(days=1), request=request
+        )
+        update_request_states_for_window_expiration()
+        self.assertEqual(
+            list(UserRequestTombstone.objects.values_list('tracking_num', flat=True)), [self.userrequest.id]
+        )
+
+    def test_deleted_user_request_gets_a_tombstone(self, ipp_mock):
+        tracking_num = self.userrequest.id
+        self.userrequest.delete()
+        self.assertTrue(UserRequestTombstone.objects.filter(tracking_num=tracking_num).exists())
+
+    def test_deactivating_a_proposal_gives_its_user_requests_tombstones(self, ipp_mock):
+        dmixer.blend(UserRequest, state='CANCELED', proposal=self.proposal)
+        self.proposal.active = False
+        self.proposal.save()
+        self.assertEqual(
+            list(UserRequestTombstone.objects.values_list('tracking_num', flat=True)), [self.userrequest.id]
+        )
+
+    def test_reactivating_a_proposal_marks_its_user_requests_modified(self, ipp_mock):
+        Proposal.objects.filter(pk=self.proposal.pk).update(active=False)
+        UserRequest.objects.filter(pk=self.userrequest.pk).update(modified=timezone.now() - timedelta(days=1))
+        proposal = Proposal.objects.get(pk=self.proposal.pk)
+        proposal.active = True
+        proposal.save()
+        self.userrequest.refresh_from_db()
+        self.assertGreater(self.userrequest.modified, timezone.now() - timedelta(minutes=1))
+        self.assertFalse(UserRequestTombstone.objects.exists())
+
+    def test_saving_a_proposal_does_not_read_it_again(self, ipp_mock):
+        proposal = Proposal.objects.get(pk=self.proposal.pk)
+        proposal.title = 'retitled'
+        with CaptureQueriesContext(connection) as queries:
+            proposal.save()
+        self.assertFalse([query['sql'] for query in queries if query['sql'].startswith('SELECT')])
+        self.assertFalse(UserRequestTombstone.objects.exists())
+
+    def setup_time_allocation(self):
+        time_allocation = dmixer.blend(TimeAllocation, proposal=self.proposal, std_allocation=10.0, std_time_used=1.0)
+        UserRequest.objects.filter(pk=self.userrequest.pk).update(observation_type=UserRequest.NORMAL)
+        self.long_userrequest = dmixer.blend(UserRequest, state='PENDING', proposal=self.proposal,
+                                             observation_type=UserRequest.NORMAL)
+        for user_request, hours in ((self.userrequest, 5), (self.long_userrequest, 20)):
+            UserRequestTotalDuration.objects.create(
+                user_request=user_request, semester=time_allocation.semester,
+                telescope_class=time_allocation.telescope_class, duration=hours * 3600
+            )
+        UserRequest.objects.update(modified=timezone.now() - timedelta(days=1))
+        return TimeAllocation.objects.get(pk=time_allocation.pk)
+
+    def assertTouched(self, user_request, touched):
+        user_request.refresh_from_db()
+        if touched:
+            self.assertGreater(user_request.modified, timezone.now() - timedelta(minutes=1))
+        else:
+            self.assertLess(user_request.modified, timezone.now() - timedelta(hours=1))
+
+    @patch('valhalla.userrequests.signals.handlers.queue_schedulable_snapshot_update')
+    @patch('valhalla.userrequests.signals.handlers.transaction.on_commit', side_effect=lambda func: func())
+    def test_time_used_marks_user_requests_whose_time_left_flipped_modified(self, on_commit_mock, queue_mock, ipp_mock):
+        time_allocation = self.setup_time_allocation()
+        queue_mock.reset_mock()
+        time_allocation.save()
+        time_allocation.std_time_used = 2.0
+        time_allocation.save()
+        self.assertTouched(self.userrequest, False)
+        self.assertFalse(queue_mock.called)
+
+        # 4 hours left, with the overhead allowance, is no longer enough for the 5 hour user request
+        time_allocation.std_time_used = 6.0
+        time_allocation.save()
+        self.assertTouched(self.userrequest, True)
+        self.assertTouched(self.long_userrequest, False)
+        self.assertEqual(queue_mock.call_count, 1)
+
+    @patch('valhalla.userrequests.signals.handlers.transaction.on_commit')
+    def test_time_used_touches_user_requests_once_committed(self, on_commit_mock, ipp_mock):
+        time_allocation = self.setup_time_allocation()
+        time_allocation.std_time_used = 6.0
+        time_allocation.save()
+        self.assertTouched(self.userrequest, False)
+        on_commit_mock.call_args[0][0]()
+        self.assertTouched(self.userrequest, True)
+
+    @patch('valhalla.userrequests.signals.handlers.transaction.on_commit', side_effect=lambda func: func())
+    def test_deleting_a_time_allocation_marks_user_requests_that_fit_it_modified(self, on_commit_mock, ipp_mock):
+        self.setup_time_allocation().delete()
+        self.assertTouched(self.userrequest, True)
+        self.assertTouched(self.long_userrequest, False)
+
+    def test_old_tombstones_are_pruned(self, ipp_mock):
+        old = UserRequestTombstone.objects.create(tracking_num=1)
+        UserRequestTombstone.objects.filter(pk=old.pk).update(created=timezone.now() - timedelta(days=30))
+        UserRequestTombstone.objects.create(tracking_num=2)
+        prune_tombstones()
+        self.assertEqual(list(UserRequestTombstone.objects.values_list('tracking_num', flat=True)), [2])
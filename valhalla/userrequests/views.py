@@ -9,10 +9,8 @@ from django.http import HttpResponseBadRequest, HttpResponseServerError, HttpRes
 from django.utils import timezone
 from django.conf import settings
 from django.urls import reverse
-from django.core.cache import cache
 from dateutil.parser import parse
 from datetime import timedelta
-import requests
 from rest_framework.views import APIView
 
 from valhalla.common.configdb import configdb
@@ -22,7 +20,8 @@ from valhalla.userrequests.request_utils import get_airmasses_for_request_at_sit
 from valhalla.userrequests.models import UserRequest, Request
 from valhalla.userrequests.serializers import RequestSerializer
 from valhalla.userrequests.filters import UserRequestFilter
-from valhalla.userrequests.state_changes import update_request_states_from_pond_blocks
+from valhalla.userrequests.pond_ingestion import run_pond_ingestion, pop_is_dirty, get_ingestion_status
+from valhalla.userrequests.tasks import queue_schedulable_snapshot_update
 from valhalla.userrequests.contention import Contention, Pressure
 
 
@@ -187,31 +186,43 @@ class InstrumentsInformationView(APIView):
 class UserRequestStatusIsDirty(APIView):
     '''
         Gets the pond blocks changed since last call, and updates request and ur statuses with them. Returns if any
-        pond_blocks were received from the pond (isDirty)
+        pond_blocks were received from the pond (isDirty). With ISDIRTY_ASYNC a celery task does this in the background
+        instead, and this returns if any of its pulls changed states since the last call, and the cursor it pulls from.
     '''
     permission_classes = (IsAdminUser,)
 
     def get(self, request):
+        if settings.ISDIRTY_ASYNC:
+            return Response({'isDirty': pop_is_dirty(), 'cursor': get_ingestion_status()['cursor']})
+
         try:
             last_query_time = parse(request.query_params.get('last_query_time'))
         except (TypeError, ValueError):
-            last_query_time = cache.get('isDirty_query_time', (timezone.now() - timedelta(days=7)))
+            last_query_time = None
 
-        url = settings.POND_URL + '/pond/pond/blocks/new/?since={}&using=default'.format(last_query_time.strftime('%Y-%m-%dT%H:%M:%S'))
-        now = timezone.now()
         try:
-            response = requests.get(url)
-            response.raise_for_status()
+            counts = run_pond_ingestion(last_query_time)
         except Exception as e:
             return HttpResponseServerError({'error': repr(e)})
 
-        pond_blocks = response.json()
-        is_dirty = update_request_states_from_pond_blocks(pond_blocks)
-        cache.set('isDirty_query_time', now, None)
+        is_dirty = counts['is_dirty']
+        if is_dirty:
+            queue_schedulable_snapshot_update()
 
         return Response({'isDirty': is_dirty})
 
 
+class PondIngestionStatusView(APIView):
+    '''
+        How far behind the pond the request states are: the cursor the next pull of pond blocks starts from and its
+        lag in seconds, and the duration, block count and changed request counts of the last pull
+    '''
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(get_ingestion_status())
+
+
 class ContentionView(APIView):
     permission_classes = (AllowAny,)
 
@@ -2,27 +2,38 @@ from rest_framework import viewsets, filters
 from rest_framework.decorators import list_route, detail_route
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAdminUser
+from rest_framework.settings import api_settings
 from django.utils import timezone
+from django.http import StreamingHttpResponse, FileResponse, HttpResponseNotModified
+from django.conf import settings
+from django.db.models import Q
 from dateutil.parser import parse
+from datetime import timedelta
 import logging
+import gzip
 
-from valhalla.proposals.models import Proposal, Semester, TimeAllocation
-from valhalla.userrequests.models import UserRequest, Request, DraftUserRequest
+from valhalla.proposals.models import Proposal, Semester
+from valhalla.userrequests.models import UserRequest, Request, DraftUserRequest, UserRequestTombstone
 from valhalla.userrequests.filters import UserRequestFilter, RequestFilter
 from valhalla.userrequests.cadence import expand_cadence_request
 from valhalla.userrequests.serializers import RequestSerializer, UserRequestSerializer
 from valhalla.userrequests.serializers import DraftUserRequestSerializer, CadenceRequestSerializer
-from valhalla.userrequests.duration_utils import (get_request_duration_dict, get_max_ipp_for_userrequest,
-                                                  OVERHEAD_ALLOWANCE)
-from valhalla.userrequests.state_changes import InvalidStateChange, TERMINAL_STATES
+from valhalla.userrequests.duration_utils import get_request_duration_dict, get_max_ipp_for_userrequest
+from valhalla.userrequests.state_changes import InvalidStateChange
+from valhalla.userrequests.fast_serializers import serialize_user_requests, serialize_requests
+from valhalla.userrequests.schedulable import get_schedulable_user_requests, get_schedulable_snapshot
+from valhalla.userrequests.tasks import queue_schedulable_snapshot_update
+from valhalla.common.renderers import NDJSONRenderer, MessagePackRenderer
+from valhalla.common.compression import CompressedResponseMixin, get_accepted_encodings
 from valhalla.userrequests.request_utils import (get_airmasses_for_request_at_sites,
                                                  get_telescope_states_for_request)
 logger = logging.getLogger(__name__)
 
 
-class UserRequestViewSet(viewsets.ModelViewSet):
+class UserRequestViewSet(CompressedResponseMixin, viewsets.ModelViewSet):
     permission_classes = (IsAuthenticatedOrReadOnly,)
     http_method_names = ['get', 'post', 'head', 'options']
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [MessagePackRenderer]
     serializer_class = UserRequestSerializer
     filter_class = UserRequestFilter
     filter_backends = (
@@ -51,57 +62,120 @@ class UserRequestViewSet(viewsets.ModelViewSet):
             'requests__target', 'requests__location'
         )
 
-    @list_route(methods=['get'], permission_classes=(IsAdminUser,))
+    def list(self, request, *args, **kwargs):
+        # Pages are serialized straight from their rows, so the prefetching of get_queryset would go unused
+        ur_ids = self.filter_queryset(self.get_queryset()).prefetch_related(None).values_list('id', flat=True)
+        page = self.paginate_queryset(ur_ids)
+        page_ids = list(ur_ids if page is None else page)
+        ur_data = {ur['id']: ur for ur in serialize_user_requests(UserRequest.objects.filter(id__in=page_ids))}
+        ur_data = [ur_data[ur_id] for ur_id in page_ids]
+        if page is not None:
+            return self.get_paginated_response(ur_data)
+        return Response(ur_data)
+
+    @list_route(methods=['get'], permission_classes=(IsAdminUser,),
+                renderer_classes=api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer, MessagePackRenderer])
     def schedulable_requests(self, request):
         '''
             Gets the set of schedulable User requests for the scheduler, should be called right after isDirty finishes
             Needs a start and end time specified as the range of time to get requests in. Usually this is the entire
-            semester for a scheduling run.
+            semester for a scheduling run. With ?format=ndjson the User requests are streamed one per line as they are
+            serialized, instead of returned as one json list. With SCHEDULABLE_SNAPSHOT_ENABLED the json of the current
+            semester is served from the snapshot, with its version as the ETag.
+        '''
+        if settings.SCHEDULABLE_SNAPSHOT_ENABLED and request.accepted_renderer.format == 'json' and not (
+                {'start', 'end'} & set(request.query_params)):
+            response = self._schedulable_snapshot_response(request)
+            if response is not None:
+                return response
+
+        start, end = self._schedulable_range(request)
+        ur_data = get_schedulable_user_requests(start, end)
+        if isinstance(request.accepted_renderer, NDJSONRenderer):
+            return StreamingHttpResponse(
+                (request.accepted_renderer.render_item(serialized_ur) for serialized_ur in ur_data),
+                content_type=request.accepted_renderer.media_type
+            )
+        return Response(list(ur_data))
+
+    @list_route(methods=['get'], permission_classes=(IsAdminUser,))
+    def schedulable_requests_changes(self, request):
+        '''
+            Gets the changes to the schedulable User requests since the cursor returned by an earlier call, so the
+            scheduler only downloads what changed after isDirty. Takes the same start and end as schedulable_requests,
+            and the cursor as since. Returns the User requests that became schedulable or changed, the tracking numbers
+            of those that are no longer schedulable, and the cursor to pass next time. Changes to a proposal's active
+            flag, and changes to its time allocations or the time they used that flip whether User requests have time
+            left, count as changes to those User requests.
         '''
+        cursor = timezone.now()
+        if 'since' not in request.query_params:
+            return Response({'errors': ['since is required, start from the cursor of a full schedulable_requests']},
+                            status=400)
+        try:
+            since = parse(request.query_params['since'])
+        except (ValueError, OverflowError):
+            return Response({'errors': ['since must be a date and time, such as the cursor of an earlier call']},
+                            status=400)
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        if since < cursor - timedelta(days=settings.SCHEDULABLE_TOMBSTONE_DAYS):
+            return Response({'errors': ['Changes before {} are no longer kept, get schedulable_requests instead'.format(
+                cursor - timedelta(days=settings.SCHEDULABLE_TOMBSTONE_DAYS)
+            )]}, status=400)
+        # Overlapping the previous call catches changes whose transactions committed after it ran
+        since -= timedelta(seconds=settings.SCHEDULABLE_CHANGES_OVERLAP)
+
+        start, end = self._schedulable_range(request)
+        changed_ids = set(UserRequest.objects.filter(
+            Q(modified__gt=since) | Q(requests__modified__gt=since)
+        ).values_list('id', flat=True))
+        ur_data = list(get_schedulable_user_requests(start, end, UserRequest.objects.filter(id__in=changed_ids)))
+        removed = set(UserRequestTombstone.objects.filter(created__gt=since).values_list('tracking_num', flat=True))
+        # Changed User requests that were not returned are not schedulable anymore, if they ever were
+        removed = (removed | changed_ids) - {serialized_ur['id'] for serialized_ur in ur_data}
+        return Response({'cursor': cursor, 'user_requests': ur_data, 'removed': sorted(removed)})
+
+    def _schedulable_range(self, request):
         current_semester = Semester.current_semesters().first()
         start = parse(request.query_params.get('start', str(current_semester.start))).replace(tzinfo=timezone.utc)
         end = parse(request.query_params.get('end', str(current_semester.end))).replace(tzinfo=timezone.utc)
+        return start, end
 
-        # Schedulable requests are not in a terminal state, are part of an active proposal,
-        # and have a window within this semester
-        queryset = UserRequest.objects.exclude(state__in=TERMINAL_STATES).filter(
-            requests__windows__start__lte=end, requests__windows__start__gte=start,
-            proposal__active=True).prefetch_related('requests', 'requests__windows', 'requests__target', 'proposal',
-                                                    'proposal__timeallocation_set', 'requests__molecules',
-                                                    'requests__location', 'requests__constraints').distinct()
-
-        # queryset now contains all the schedulable URs and their associated requests and data
-        # Check that each request time available in its proposal still
-        ur_data = []
-        tas = {}
-        for ur in queryset.all():
-            total_duration_dict = ur.total_duration
-            for tak, duration in total_duration_dict.items():
-                if (tak, ur.proposal.id) in tas:
-                    time_allocation = tas[(tak, ur.proposal.id)]
-                else:
-                    time_allocation = TimeAllocation.objects.get(
-                        semester=tak.semester,
-                        telescope_class=tak.telescope_class,
-                        proposal=ur.proposal.id,
-                    )
-                    tas[(tak, ur.proposal.id)] = time_allocation
-                if ur.observation_type == UserRequest.NORMAL:
-                    time_left = time_allocation.std_allocation - time_allocation.std_time_used
-                else:
-                    time_left = time_allocation.too_allocation - time_allocation.too_time_used
-                if time_left * OVERHEAD_ALLOWANCE >= (duration / 3600.0):
-                    serialized_ur = UserRequestSerializer(ur)
-                    ur_data.append(serialized_ur.data)
-                    break
-                else:
-                    logger.warning(
-                        'not enough time left {0} in proposal {1} for ur {2} of duration {3}, skipping'.format(
-                            time_left, ur.proposal.id, ur.id, (duration / 3600.0)
-                        )
-                    )
-
-        return Response(ur_data)
+    def _schedulable_snapshot_response(self, request):
+        '''
+            The snapshot of the current semester's schedulable User requests, or None to serve them from the database
+            while an update is queued if the snapshot is missing or of an earlier semester. Responds 304 Not Modified
+            if the scheduler already has this version, and 404 if there is no current semester.
+        '''
+        current_semester = Semester.current_semesters().first()
+        if current_semester is None:
+            return Response({'errors': ['There is no current semester']}, status=404)
+        snapshot = get_schedulable_snapshot()
+        if snapshot is None or snapshot['semester'] != current_semester.id:
+            queue_schedulable_snapshot_update()
+            return None
+        etag = '"{}"'.format(snapshot['version'])
+        # If-None-Match compares weakly, and the tag is weakened when the response is compressed
+        if etag in [tag.strip().replace('W/', '', 1) for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+        try:
+            snapshot_file = open(snapshot['path'], 'rb')
+        except OSError:
+            # Replaced by a newer version since its pointer was read
+            return None
+        if not snapshot['gzip']:
+            response = FileResponse(snapshot_file, content_type='application/json')
+        elif {'gzip', '*'} & get_accepted_encodings(request):
+            response = FileResponse(snapshot_file, content_type='application/json')
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = FileResponse(gzip.GzipFile(fileobj=snapshot_file), content_type='application/json')
+        response['ETag'] = etag
+        response['Vary'] = 'Accept-Encoding'
+        return response
 
     @detail_route(methods=['post'])
     def cancel(self, request, pk=None):
@@ -160,8 +234,9 @@ class UserRequestViewSet(viewsets.ModelViewSet):
         return Response(ret_data)
 
 
-class RequestViewSet(viewsets.ReadOnlyModelViewSet):
+class RequestViewSet(CompressedResponseMixin, viewsets.ReadOnlyModelViewSet):
     permission_classes = (IsAuthenticatedOrReadOnly,)
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [MessagePackRenderer]
     serializer_class = RequestSerializer
     filter_class = RequestFilter
     filter_backends = (
@@ -181,6 +256,9 @@ class RequestViewSet(viewsets.ReadOnlyModelViewSet):
         else:
             return Request.objects.filter(user_request__proposal__in=Proposal.objects.filter(public=True))
 
+    def retrieve(self, request, *args, **kwargs):
+        return Response(serialize_requests(Request.objects.filter(pk=self.get_object().pk))[0])
+
     @detail_route()
     def airmass(self, request, pk=None):
         return Response(get_airmasses_for_request_at_sites(self.get_object().as_dict))